@@ -1,103 +1,29 @@
 # Author: https://github.com/JavaScriptDude
 # License: MIT
 
+# Kept free of heavy imports so CLI paths that do not need them start fast
+# - Web server classes are in qwebserver.py
+# - psutil, subprocess, pprint and traceback are imported where used
+
 import os
 import sys
-import traceback
 import logging
 import signal
-import psutil
 import time
 import threading
 import re
-from subprocess import Popen, DEVNULL
+import json
+import atexit
+import queue
+import selectors
 from datetime import datetime
-from pprint import pformat as pf
-from flask import Flask, request, make_response
-from flask_restx import Api as FlaskRestxApi, Resource
-from werkzeug.serving import make_server
 from urllib.parse import urlparse
+from collections.abc import Mapping, Sequence
 
 
 
-browser_pid = None
-
 log = logging.getLogger('qpaypal')
 
-# Disable Access Logging by werkzeug
-# Access logging will be handled by WSGI layer or above
-log_werkzeug = logging.getLogger('werkzeug')
-log_werkzeug.setLevel(logging.ERROR)
-
-
-class QResource(Resource):
-    def __init__(self, *class_args, **kwargs):
-        self.shutdown_server = kwargs['shutdown_server']
-        self.pc = kwargs['pc']
-        
-        super().__init__(*class_args, **kwargs)
-
-    #abstract method
-    def run(self): pass
-
-    def get(self): return self.run()
-    def post(self): return self.run()
-    
-    def html_response(self, html):
-        response = make_response()
-        response.set_data(html)
-        response.status_code = 200
-        response.headers['Content-Type'] = 'text/html'
-        return response
-
-    def shutdown_server(self):
-        pass
-
-
-class QWebServer(threading.Thread):
-    def __init__(self, host, port):
-        threading.Thread.__init__(self)
-        assert isinstance(host, str) and not host.strip() == '', 'host param is required'
-        assert isinstance(port, int), 'port param must be an integer'
-        
-        self.app = app = Flask(__name__)
-        self.host = host
-        self.port = port
-        self.api = FlaskRestxApi(self.app)
-        self.srv = make_server(self.host, self.port, self.app)
-        self.is_running = True
-
-    def _build_kwargs(self, pc):
-        return {'shutdown_server': self.begin_shutdown,'pc': pc}
-
-    def start(self):
-        # Finish flask_restx setup
-        self.ctx = self.app.app_context()
-        self.ctx.push()
-
-        # Start thread
-        super().start()
-
-
-    def run(self):
-        self.srv.serve_forever()
-
-    def _do_shutdown(self):
-        self.srv.shutdown()
-
-
-    def begin_shutdown(self):
-        global browser_pid
-        if self.is_running:
-            self.is_running = False
-            pc("Server being shut down")
-            t = threading.Thread(target=self._do_shutdown)
-            t.start()
-
-        close_proc_if_running('browser', browser_pid)
-
-
-
 def aget_bool(alias:str, obj, sKey, req:bool=True, defval=False):
     return aget(alias, obj, sKey, req=req, dtype=bool)
 
@@ -137,6 +63,11 @@ def aget(alias:str, obj, sKey, req:bool=True, noBlank:bool=False, dtype=str):
         # Can't use isinstance as almost everything is a subclass of object
         if dtype.__name__ == 'object':
             pass
+        # Read only views (eg. pptools.OrderView) pass as dict / list
+        elif dtype is dict and isinstance(v, Mapping):
+            pass
+        elif dtype is list and isinstance(v, Sequence) and not isinstance(v, (str, bytes)):
+            pass
         elif not isInst(v, dtype, subclass=True):
             raise AssertionError(f'value for key {sKey} in {alias} is not a {dtype.__name__}. Got: {getClassName(v)}')
 
@@ -209,29 +140,103 @@ def isInst(o, of, subclass:bool=False) -> bool:
 
 
 def dumpCurExcept(chain:bool=True):
+    import traceback
     ety, ev, etr = sys.exc_info()
     s = ''.join(traceback.format_exception(ety, ev, etr, chain=chain))
     iF = s.find('\n')
     return s[iF+1:] if iF > -1 else s
 
 
+# pc() output options. Change with pc_config()
+_pc_caller = True
+_pc_json = False
+_pc_listener = None
+_pc_files = {}
+_pc_dtms = (None, '')
+
+
+# caller:     include file:line of the pc() call
+# as_json:    emit one JSON object per message ({"ts", "caller", "msg"})
+# background: hand records to a queue drained by a background thread so callers never block on log I/O
+def pc_config(caller:bool=None, as_json:bool=None, background:bool=None):
+    global _pc_caller, _pc_json, _pc_listener
+    if caller is not None: _pc_caller = caller
+    if as_json is not None: _pc_json = as_json
+    if background is None: return
+    if background and _pc_listener is None:
+        from logging.handlers import QueueHandler, QueueListener
+        # Move the handlers that would have received records behind the queue
+        handlers = list(log.handlers) or list(logging.getLogger().handlers)
+        if not handlers:
+            handlers = [logging.StreamHandler(sys.stderr)] # Same output as logging.lastResort
+            handlers[0].setLevel(logging.WARNING)
+        for h in list(log.handlers): log.removeHandler(h)
+        q = queue.SimpleQueue()
+        log.addHandler(QueueHandler(q))
+        log.propagate = False
+        _pc_listener = QueueListener(q, *handlers, respect_handler_level=True)
+        _pc_listener.start()
+        atexit.register(_pc_stop_listener)
+    elif not background and _pc_listener is not None:
+        _pc_stop_listener()
+
+
+def _pc_stop_listener():
+    global _pc_listener
+    if _pc_listener is None: return
+    _pc_listener.stop() # Flushes queued records
+    for h in list(log.handlers): log.removeHandler(h)
+    for h in _pc_listener.handlers:
+        if not h in logging.getLogger().handlers: log.addHandler(h)
+    log.propagate = not log.handlers
+    _pc_listener = None
+
+
 def pc(*args):
-    global log
+    # Fast path - Skip all formatting when the record would be dropped
+    if not log.isEnabledFor(logging.WARNING): return
     i = 0; a = []
     for v in args:
-        a.append( ( v if i == 0 or isinstance(v, (int, float, complex, str)) else pf(v, indent=1, width=80, depth=2) ) )
+        a.append( ( v if i == 0 or isinstance(v, (int, float, complex, str)) else _pf(v) ) )
         i = i + 1
-    sMsg = "{}{} - {}".format(
-        getMachineDTMS()
-        ,(' ' + getCaller(1).__str__(0))
-        ,(a[0] if i == 1 else a[0].format(*a[1:]))
-    )
+    sText = a[0] if i == 1 else a[0].format(*a[1:])
+    sCaller = _pc_caller_str(sys._getframe(1)) if _pc_caller else None
+    if _pc_json:
+        sMsg = json.dumps({'ts': getMachineDTMS(), 'caller': sCaller, 'msg': str(sText)})
+    else:
+        sMsg = "{}{} - {}".format(
+            getMachineDTMS()
+            ,('' if sCaller is None else ' ' + sCaller)
+            ,sText
+        )
     log.warning(sMsg)
 
 
+def _pf(v):
+    from pprint import pformat
+    return pformat(v, indent=1, width=80, depth=2)
+
+
+# Same as getCaller(1).__str__(0) without the path split and f_locals lookup
+def _pc_caller_str(frame) -> str:
+    sFile = _pc_files.get(frame.f_code.co_filename)
+    if sFile is None:
+        sFile = _pc_files[frame.f_code.co_filename] = os.path.basename(frame.f_code.co_filename)
+    return f"{sFile}:{frame.f_lineno}"
+
+
 def getMachineDTMS(dt:datetime=None):
-    dt = datetime.now() if dt is None else dt
-    return dt.strftime("%y%m%d-%H%M%S.%f")[:-3]
+    global _pc_dtms
+    if dt is not None:
+        return dt.strftime("%y%m%d-%H%M%S.%f")[:-3]
+    # strftime only once per second
+    t = time.time()
+    iSec = int(t)
+    (iCached, sPrefix) = _pc_dtms
+    if not iSec == iCached:
+        sPrefix = time.strftime("%y%m%d-%H%M%S", time.localtime(iSec))
+        _pc_dtms = (iSec, sPrefix)
+    return f"{sPrefix}.{int((t - iSec) * 1000):03d}"
 
 
 def getCaller(depth=1):
@@ -251,6 +256,7 @@ class StackFrameItem:
             if 'self' in frame.f_locals:
                 self.clazz = frame.f_locals['self'].__class__.__name__
         except Exception as e:
+            import traceback
             exc_type, exc_value, exc_traceback = sys.exc_info()
             sTB = '\n'.join(traceback.format_tb(exc_traceback))
             print("Fatal exception: {}\n - msg: {}\n stack: {}".format(exc_type, exc_value, sTB))
@@ -280,6 +286,7 @@ def kill_proc_tree(pid, sig=signal.SIGTERM, include_parent=True,
     called as soon as a child terminates.
     """
     assert pid != os.getpid(), "won't kill myself"
+    import psutil
     parent = psutil.Process(pid)
     children = parent.children(recursive=True)
     if include_parent:
@@ -308,40 +315,193 @@ class StringBuffer:
         return delim.join(self._a)
 
 
-def launch_browser_and_watch(web_server, start_link):
-    global browser_pid
+# Returns the OrderEvent that ended the watch
+def launch_browser_and_watch(web_server, start_link, pending, watcher=None):
+    from subprocess import Popen, DEVNULL
+    watcher = get_proc_watcher() if watcher is None else watcher
     # Launch window to approve
     # To finish, close the window after hitting 'CONTINUE' button
     # Close when done or click 'Cancel and return ...'
     browser_proc = Popen(f'google-chrome {start_link}', shell=True, stdin=None, stdout=DEVNULL, stderr=DEVNULL, close_fds=True)
-    browser_pid = browser_proc.pid
-    
+    pending.browser_pid = browser_pid = browser_proc.pid
+
+    def _on_exit(pid):
+        browser_proc.poll() # Reap
+        if pending.resolve('closed'):
+            pc("Browser was closed by user")
+
     pc('Watching for browser being closed ...')
-    while web_server.is_running:
+    watcher.watch(browser_pid, _on_exit)
+    pending.wait()
+    watcher.unwatch(browser_pid)
+
+    if not pending.outcome == 'closed':
+        close_proc_if_running('browser', browser_pid)
+
+    browser_proc.poll()
+    web_server.unregister_order(pending.token)
+    return pending.event
+
+
+
+# Watches any number of processes from one thread and calls callback(pid) when one exits
+# - Linux 5.3+: a pidfd per process in a selector, so exit is seen immediately without polling
+# - Otherwise: one thread polls all watched pids every `poll_interval` secs
+# - Callbacks run on the watcher thread
+class ProcWatcher:
+    def __init__(self, poll_interval:float=0.5):
+        self.poll_interval = poll_interval
+        self._use_pidfd = hasattr(os, 'pidfd_open')
+        self._lock = threading.Lock()
+        self._callbacks = {}
+        self._fds = {}
+        self._changes = []
+        self._sel = selectors.DefaultSelector()
+        (self._wake_r, self._wake_w) = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._sel.register(self._wake_r, selectors.EVENT_READ, None)
+        self._thread = None
+        self._stopped = False
+
+
+    def watch(self, pid:int, callback):
+        assert callable(callback), f"callback is not callable. Got {getClassName(callback)}"
+        with self._lock:
+            assert not self._stopped, "ProcWatcher is stopped"
+            cbs = self._callbacks.get(pid)
+            if cbs is not None:
+                cbs.append(callback)
+                return
+            self._callbacks[pid] = [callback]
+            self._changes.append(('add', pid))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='pp-proc-watcher', daemon=True)
+                self._thread.start()
+        self._wake()
+
+
+    def unwatch(self, pid:int):
+        with self._lock:
+            if self._callbacks.pop(pid, None) is None: return
+            self._changes.append(('remove', pid))
+        self._wake()
+
+
+    def watching(self) -> list:
+        with self._lock:
+            return list(self._callbacks.keys())
+
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+        self._wake()
+
+
+    def _wake(self):
         try:
-            _p = psutil.Process(browser_pid)
-            _p_status = _p.status()
-            if _p_status == psutil.STATUS_ZOMBIE: 
-                break
-        except psutil.NoSuchProcess:
-            break
-        time.sleep(0.5)
+            os.write(self._wake_w, b'\0')
+        except BlockingIOError:
+            pass # Already has a pending wake up
+
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._stopped: break
+                changes = self._changes
+                self._changes = []
+            for (action, pid) in changes:
+                if action == 'add': self._add(pid)
+                else: self._close_fd(pid)
+
+            with self._lock:
+                polled = [pid for pid in self._callbacks if not pid in self._fds]
+
+            for (key, _) in self._sel.select(self.poll_interval if polled else None):
+                if key.data is None:
+                    try:
+                        while os.read(self._wake_r, 512): pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    self._exited(key.data)
+
+            for pid in polled:
+                if not _pid_running(pid): self._exited(pid)
+
+        for pid in list(self._fds): self._close_fd(pid)
+
 
-    if web_server.is_running:
-        pc("Browser was closed by user")
-        web_server.begin_shutdown()
+    def _add(self, pid):
+        if self._use_pidfd:
+            try:
+                fd = os.pidfd_open(pid)
+            except ProcessLookupError:
+                self._exited(pid)
+                return
+            except OSError:
+                self._use_pidfd = False # Kernel without pidfd support. Fall back to polling
+            else:
+                self._fds[pid] = fd
+                self._sel.register(fd, selectors.EVENT_READ, pid)
+                return
+
+
+    def _close_fd(self, pid):
+        fd = self._fds.pop(pid, None)
+        if fd is None: return
+        self._sel.unregister(fd)
+        os.close(fd)
+
+
+    def _exited(self, pid):
+        self._close_fd(pid)
+        with self._lock:
+            callbacks = self._callbacks.pop(pid, [])
+        for cb in callbacks:
+            try:
+                cb(pid)
+            except Exception as ex:
+                pc(f"WARNING - Process exit callback failed for pid {pid}: {ex}")
+
+
+_proc_watcher = None
+_proc_watcher_lock = threading.Lock()
+
+# Process wide ProcWatcher, started on first use
+def get_proc_watcher() -> ProcWatcher:
+    global _proc_watcher
+    with _proc_watcher_lock:
+        if _proc_watcher is None:
+            _proc_watcher = ProcWatcher()
+        return _proc_watcher
+
+
+def _pid_running(pid) -> bool:
+    import psutil
+    try:
+        return not psutil.Process(pid).status() == psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return False
 
 
 
 def close_proc_if_running(alias, pid):
-    _p = psutil.Process(pid)
-    if _p.is_running() and not _p.status() == psutil.STATUS_ZOMBIE:
-        pc(f"Closing {alias}")
-        kill_proc_tree(pid)
+    import psutil
+    try:
+        _p = psutil.Process(pid)
+        if _p.is_running() and not _p.status() == psutil.STATUS_ZOMBIE:
+            pc(f"Closing {alias}")
+            kill_proc_tree(pid)
+    except psutil.NoSuchProcess:
+        pass
 
 RE_VALID_EMAIL = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
+_re_valid_email = re.compile(RE_VALID_EMAIL)
 def valid_email(email) -> bool:
-    if re.fullmatch(RE_VALID_EMAIL, email):
+    if _re_valid_email.fullmatch(email):
         return True
     return False
 
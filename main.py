@@ -20,141 +20,402 @@ PP_PAYEE_EMAIL="<<email_for_paypal_account>>"
 """
 
 import os, sys, threading
-from dotenv import load_dotenv
-from flask import request
-from flask_restx import Resource
+from contextlib import nullcontext
 from pptools import *
 
-def main(argv):
+# Usage:
+#   python3 main.py                  - Create an order and approve / cancel it in Chrome (default)
+#   python3 main.py status <ordid>   - Print order status (NOT_FOUND if deleted)
+#   python3 main.py cancel <ordid>   - Cancel (delete) an order
+#   python3 main.py resume           - Finish orders left in flight by a crashed run (see run_resume)
+#   python3 main.py sweep [--file F] - Cancel / authorize stale orders in parallel (see ppsweep.py)
+#   python3 main.py bulk <file>      - Run orders from a CSV / JSONL file without a browser (see ppbulk.py)
+#   --journal <path>                 - Order journal (default PP_JOURNAL or ~/.paypal/pp_journal.db)
+#   --profile [cpu,mem,methods]      - Profile the command and write a report (or PP_PROFILE, see ppprofile.py)
+#   --trace <file>                   - Per order timeline spans as OTLP JSON (or PP_TRACE, see pptrace.py)
+# - status and cancel do not import flask or psutil so they start fast when called from scripts
 
-    # Start server to handle PayPal UI redirect for accepted / cancelled
-    ws_host='127.0.0.1'
-    ws_port=9991
-    web_server = WebServer(ws_host, ws_port)
+# Same off values as ppprofile.parse_profile_spec. Checked here so ppprofile is not imported
+PROFILE_OFF = ('', '0', 'off', 'false', 'no')
+
+
+def main(argv):
+    args = parse_args(argv)
 
     # Load Enviroment Variables
+    load_env()
+
+    # Set up client
+    pp_client = Client(get_env(), pool_size=max(10, getattr(args, 'workers', 0)))
+
+    # Profiling is only imported when asked for. PP_PROFILE=off / 0 / false / no means not asked
+    profile = args.profile or os.environ.get('PP_PROFILE')
+    if profile is not None and profile.strip().lower() in PROFILE_OFF: profile = None
+    if profile:
+        from ppprofile import RunProfiler
+        profiler = RunProfiler(args.cmd, profile, client=pp_client, out_dir=args.profile_dir)
+    else:
+        profiler = nullcontext()
+
+    # Tracing is only imported when asked for. Spans are keyed by order id (see pptrace.py)
+    trace_path = args.trace or os.environ.get('PP_TRACE')
+    tracer = None
+    if trace_path:
+        from pptrace import Tracer
+        tracer = Tracer(trace_path)
+        tracer.instrument_client(pp_client)
+
+    with profiler, (tracer or nullcontext()):
+        if args.cmd == 'status':
+            cmd_status(pp_client, args.ordid)
+        elif args.cmd == 'cancel':
+            cmd_cancel(pp_client, args.ordid)
+        else:
+            from ppjournal import OrderJournal
+            with OrderJournal(args.journal) as journal:
+                if args.cmd == 'resume':
+                    run_resume(pp_client, journal, tracer=tracer)
+                elif args.cmd == 'sweep':
+                    run_sweep(pp_client, journal, args)
+                elif args.cmd == 'bulk':
+                    run_bulk(pp_client, journal, args)
+                else:
+                    run_checkout(pp_client, journal, tracer=tracer)
+
+
+def parse_args(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='main.py', description='PayPal AUTHORIZE intent example')
+    parser.add_argument('--journal', default=None, help='Order journal (sqlite). Default: PP_JOURNAL or ~/.paypal/pp_journal.db')
+    parser.add_argument('--profile', nargs='?', const='cpu,mem', default=None, metavar='cpu,mem,methods'
+                       ,help='Profile the command. Default kinds: cpu,mem. Also PP_PROFILE')
+    parser.add_argument('--profile-dir', default=None, help='Profile report directory. Default: PP_PROFILE_DIR or ./pp_profiles')
+    parser.add_argument('--trace', default=None, metavar='FILE', help='Write per order trace spans as OTLP JSON. Also PP_TRACE')
+    sub = parser.add_subparsers(dest='cmd')
+    sub.add_parser('checkout', help='Create an order and approve / cancel it in Chrome (default)')
+    p = sub.add_parser('status', help='Print order status')
+    p.add_argument('ordid')
+    p = sub.add_parser('cancel', help='Cancel (delete) an order')
+    p.add_argument('ordid')
+    sub.add_parser('resume', help='Finish orders left in flight by a previous run')
+    p = sub.add_parser('sweep', help='Cancel / authorize stale CREATED and APPROVED orders')
+    p.add_argument('--file', default=None, help='Order ids, one per line. Default: in-flight orders in the journal')
+    p.add_argument('--created', default='cancel', choices=('cancel', 'keep'))
+    p.add_argument('--approved', default='authorize', choices=('authorize', 'cancel', 'keep'))
+    p.add_argument('--min-age', type=float, default=3600, help='Only touch orders created at least this many secs ago')
+    p.add_argument('--workers', type=int, default=8)
+    p.add_argument('--checkpoint', default=None, help='Swept ids file for resuming. Default: <file>.done with --file')
+    p.add_argument('--json', action='store_true', help='Print report as JSON')
+    p = sub.add_parser('bulk', help='Run orders from a CSV or JSONL file without a browser')
+    p.add_argument('file', help='Order specs (.csv with header or .jsonl)')
+    p.add_argument('--format', default=None, choices=('csv', 'jsonl'), help='Default: from file extension')
+    p.add_argument('--workers', type=int, default=8)
+    p.add_argument('--output', default='-', help='JSONL results file. Default: stdout')
+    p.add_argument('--approve', default=None, choices=('standin', 'none')
+                  ,help='standin: approve via the stand-in buyer. Default: standin when PP_ENV=standin else none')
+    args = parser.parse_args(argv)
+    if args.cmd is None: args.cmd = 'checkout'
+    return args
+
+
+def load_env():
     v = os.path.expanduser('~/.paypal/acmeinc_sandbox/.env')
+    if not os.path.isfile(v) and os.environ.get('PP_ENV', 'sandbox') == 'standin':
+        return # Stand-in needs no credentials
     assert os.path.isfile(v), f"Env file not found: {v}"
+    from dotenv import load_dotenv
     load_dotenv(dotenv_path=v)
 
-    # Set up client
-    pp_client = Client(get_sandbox_env())
-
-    # Create Order
-    amount = 6000
-    pc("Calling PayPal REST API to create Order")
-    ord_result = pp_client.create_order(
-         purchase_units={
-            "amount": {
-                "currency_code": "USD",
-                "value": f"{amount}.00"
+
+def cmd_status(pp_client, ordid):
+    (ord_exists, ord_status, ord_info) = pp_client.get_order_info(ordid)
+    print(ord_status if ord_exists else 'NOT_FOUND')
+    sys.stdout.flush()
+    sys.exit(0 if ord_exists else 2)
+
+
+def cmd_cancel(pp_client, ordid):
+    pp_client.cancel_order(ordid)
+    print('CANCELLED')
+    sys.stdout.flush()
+    sys.exit(0)
+
+
+WS_HOST = '127.0.0.1'
+WS_PORT = 9991
+
+
+def run_checkout(pp_client, journal, tracer=None):
+
+    # Web server threads should not block on log output
+    pc_config(background=True)
+
+    # Start server to handle PayPal UI redirect for accepted / cancelled
+    web_server = get_web_server_class()(WS_HOST, WS_PORT, tracer=tracer)
+
+    # Server thread is not a daemon so it must be shut down on every path, including errors
+    try:
+        # Create Order
+        amount = 6000
+        pc("Calling PayPal REST API to create Order")
+        ord_result = pp_client.create_order(
+             purchase_units={
+                "amount": {
+                    "currency_code": "USD",
+                    "value": f"{amount}.00"
+                }
+                # payee - This must be specified so that logo shows up in head of PayPal page
+                # - Note this will only show if application_context has no brand_name AND logo
+                #   is set in PayPal Account -> Account Settings -> Business Information -> Update ...
+                ,'payee': {'email_address': os.environ['PP_PAYEE_EMAIL']}
+            }
+            # https://developer.paypal.com/docs/api/orders/v1/#definition-application_context
+            ,application_context={
+                 # Remove shipping section
+                 'shipping_preference': "NO_SHIPPING" 
+                 # Order Status will be APPROVED at callback
+                ,'user_action': "CONTINUE"   
+                 # Optional - Show in text at top of window
+                 # - Note this will only show if purchase_unit has no payee
+                # ,'brand_name': 'Acme Anvil Incorporated'     
+                 # URL called on `CONTINUE`      
+                ,'return_url': f'http://{WS_HOST}:{WS_PORT}/pp_ord_accepted'        
+                 # URL called on `Cancel and return ...``     
+                ,'cancel_url': f'http://{WS_HOST}:{WS_PORT}/pp_ord_cancelled'             
             }
-            # payee - This must be specified so that logo shows up in head of PayPal page
-            # - Note this will only show if application_context has no brand_name AND logo
-            #   is set in PayPal Account -> Account Settings -> Business Information -> Update ...
-            ,'payee': {'email_address': os.environ['PP_PAYEE_EMAIL']}
-        }
-        # https://developer.paypal.com/docs/api/orders/v1/#definition-application_context
-        ,application_context={
-             # Remove shipping section
-             'shipping_preference': "NO_SHIPPING" 
-             # Order Status will be APPROVED at callback
-            ,'user_action': "CONTINUE"   
-             # Optional - Show in text at top of window
-             # - Note this will only show if purchase_unit has no payee
-            # ,'brand_name': 'Acme Anvil Incorporated'     
-             # URL called on `CONTINUE`      
-            ,'return_url': f'http://{ws_host}:{ws_port}/pp_ord_accepted'        
-             # URL called on `Cancel and return ...``     
-            ,'cancel_url': f'http://{ws_host}:{ws_port}/pp_ord_cancelled'             
-        }
-    )
-
-
-    pp_ordid = aget('ord_result', ord_result, 'id', True, True)
-
-
-    # Get Pay Pal approve link
-    (start_link, _, _) = get_link_by_rel(ord_result, 'approve')
-    pc(f'start_link: {start_link}')
-
-
-    # Test Order Status
-    (ord_exists, ord_status, ord_info) = pp_client.get_order_info(pp_ordid)
-    if not ord_exists: raise Exception(f"Order does not exist: {pp_ordid}")
-    if not ord_status == 'CREATED':
-        raise Exception(f"Unexpected order status: {ord_status}. Expecting CREATED.")
+        )
 
-    pc(f"Order {pp_ordid} is created. Loading PayPal dialog using Chrome...\n" 
-       +"You may hit `Continue`, `Cancel and return ...` or close the chrome window")
 
+        pp_ordid = aget('ord_result', ord_result, 'id', True, True)
 
-    # launch Chrome with PayPal UI
-    launch_browser_and_watch(web_server, start_link)
 
+        # Get Pay Pal approve link
+        (start_link, _, _) = get_link_by_rel(ord_result, 'approve')
+        pc(f'start_link: {start_link}')
 
-    # Get Order status and decide if its been cancelled
-    (ord_exists, ord_status, ord_info) = pp_client.get_order_info(pp_ordid)
-    if ord_status == 'CREATED':
-        pc("PayPal user cancelled or closed window")
 
-        pc('Calling PayPal REST API to cancel Order ...')
-        pp_client.cancel_order(pp_ordid)
+        # Journal the order before anything else can fail so `resume` can pick it up
+        journal.record(pp_ordid, 'CREATED', ord_result, start_link=start_link, wait=True)
 
-        # Check status of order
+
+        # Test Order Status
+        # - Create response is the full order (return=representation) so no need to GET it
+        ord_status = aget('ord_result', ord_result, 'status', True, True)
+        if not ord_status == 'CREATED':
+            raise Exception(f"Unexpected order status: {ord_status}. Expecting CREATED.")
+
+        finish_order(pp_client, journal, web_server, pp_ordid, start_link, tracer=tracer)
+
+    finally:
+        web_server.begin_shutdown(drain_timeout=0)
+        web_server.join()
+
+    pc("DONE\n.")
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    sys.exit(1)
+
+
+# Approve / cancel a CREATED order in Chrome then authorize or cancel it
+# - tracer: the user.approval span is ended by the web server / browser watcher thread that sees the outcome
+def finish_order(pp_client, journal, web_server, pp_ordid, start_link, tracer=None):
+    pc(f"Order {pp_ordid} is created. Loading PayPal dialog using Chrome...\n" 
+       +"You may hit `Continue`, `Cancel and return ...` or close the chrome window")
+
+
+    # launch Chrome with PayPal UI
+    # - PayPal passes the order id back as `token` on the redirect
+    pending = web_server.register_order(pp_ordid)
+    if tracer is not None: tracer.start_span(pp_ordid, 'user.approval', wait='user')
+    try:
+        event = launch_browser_and_watch(web_server, start_link, pending)
+    except Exception:
+        # Browser launch / watch failed. Free the token so the server does not drain on it
+        web_server.unregister_order(pp_ordid)
+        raise
+
+
+    # Decide from the redirect callback event
+    # - Only ask PayPal when the window was closed without a callback
+    if event.outcome == 'accepted':
+        ord_status = 'APPROVED'
+    elif event.outcome == 'cancelled':
+        ord_status = 'CREATED'
+    else:
         (ord_exists, ord_status, ord_info) = pp_client.get_order_info(pp_ordid)
-        if ord_exists: 
-            raise Exception(f"Order exists but should be deleted: {pp_ordid}. ord_info: {ord_info}")
+        if not ord_exists: raise Exception(f"Order does not exist: {pp_ordid}")
 
-        pc("Order Cancelled")
+    if ord_status == 'CREATED':
+        pc("PayPal user cancelled or closed window")
+        cancel_order(pp_client, journal, pp_ordid)
 
     elif not ord_status == 'APPROVED':
         raise Exception(f"Unexpected order status: {ord_status}. Expecting APPROVED.")
 
     else:
         pc('User approved the order by hitting CONTINUE')
+        journal.record(pp_ordid, 'APPROVED', wait=True)
+        authorize_order(pp_client, journal, pp_ordid)
 
-        pc('Calling PayPal REST API to authorize Order ...')
-        resu = pp_client.authorize_order(pp_ordid)
 
-        def _aget_strings(a):
-            sb = StringBuffer()
-            for k in a: sb.a(f"  -  {k}: {aget('resu', resu, k, True, True)}")
-            return sb.ts('\n')
+def cancel_order(pp_client, journal, pp_ordid):
+    pc('Calling PayPal REST API to cancel Order ...')
+    pp_client.cancel_order(pp_ordid) # Raises if order was not deleted
+    journal.record(pp_ordid, 'CANCELLED')
 
-        pc(f"\nOrder Auth Result:\n{_aget_strings(['id', 'intent','status','create_time', 'update_time'])}\n")
+    pc("Order Cancelled")
 
 
-        # Check status of order
-        (ord_exists, ord_status, ord_info) = pp_client.get_order_info(pp_ordid)
-        if not ord_exists: raise Exception(f"Order does not exist: {pp_ordid}")
-        if not ord_status == 'COMPLETED':
-            raise Exception(f"Unexpected order status: {ord_status}. Expecting COMPLETED.")
+def authorize_order(pp_client, journal, pp_ordid):
+    pc('Calling PayPal REST API to authorize Order ...')
+    resu = pp_client.authorize_order(pp_ordid)
+
+    def _aget_strings(a):
+        sb = StringBuffer()
+        for k in a: sb.a(f"  -  {k}: {aget('resu', resu, k, True, True)}")
+        return sb.ts('\n')
+
+    pc(f"\nOrder Auth Result:\n{_aget_strings(['id', 'intent','status','create_time', 'update_time'])}\n")
+
+
+    # Check status of order
+    # - Authorize response is the full order (return=representation)
+    ord_status = aget('resu', resu, 'status', True, True)
+    journal.record(pp_ordid, ord_status if ord_status == 'COMPLETED' else 'FAILED', resu
+                  ,note=None if ord_status == 'COMPLETED' else f"Unexpected status after authorize: {ord_status}")
+    if not ord_status == 'COMPLETED':
+        raise Exception(f"Unexpected order status: {ord_status}. Expecting COMPLETED.")
+
+    pc("Order Approved and completed")
 
-        pc("Order Approved and completed")
 
+# Finish orders left in flight by a previous run. Orders are never re-created:
+#   PayPal CREATED   -> Load the PayPal dialog again (user can approve or cancel)
+#   PayPal APPROVED  -> authorize
+#   PayPal COMPLETED -> journal only
+#   Not found        -> journal as CANCELLED (deleted or expired at PayPal)
+def run_resume(pp_client, journal, tracer=None):
+    orders = journal.pending_orders()
+    if not orders:
+        pc("No in-flight orders in journal")
+        return
+
+    pc(f"Resuming {len(orders)} in-flight order(s) from journal {journal.path}")
+    web_server = None
+    try:
+        for o in orders:
+            # One failed order should not stop the rest. Its journal state is left as is for the next resume
+            try:
+                (ord_exists, ord_status, ord_info) = pp_client.get_order_info(o.ordid, bypass_cache=True)
+                pc(f"Order {o.ordid}: journal state {o.state}, PayPal status {ord_status if ord_exists else 'NOT_FOUND'}")
+
+                if not ord_exists:
+                    journal.record(o.ordid, 'CANCELLED', note='Order not found at PayPal on resume')
+
+                elif ord_status == 'CREATED':
+                    if not o.start_link:
+                        pc(f"No approve link journaled for {o.ordid}. Cancelling")
+                        cancel_order(pp_client, journal, o.ordid)
+                        continue
+                    if web_server is None:
+                        pc_config(background=True)
+                        web_server = get_web_server_class()(WS_HOST, WS_PORT, tracer=tracer)
+                    finish_order(pp_client, journal, web_server, o.ordid, o.start_link, tracer=tracer)
+
+                elif ord_status == 'APPROVED':
+                    if o.state != 'APPROVED': journal.record(o.ordid, 'APPROVED', ord_info)
+                    authorize_order(pp_client, journal, o.ordid)
+
+                else:
+                    journal.record(o.ordid, ord_status, ord_info)
+            except Exception as ex:
+                pc(f"WARNING - Could not resume order {o.ordid}: {ex}")
+
+    finally:
+        if web_server is not None:
+            web_server.begin_shutdown()
+            web_server.join()
 
     pc("DONE\n.")
 
+
+def run_sweep(pp_client, journal, args):
+    import json
+    from ppsweep import Sweeper, SweepPolicy, read_order_ids
+
+    if args.file:
+        assert os.path.isfile(args.file), f"Order id file not found: {args.file}"
+        ordids = read_order_ids(args.file)
+        checkpoint = args.checkpoint or f"{args.file}.done"
+    else:
+        ordids = [o.ordid for o in journal.pending_orders()]
+        checkpoint = args.checkpoint
+
+    policy = SweepPolicy(created=args.created, approved=args.approved, min_age=args.min_age)
+    sweeper = Sweeper(pp_client, policy, max_workers=args.workers, checkpoint=checkpoint, journal=journal)
+    res = sweeper.run(ordids)
+
+    if args.json:
+        print(json.dumps(res.summary(), indent=1))
+    else:
+        print(res.report())
     sys.stdout.flush()
-    sys.stderr.flush()
-    sys.exit(1)
-        
+    sys.exit(1 if res.totals['failed'] else 0)
+
+
+def run_bulk(pp_client, journal, args):
+    import ppbulk
+    assert os.path.isfile(args.file), f"Order spec file not found: {args.file}"
+    approve = args.approve or ('standin' if os.environ.get('PP_ENV') == 'standin' else 'none')
+
+    out_f = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        totals = ppbulk.run_bulk(pp_client, args.file, out_f, fmt=args.format
+                                ,max_workers=args.workers, approve=approve, journal=journal)
+    finally:
+        if out_f is not sys.stdout: out_f.close()
+
+    pc("Bulk run done in {0:.2f}s - {1}", totals.pop('elapsed_s'), ' '.join(f"{k}: {n}" for (k, n) in totals.items()))
+    sys.exit(1 if totals['failed'] else 0)
+
+
+_WebServer = None
 
 # flask_restx server for handling accepted / cancelled redirections from PayPal UI
-class WebServer(QWebServer):
-    def __init__(self, host, port):
-        threading.Thread.__init__(self)
-        super().__init__(host, port)
-
-        @self.api.route('/pp_ord_accepted', '/pp_ord_cancelled', resource_class_kwargs=self._build_kwargs(pc))
-        class pp_ord_route(QResource):
-            def run(self):
-                self.pc('WebServer called: {0}', request.full_path)
-                self.shutdown_server()
-                return self.html_response('Page will close...')
-
-        self.start()
+# - Class is built on first use so flask is only imported when a redirect listener is needed
+def get_web_server_class():
+    global _WebServer
+    if _WebServer is not None: return _WebServer
+
+    from flask import request
+    from qwebserver import QWebServer, QResource
+
+    class WebServer(QWebServer):
+        def __init__(self, host, port, tracer=None):
+            threading.Thread.__init__(self)
+            super().__init__(host, port, tracer=tracer)
+
+            @self.api.route('/pp_ord_accepted', '/pp_ord_cancelled', resource_class_kwargs=self._build_kwargs(pc))
+            class pp_ord_route(QResource):
+                def run(self):
+                    self.pc('WebServer called: {0}', request.full_path)
+                    outcome = 'accepted' if request.path == '/pp_ord_accepted' else 'cancelled'
+                    pending = self.web_server.resolve_order(request.args.get('token'), outcome, request.args.to_dict())
+                    if pending is None:
+                        return self.html_response('Unknown or expired order', 404)
+                    return self.html_response('Page will close...')
+
+            self.start()
+
+    _WebServer = WebServer
+    return _WebServer
+
+
+# main.WebServer still works for code that imported it directly
+def __getattr__(name):
+    if name == 'WebServer': return get_web_server_class()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
         
             
@@ -0,0 +1,330 @@
+# ppasync.py
+# asyncio version of pptools.Client
+# Author: https://github.com/JavaScriptDude
+# License: MIT
+
+# Requires: python3 -m pip install aiohttp
+
+import asyncio
+import copy
+import platform
+import time
+import uuid
+import aiohttp
+from paypalhttp import HttpError
+from paypalhttp.encoder import Encoder
+from paypalhttp.http_response import HttpResponse
+from paypalhttp.serializers import Json, Text, Multipart, FormEncoded
+from paypalcheckoutsdk.core.paypal_http_client import USER_AGENT
+from paypalcheckoutsdk.orders import OrdersGetRequest
+from pptools import *
+
+
+# Usage:
+#   async with AsyncClient(get_sandbox_env()) as pp_client:
+#       ord_result = await pp_client.create_order(purchase_units={...}, application_context={...})
+#       (ord_exists, ord_status, ord_info) = await pp_client.get_order_info(ord_result['id'])
+class AsyncClient:
+    def __init__(self, environment
+                ,token_expiry_margin:int=60, token_refresh_ahead:int=300
+                ,pool_size:int=100, pool_size_per_host:int=0, keep_alive:bool=True, keepalive_timeout:float=15.0
+                ,connect_timeout:float=5.0, read_timeout:float=30.0, connector=None):
+        self.environment = environment
+        self.encoder = Encoder([Json(), Text(), Multipart(), FormEncoded()])
+        self._token_cache = AsyncAccessTokenCache(self._fetch_access_token
+                                    ,expiry_margin=token_expiry_margin
+                                    ,refresh_ahead=token_refresh_ahead)
+
+        # Connection pool is created on first use as aiohttp needs a running loop
+        # - Pass `connector` to share one aiohttp.TCPConnector between several clients
+        self.keep_alive = keep_alive
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self._connector = connector
+        self._connector_owner = connector is None
+        self._connector_kwargs = {
+             'limit': pool_size
+            ,'limit_per_host': pool_size_per_host
+            ,'force_close': not keep_alive
+        }
+        if keep_alive: self._connector_kwargs['keepalive_timeout'] = keepalive_timeout
+        self._session = None
+        self._stats = {'requests': 0, 'hits': 0, 'misses': 0}
+
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+    def pool_stats(self) -> dict:
+        return dict(self._stats)
+
+
+    async def get_access_token(self):
+        return await self._token_cache.get()
+
+
+    # PayPal-Request-Id is picked as in Client.create_order. Calls are not merged
+    async def create_order(self, purchase_units, application_context, request_id:str=None) -> dict:
+        request_id = request_id or derive_create_request_id(purchase_units, application_context) or f"create-{uuid.uuid4().hex}"
+        request = new_create_order_request(purchase_units, application_context, request_id=request_id)
+
+        ord_resp = await self.execute(request)
+
+        return get_order_result_dict(ord_resp)
+
+
+    # (ord_exists, ord_status, ord_info) = await get_order_info(<ordid>)
+    async def get_order_info(self, ordid):
+        req = OrdersGetRequest(ordid)
+        try:
+            resp = await self.execute(req)
+
+        except HttpError as he:
+            msg = he.message
+            if msg.find('RESOURCE_NOT_FOUND') > -1:
+                return (False, None, None)
+
+            raise Exception(f"HTTP Error occured. Message: '{msg}', error: {he}") from he
+
+        ord_info = get_order_result_dict(resp)
+        ord_status = aget('ord_info', ord_info, 'status', True, True)
+        return (True, ord_status, ord_info)
+
+
+    async def authorize_order(self, pp_ordid, request_id:str=None) -> dict:
+        req = new_authorize_order_request(pp_ordid, request_id=request_id or f"authorize-{pp_ordid}")
+
+        resp = await self.execute(req)
+
+        return get_authorize_result_dict(resp)
+
+
+    # Have to use v1 API as order deletion is not available in v2 API
+    async def cancel_order(self, order_id):
+        uri = f'{self.environment.base_url}/v1/checkout/orders/{order_id}'
+        (status, reason, headers, text) = await self._send(
+            'DELETE',
+            uri,
+            headers={
+                'Content-Type': 'application/json',
+                'Authorization': await self._token_cache.authorization_string()
+            }
+        )
+
+        if status >= 400:
+            raise Exception(f"\n\nPayPal API Call failed for url {uri}: {reason} ({text}).\nFull Response:\n{status} {headers}\n\n")
+
+        return
+
+
+    # Async equivalent of Client.execute for paypalcheckoutsdk request objects
+    async def execute(self, request) -> HttpResponse:
+        reqCpy = copy.deepcopy(request)
+
+        try:
+            getattr(reqCpy, 'headers')
+        except AttributeError:
+            reqCpy.headers = {}
+
+        reqCpy.headers["sdk_name"] = "Checkout SDK"
+        reqCpy.headers["sdk_version"] = "1.0.1"
+        reqCpy.headers["sdk_tech_stack"] = "Python" + platform.python_version()
+        reqCpy.headers["api_integration_type"] = "PAYPALSDK"
+        if "Authorization" not in reqCpy.headers:
+            reqCpy.headers["Authorization"] = await self._token_cache.authorization_string()
+
+        data = None
+
+        formatted_headers = _format_headers(reqCpy.headers)
+
+        if "user-agent" not in formatted_headers:
+            reqCpy.headers["user-agent"] = USER_AGENT
+
+        if hasattr(reqCpy, 'body') and reqCpy.body is not None:
+            data = self.encoder.serialize_request(_HeaderView(reqCpy, formatted_headers))
+
+        (status, reason, headers, text) = await self._send(reqCpy.verb, self.environment.base_url + reqCpy.path, headers=reqCpy.headers, data=data)
+
+        if 200 <= status <= 299:
+            body = ""
+            if text and (len(text) > 0 and text != 'None'):
+                body = self.encoder.deserialize_response(text, _format_headers(headers))
+
+            return HttpResponse(body, status, headers)
+        else:
+            raise HttpError(text, status, headers)
+
+
+    # (access_token, token_type, expires_in) = await _fetch_access_token()
+    async def _fetch_access_token(self):
+        (status, reason, headers, text) = await self._send(
+            'POST',
+            f'{self.environment.base_url}/v1/oauth2/token',
+            headers={
+                'Accept': 'application/json',
+                'Accept-Language': 'en_US',
+            },
+            auth=aiohttp.BasicAuth(self.environment.client_id, self.environment.client_secret),
+            data={'grant_type': 'client_credentials'},
+        )
+        if status >= 400:
+            raise HttpError(text, status, headers)
+        res = self.encoder.deserialize_response(text, _format_headers(headers))
+        access_token = aget('res', res, 'access_token', True, True)
+        token_type = aget('res', res, 'token_type', False, True)
+        expires_in = aget_int('res', res, 'expires_in', False)
+        return (access_token, token_type or 'Bearer', expires_in)
+
+
+    # (status, reason, headers, text) = await _send(method, url, ...)
+    # - On a 401 for a call with an Authorization header the token is dropped and the call resent
+    #   once with a new one, as in Client._send
+    async def _send(self, method, url, **kwargs):
+        res = await self._send_once(method, url, **kwargs)
+        headers = kwargs.get('headers')
+        if res[0] == 401 and headers:
+            key = next((k for k in headers if k.lower() == 'authorization'), None)
+            if key is not None:
+                self._token_cache.invalidate(headers[key])
+                kwargs['headers'] = dict(headers)
+                kwargs['headers'][key] = await self._token_cache.authorization_string()
+                res = await self._send_once(method, url, **kwargs)
+        return res
+
+
+    async def _send_once(self, method, url, **kwargs):
+        session = self._get_session()
+        async with session.request(method, url, **kwargs) as resp:
+            text = await resp.text()
+            return (resp.status, resp.reason, dict(resp.headers), text)
+
+
+    def _get_session(self):
+        if self._session is None:
+            if self._connector is None or self._connector.closed:
+                self._connector = aiohttp.TCPConnector(**self._connector_kwargs)
+                self._connector_owner = True
+
+            trace = aiohttp.TraceConfig()
+            trace.on_request_start.append(self._on_request_start)
+            trace.on_connection_create_end.append(self._on_connection_create)
+            trace.on_connection_reuseconn.append(self._on_connection_reuse)
+
+            self._session = aiohttp.ClientSession(
+                 connector=self._connector
+                ,connector_owner=self._connector_owner
+                ,timeout=self.timeout
+                ,trace_configs=[trace])
+        return self._session
+
+
+    async def _on_request_start(self, session, ctx, params):
+        self._stats['requests'] += 1
+
+    async def _on_connection_create(self, session, ctx, params):
+        self._stats['misses'] += 1
+
+    async def _on_connection_reuse(self, session, ctx, params):
+        self._stats['hits'] += 1
+
+
+
+# asyncio version of pptools.AccessTokenCache
+# - Callers in one event loop share a single in-flight fetch
+# - Once inside `refresh_ahead` seconds of expiry, refresh runs as a background task
+class AsyncAccessTokenCache:
+    def __init__(self, fetch, expiry_margin:int=60, refresh_ahead:int=300):
+        assert callable(fetch), f"fetch is not callable. Got {getClassName(fetch)}"
+        assert expiry_margin >= 0, f"expiry_margin must be >= 0. Got {expiry_margin}"
+        assert refresh_ahead >= expiry_margin, f"refresh_ahead must be >= expiry_margin. Got {refresh_ahead}"
+        self._fetch = fetch
+        self.expiry_margin = expiry_margin
+        self.refresh_ahead = refresh_ahead
+        self._token = None
+        self._token_type = None
+        self._expires_at = 0.0
+        self._task = None
+        self.fetch_count = 0
+
+
+    async def get(self) -> str:
+        return (await self._get())[0]
+
+
+    async def authorization_string(self) -> str:
+        (token, token_type) = await self._get()
+        return f"{token_type} {token}"
+
+
+    # authorization: drop the token only if it is still the one that failed, so concurrent
+    # 401s on the same token cause one fetch
+    def invalidate(self, authorization:str=None):
+        if authorization is not None and authorization != f"{self._token_type} {self._token}": return
+        self._token = None
+        self._expires_at = 0.0
+
+
+    # (token, token_type) = await _get()
+    async def _get(self):
+        now = time.monotonic()
+        if self._is_valid(now):
+            if self._task is None and now >= self._expires_at - self.refresh_ahead:
+                self._task = asyncio.ensure_future(self._refresh())
+                self._task.add_done_callback(self._on_background_done)
+            return (self._token, self._token_type)
+
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._refresh())
+            self._task.add_done_callback(_consume_exception)
+
+        # shield so a cancelled caller does not cancel the fetch for everyone else
+        await asyncio.shield(self._task)
+        return (self._token, self._token_type)
+
+
+    def _is_valid(self, now) -> bool:
+        return self._token is not None and now < self._expires_at - self.expiry_margin
+
+
+    async def _refresh(self):
+        started = time.monotonic()
+        try:
+            (token, token_type, expires_in) = await self._fetch()
+            self._token = token
+            self._token_type = token_type
+            self._expires_at = started + (expires_in if expires_in and expires_in > 0 else 0)
+            self.fetch_count += 1
+        finally:
+            self._task = None
+
+
+    def _on_background_done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            pc(f"WARNING - Background access token refresh failed: {task.exception()}")
+
+
+
+# Failure is raised to the awaiting callers. Retrieve it here too so a fetch whose
+# callers were all cancelled does not log 'Task exception was never retrieved'
+def _consume_exception(task):
+    if not task.cancelled(): task.exception()
+
+
+def _format_headers(headers):
+    return dict((k.lower(), v) for k, v in headers.items())
+
+
+# Presents a request with lower cased headers to paypalhttp Encoder without copying the body
+class _HeaderView:
+    def __init__(self, request, formatted_headers):
+        self.body = request.body
+        self.headers = formatted_headers
@@ -0,0 +1,307 @@
+# ppbench.py
+# End to end throughput / latency benchmark of pptools.Client against the local stand-in
+# Author: https://github.com/JavaScriptDude
+# License: MIT
+
+# Usage:
+#   python3 ppbench.py --orders 500 --concurrency 16 --cancel-ratio 0.2
+#   python3 ppbench.py --url http://127.0.0.1:9992 ...   (use an already running ppstandin.py)
+#   python3 ppbench.py imports --budget-ms 250 --status-budget-ms 400
+#                                                           (cold `import main` and `main.py status` time, heavy module check)
+#
+# Flows run per order:
+#   create -> approve -> authorize        (approve is the stand-in's simulated buyer)
+#   create -> cancel                      (for --cancel-ratio of the orders)
+
+import os
+import sys
+import math
+import json
+import time
+import random
+import argparse
+from pptools import *
+
+
+STEPS = ('create', 'approve', 'authorize', 'cancel', 'flow')
+
+
+# Returns the value at percentile p (0-100) of an already sorted list using nearest rank
+def percentile(sorted_values, p):
+    if not sorted_values: return None
+    k = max(0, min(len(sorted_values) - 1, math.ceil(p / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+
+class BenchResult:
+    def __init__(self):
+        self.timings = {k: [] for k in STEPS}
+        self.errors = {}
+        self.orders_ok = 0
+        self.orders_failed = 0
+        self.elapsed = 0.0
+
+    def add_error(self, step, ex):
+        key = f"{step}: {getClassName(ex)}"
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+    def summary(self) -> dict:
+        steps = {}
+        for (step, values) in self.timings.items():
+            if not values: continue
+            values = sorted(values)
+            steps[step] = {
+                 'count': len(values)
+                ,'p50_ms': percentile(values, 50) * 1000
+                ,'p95_ms': percentile(values, 95) * 1000
+                ,'p99_ms': percentile(values, 99) * 1000
+                ,'max_ms': values[-1] * 1000
+            }
+        return {
+             'orders_ok': self.orders_ok
+            ,'orders_failed': self.orders_failed
+            ,'elapsed_s': self.elapsed
+            ,'orders_per_sec': (self.orders_ok / self.elapsed) if self.elapsed > 0 else 0.0
+            ,'steps': steps
+            ,'errors': self.errors
+        }
+
+    def report(self) -> str:
+        d = self.summary()
+        sb = StringBuffer()
+        sb.al(f"orders ok: {d['orders_ok']}  failed: {d['orders_failed']}  elapsed: {d['elapsed_s']:.2f}s  orders/sec: {d['orders_per_sec']:.1f}")
+        sb.al(f"{'step':<10}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for (step, s) in d['steps'].items():
+            sb.al(f"{step:<10}{s['count']:>8}{s['p50_ms']:>10.1f}{s['p95_ms']:>10.1f}{s['p99_ms']:>10.1f}{s['max_ms']:>10.1f}")
+        for (k, n) in d['errors'].items():
+            sb.al(f"error {k}: {n}")
+        return sb.ts()
+
+
+
+def run_benchmark(client, orders:int=100, concurrency:int=8, cancel_ratio:float=0.2
+                 ,return_url:str='http://127.0.0.1:9991/pp_ord_accepted'
+                 ,cancel_url:str='http://127.0.0.1:9991/pp_ord_cancelled') -> BenchResult:
+    res = BenchResult()
+    application_context = {
+         'shipping_preference': "NO_SHIPPING"
+        ,'user_action': "CONTINUE"
+        ,'brand_name': 'Benchmark'
+        ,'return_url': return_url
+        ,'cancel_url': cancel_url
+    }
+
+    def _timed(step, fn, *args):
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        except Exception as ex:
+            res.add_error(step, ex)
+            raise
+        finally:
+            res.timings[step].append(time.perf_counter() - started)
+
+    def _flow(i):
+        started = time.perf_counter()
+        purchase_units = {'amount': {'currency_code': 'USD', 'value': f"{random.randint(1, 9999)}.00"}}
+        ord_result = _timed('create', client.create_order, purchase_units, application_context)
+        pp_ordid = aget('ord_result', ord_result, 'id', True, True)
+        if i < orders * cancel_ratio:
+            _timed('cancel', client.cancel_order, pp_ordid)
+        else:
+            (start_link, _, _) = get_link_by_rel(ord_result, 'approve')
+            _timed('approve', standin_buyer_action, client, start_link)
+            _timed('authorize', client.authorize_order, pp_ordid)
+        res.timings['flow'].append(time.perf_counter() - started)
+
+    # Interleave cancel and authorize flows
+    idx = list(range(orders))
+    random.shuffle(idx)
+
+    started = time.perf_counter()
+    for r in run_batch(_flow, idx, max_workers=concurrency, stream=True):
+        if r.ok: res.orders_ok += 1
+        else: res.orders_failed += 1
+    res.elapsed = time.perf_counter() - started
+    return res
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Modules that must not be loaded by `import main` or `main.py status`. They are imported lazily when needed
+HEAVY_MODULES = ('flask', 'flask_restx', 'werkzeug', 'psutil', 'aiohttp', 'dotenv')
+
+_IMPORT_PROBE = """
+import sys, time, json
+t = time.perf_counter()
+import main
+ms = (time.perf_counter() - t) * 1000
+print(json.dumps({'ms': ms, 'heavy': [m for m in %r if m in sys.modules]}))
+"""
+
+
+# Times `import main` in fresh interpreters. Returns {'runs', 'median_ms', 'max_ms', 'heavy', 'top'}
+def run_import_benchmark(runs:int=5, top:int=0) -> dict:
+    import subprocess
+    import statistics
+    probe = _IMPORT_PROBE % (HEAVY_MODULES,)
+    times = []
+    heavy = set()
+    for i in range(runs):
+        out = subprocess.run([sys.executable, '-c', probe], capture_output=True, text=True, check=True, cwd=REPO_DIR)
+        d = json.loads(out.stdout.strip().splitlines()[-1])
+        times.append(d['ms'])
+        heavy.update(d['heavy'])
+
+    top_entries = []
+    if top > 0:
+        # -X importtime lines: "import time: self [us] | cumulative | imported package"
+        out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'], capture_output=True, text=True, check=True, cwd=REPO_DIR)
+        top_entries = sorted(_importtime_entries(out.stderr), reverse=True)[:top]
+
+    return {'runs': runs, 'median_ms': statistics.median(times), 'max_ms': max(times)
+           ,'heavy': sorted(heavy), 'top': top_entries}
+
+
+# [(cumulative_ms, module)] from -X importtime lines: "import time: self [us] | cumulative | imported package"
+def _importtime_entries(stderr:str) -> list:
+    entries = []
+    for line in stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit(): continue
+        entries.append((int(parts[1]) / 1000, parts[2].strip()))
+    return entries
+
+
+# Wall time of `python3 main.py status <ordid>` in fresh processes against the stand-in, interpreter
+# start to exit. This is the fast path scripts call, so it is budgeted as a whole and not only the import
+# - url: running ppstandin.py. Default: one is started in process
+# - HOME is an empty dir so no ~/.paypal env file is loaded. The stand-in needs no credentials
+# Returns {'runs', 'median_ms', 'max_ms', 'heavy'}
+def run_status_benchmark(runs:int=5, url:str=None) -> dict:
+    import subprocess
+    import statistics
+    import tempfile
+
+    server = None
+    if url is None:
+        from ppstandin import StandInServer
+        server = StandInServer('127.0.0.1', 0)
+        server.start()
+        url = server.url
+    client = Client(get_standin_env(url))
+    try:
+        ord_result = client.create_order({'amount': {'currency_code': 'USD', 'value': '1.00'}}
+                                        ,{'shipping_preference': 'NO_SHIPPING', 'user_action': 'CONTINUE', 'brand_name': 'ppbench'
+                                         ,'return_url': 'http://127.0.0.1:9991/pp_ord_accepted', 'cancel_url': 'http://127.0.0.1:9991/pp_ord_cancelled'})
+        ordid = aget('ord_result', ord_result, 'id', True, True)
+
+        with tempfile.TemporaryDirectory() as home:
+            env = dict(os.environ, PP_ENV='standin', PP_STANDIN_URL=url, HOME=home)
+            env.pop('PP_PROFILE', None)
+            env.pop('PP_TRACE', None)
+            cmd = [sys.executable, os.path.join(REPO_DIR, 'main.py'), 'status', ordid]
+            times = []
+            for i in range(runs):
+                t = time.perf_counter()
+                subprocess.run(cmd, capture_output=True, text=True, check=True, cwd=REPO_DIR, env=env)
+                times.append((time.perf_counter() - t) * 1000)
+
+            out = subprocess.run([sys.executable, '-X', 'importtime'] + cmd[1:], capture_output=True, text=True, check=True, cwd=REPO_DIR, env=env)
+            loaded = {name.split('.')[0] for (_, name) in _importtime_entries(out.stderr)}
+    finally:
+        client.close()
+        if server is not None:
+            server.begin_shutdown(drain_timeout=0)
+            server.join()
+
+    return {'runs': runs, 'median_ms': statistics.median(times), 'max_ms': max(times)
+           ,'heavy': sorted(m for m in HEAVY_MODULES if m in loaded)}
+
+
+def main_imports(argv):
+    parser = argparse.ArgumentParser(prog='ppbench.py imports', description='Check the startup cost of `import main` and `main.py status`')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=None, help='Fail if median import time exceeds this')
+    parser.add_argument('--status-budget-ms', type=float, default=None, help='Fail if median `main.py status` wall time exceeds this')
+    parser.add_argument('--no-status', action='store_true', help='Only time `import main`')
+    parser.add_argument('--url', default=None, help='URL of a running ppstandin.py for the status runs. Default: start one in process')
+    parser.add_argument('--top', type=int, default=0, help='List the N slowest modules (cumulative) from -X importtime')
+    parser.add_argument('--json', action='store_true', help='Print result as JSON')
+    args = parser.parse_args(argv)
+
+    d = run_import_benchmark(runs=args.runs, top=args.top)
+    failed = []
+    if d['heavy']:
+        failed.append(f"heavy modules imported: {', '.join(d['heavy'])}")
+    if args.budget_ms is not None and d['median_ms'] > args.budget_ms:
+        failed.append(f"median {d['median_ms']:.1f}ms exceeds budget {args.budget_ms:.1f}ms")
+    if not args.no_status:
+        st = d['status'] = run_status_benchmark(runs=args.runs, url=args.url)
+        if st['heavy']:
+            failed.append(f"heavy modules imported by main.py status: {', '.join(st['heavy'])}")
+        if args.status_budget_ms is not None and st['median_ms'] > args.status_budget_ms:
+            failed.append(f"main.py status median {st['median_ms']:.1f}ms exceeds budget {args.status_budget_ms:.1f}ms")
+    d['failed'] = failed
+
+    if args.json:
+        print(json.dumps(d, indent=1))
+    else:
+        print(f"import main: median {d['median_ms']:.1f}ms  max {d['max_ms']:.1f}ms  ({d['runs']} runs)")
+        if 'status' in d:
+            st = d['status']
+            print(f"main.py status: median {st['median_ms']:.1f}ms  max {st['max_ms']:.1f}ms  ({st['runs']} runs, process start to exit)")
+        for (ms, name) in d['top']:
+            print(f"{ms:>10.1f}ms  {name}")
+        for msg in failed:
+            print(f"FAIL - {msg}")
+    sys.exit(1 if failed else 0)
+
+
+def main(argv):
+    if argv[:1] == ['imports']:
+        return main_imports(argv[1:])
+
+    parser = argparse.ArgumentParser(prog='ppbench.py', description='pptools.Client end to end benchmark against the PayPal stand-in')
+    parser.add_argument('--url', default=None, help='URL of a running ppstandin.py. Default: start one in process')
+    parser.add_argument('--orders', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--cancel-ratio', type=float, default=0.2)
+    parser.add_argument('--latency', type=float, default=0.0, help='In process stand-in only')
+    parser.add_argument('--latency-jitter', type=float, default=0.0, help='In process stand-in only')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='In process stand-in only')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='In process stand-in only')
+    parser.add_argument('--json', action='store_true', help='Print summary as JSON')
+    args = parser.parse_args(argv)
+
+    server = None
+    url = args.url
+    if url is None:
+        from ppstandin import StandInServer
+        server = StandInServer('127.0.0.1', 0
+                    ,latency=args.latency, latency_jitter=args.latency_jitter
+                    ,error_rate=args.error_rate, rate_429=args.rate_429)
+        server.start()
+        url = server.url
+
+    client = Client(get_standin_env(url), pool_size=max(10, args.concurrency))
+    try:
+        res = run_benchmark(client, orders=args.orders, concurrency=args.concurrency, cancel_ratio=args.cancel_ratio)
+        pool = client.pool_stats()
+    finally:
+        client.close()
+        if server is not None:
+            server.begin_shutdown(drain_timeout=0)
+            server.join()
+
+    if args.json:
+        d = res.summary()
+        d['pool'] = pool
+        print(json.dumps(d, indent=1))
+    else:
+        print(res.report())
+
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,202 @@
+# ppbulk.py
+# Headless bulk run of orders from a CSV or JSONL file
+# - Each order spec runs create -> (approve) -> status check -> authorize, or create -> cancel
+# - Runs with bounded parallelism and writes one JSONL result per order as it finishes
+# Author: https://github.com/JavaScriptDude
+# License: MIT
+
+# Usage:
+#   PP_ENV=standin python3 main.py bulk orders.csv --workers 16 --output results.jsonl
+#
+# Order spec fields (CSV header or JSONL keys). Only amount is required:
+#   ref          - Caller reference, copied to the result
+#   amount       - eg. 12.50
+#   currency     - Default USD
+#   payee        - Payee email
+#   brand_name   - Shown at top of PayPal page
+#   return_url   - Default http://127.0.0.1:9991/pp_ord_accepted
+#   cancel_url   - Default http://127.0.0.1:9991/pp_ord_cancelled
+#   action       - authorize (default) or cancel
+#
+# Approval: with approve='standin' the stand-in's simulated buyer approves each order.
+# With approve='none' (real PayPal) orders wait for a buyer and finish as `not_approved`,
+# to be picked up later by `main.py sweep`
+
+import csv
+import json
+import time
+from decimal import Decimal, InvalidOperation
+from helpers import *
+from pptools import run_batch, get_link_by_rel, standin_buyer_action
+
+
+DEFAULT_RETURN_URL = 'http://127.0.0.1:9991/pp_ord_accepted'
+DEFAULT_CANCEL_URL = 'http://127.0.0.1:9991/pp_ord_cancelled'
+
+# Outcome per order: authorized, cancelled, not_approved, failed
+
+
+class OrderSpec:
+    __slots__ = ('line', 'ref', 'amount', 'currency', 'payee', 'brand_name', 'return_url', 'cancel_url', 'action')
+
+    def __init__(self, line:int, d:dict):
+        self.line = line
+        self.ref = _opt(d, 'ref')
+        self.amount = format_amount(d.get('amount'))
+        self.currency = (_opt(d, 'currency') or 'USD').upper()
+        self.payee = _opt(d, 'payee')
+        self.brand_name = _opt(d, 'brand_name')
+        self.return_url = _opt(d, 'return_url') or DEFAULT_RETURN_URL
+        self.cancel_url = _opt(d, 'cancel_url') or DEFAULT_CANCEL_URL
+        self.action = (_opt(d, 'action') or 'authorize').lower()
+        assert self.action in ('authorize', 'cancel'), f"action must be authorize or cancel. Got {self.action}"
+
+
+    # (purchase_units, application_context) for Client.create_order
+    def to_request(self):
+        purchase_units = {'amount': {'currency_code': self.currency, 'value': self.amount}}
+        if self.payee: purchase_units['payee'] = {'email_address': self.payee}
+        application_context = {
+             'shipping_preference': "NO_SHIPPING"
+            ,'user_action': "CONTINUE"
+            ,'return_url': self.return_url
+            ,'cancel_url': self.cancel_url
+        }
+        # Without payee or brand_name the validator warns on every order
+        brand_name = self.brand_name or (None if self.payee else 'Bulk Run')
+        if brand_name: application_context['brand_name'] = brand_name
+        return (purchase_units, application_context)
+
+
+
+def _opt(d, k):
+    v = d.get(k)
+    if v is None: return None
+    v = str(v).strip()
+    return v or None
+
+
+# '12.5' / 12.5 -> '12.50'
+def format_amount(v) -> str:
+    if v is None or str(v).strip() == '': raise AssertionError("Missing key amount from order spec")
+    try:
+        d = Decimal(str(v).strip())
+    except InvalidOperation:
+        raise AssertionError(f"amount is not a number. Got {v!r}")
+    if d <= 0: raise AssertionError(f"amount must be > 0. Got {v!r}")
+    return str(d.quantize(Decimal('0.01')))
+
+
+# Yields (line, ref, spec_or_exception) from a .csv or .jsonl file without reading it all
+# - A line that does not parse yields the exception so it is reported and the run continues
+# - ref is read from the raw record before validation so failures can be matched to input rows
+def read_order_specs(path:str, fmt:str=None):
+    if fmt is None: fmt = 'csv' if path.lower().endswith('.csv') else 'jsonl'
+    assert fmt in ('csv', 'jsonl'), f"fmt must be csv or jsonl. Got {fmt}"
+    with open(path, 'r', newline='') as f:
+        if fmt == 'csv':
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield _spec(_csv_row_line(reader, row), lambda: row)
+        else:
+            for (i, line) in enumerate(f):
+                line = line.strip()
+                if not line or line.startswith('#'): continue
+                yield _spec(i + 1, lambda: json.loads(line))
+
+
+# File line a CSV row starts on
+# - reader.line_num is the line the row ends on. Quoted fields can span lines so count back over them
+def _csv_row_line(reader, row) -> int:
+    n = 0
+    for v in row.values():
+        if isinstance(v, list): n += sum(x.count('\n') for x in v) # Extra fields under restkey
+        elif v: n += v.count('\n')
+    return reader.line_num - n
+
+
+def _spec(line, get):
+    d = None
+    try:
+        d = get()
+        if not isinstance(d, dict): raise AssertionError(f"Order spec is not an object. Got {getClassName(d)}")
+        return (line, _opt(d, 'ref'), OrderSpec(line, d))
+    except Exception as ex:
+        return (line, _opt(d, 'ref') if isinstance(d, dict) else None, ex)
+
+
+
+# Runs one order spec. Returns the result dict written to the output
+# - Errors are returned as outcome `failed` with the ordid if the order was created
+def run_order_spec(client, spec:OrderSpec, approve:str='none', journal=None) -> dict:
+    out = {'line': spec.line, 'ref': spec.ref, 'action': spec.action}
+    try:
+        _run_order_spec(client, spec, approve, journal, out)
+    except Exception as ex:
+        out['outcome'] = 'failed'
+        out['error'] = f"{getClassName(ex)}: {ex}"
+    return out
+
+
+def _run_order_spec(client, spec, approve, journal, out):
+    (purchase_units, application_context) = spec.to_request()
+    ord_result = client.create_order(purchase_units, application_context)
+    ordid = aget('ord_result', ord_result, 'id', True, True)
+    out['ordid'] = ordid
+    (start_link, _, _) = get_link_by_rel(ord_result, 'approve')
+    if journal is not None: journal.record(ordid, 'CREATED', ord_result, start_link=start_link)
+
+    if spec.action == 'cancel':
+        client.cancel_order(ordid)
+        if journal is not None: journal.record(ordid, 'CANCELLED', note='Cancelled by bulk run')
+        out['outcome'] = 'cancelled'
+        return
+
+    if approve == 'standin':
+        standin_buyer_action(client, start_link, 'approve')
+
+    (ord_exists, ord_status, ord_info) = client.get_order_info(ordid, bypass_cache=True)
+    if not ord_exists: raise Exception(f"Order does not exist: {ordid}")
+    out['status'] = ord_status
+    if not ord_status == 'APPROVED':
+        out['outcome'] = 'not_approved'
+        out['approve_link'] = start_link
+        return
+    if journal is not None: journal.record(ordid, 'APPROVED', ord_info)
+
+    resu = client.authorize_order(ordid)
+    ord_status = aget('resu', resu, 'status', True, True)
+    out['status'] = ord_status
+    if not ord_status == 'COMPLETED':
+        raise Exception(f"Unexpected order status: {ord_status}. Expecting COMPLETED.")
+    if journal is not None: journal.record(ordid, 'COMPLETED', resu)
+    try:
+        out['authorization_id'] = resu['purchase_units'][0]['payments']['authorizations'][0]['id']
+    except (KeyError, IndexError, TypeError):
+        pass
+    out['outcome'] = 'authorized'
+
+
+
+# Streams results of all specs in `path` to `out_f` (one JSON object per line) as they finish
+# Returns totals by outcome
+def run_bulk(client, path:str, out_f, fmt:str=None, max_workers:int=8, approve:str='none', journal=None) -> dict:
+    assert approve in ('standin', 'none'), f"approve must be standin or none. Got {approve}"
+    totals = {'authorized': 0, 'cancelled': 0, 'not_approved': 0, 'failed': 0}
+
+    def _run(item):
+        (line, ref, spec) = item
+        if isinstance(spec, Exception):
+            return {'line': line, 'ref': ref, 'outcome': 'failed', 'error': f"{getClassName(spec)}: {spec}"}
+        return run_order_spec(client, spec, approve=approve, journal=journal)
+
+    started = time.perf_counter()
+    for r in run_batch(_run, read_order_specs(path, fmt), max_workers=max_workers, stream=True):
+        d = r.result
+        d['elapsed_ms'] = round(r.elapsed * 1000, 1)
+        totals[d['outcome']] += 1
+        out_f.write(json.dumps(d) + '\n')
+        out_f.flush()
+
+    totals['elapsed_s'] = time.perf_counter() - started
+    return totals
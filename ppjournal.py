@@ -0,0 +1,255 @@
+# ppjournal.py
+# Durable order state journal in SQLite (WAL mode)
+# - Each order state transition is recorded with a summary of the PayPal response
+# - Writes are queued and committed in batches by one writer thread
+# - `python3 main.py resume` uses pending_orders() to finish in-flight orders after a crash
+# Author: https://github.com/JavaScriptDude
+# License: MIT
+
+import os
+import json
+import time
+import queue
+import sqlite3
+import threading
+from helpers import *
+
+
+# Order states. Orders not in TERMINAL_STATES are returned by pending_orders()
+#   CREATED -> APPROVED -> COMPLETED
+#   CREATED -> CANCELLED
+#   FAILED: gave up after an error. Left for manual follow up
+TERMINAL_STATES = ('COMPLETED', 'CANCELLED', 'VOIDED', 'FAILED')
+
+
+def default_journal_path() -> str:
+    return os.environ.get('PP_JOURNAL') or os.path.expanduser('~/.paypal/pp_journal.db')
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS transitions (
+     id INTEGER PRIMARY KEY
+    ,ordid TEXT NOT NULL
+    ,state TEXT NOT NULL
+    ,ts REAL NOT NULL
+    ,summary TEXT
+);
+CREATE INDEX IF NOT EXISTS transitions_ordid ON transitions (ordid, id);
+CREATE TABLE IF NOT EXISTS orders (
+     ordid TEXT PRIMARY KEY
+    ,state TEXT NOT NULL
+    ,created REAL NOT NULL
+    ,updated REAL NOT NULL
+    ,start_link TEXT
+);
+CREATE INDEX IF NOT EXISTS orders_state ON orders (state);
+"""
+
+_INSERT_TRANSITION = "INSERT INTO transitions (ordid, state, ts, summary) VALUES (?, ?, ?, ?)"
+
+_UPSERT_ORDER = """
+INSERT INTO orders (ordid, state, created, updated, start_link) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (ordid) DO UPDATE SET
+     state = excluded.state
+    ,updated = excluded.updated
+    ,start_link = COALESCE(excluded.start_link, orders.start_link)
+"""
+
+
+class JournalOrder:
+    __slots__ = ('ordid', 'state', 'created', 'updated', 'start_link')
+
+    def __init__(self, ordid, state, created, updated, start_link):
+        self.ordid = ordid
+        self.state = state
+        self.created = created
+        self.updated = updated
+        self.start_link = start_link
+
+    def __repr__(self):
+        return f"JournalOrder({self.ordid!r}, {self.state!r})"
+
+
+
+# Usage:
+#   journal = OrderJournal()
+#   journal.record(pp_ordid, 'CREATED', ord_result, start_link=start_link, wait=True)
+#   ...
+#   for o in journal.pending_orders(): ...
+#   journal.close()
+#
+# record() returns once queued. Pass wait=True for transitions that must be on disk
+# before continuing (eg. CREATED, so a crash can not orphan the order)
+class OrderJournal:
+    def __init__(self, path:str=None, batch_size:int=1000, synchronous:str='NORMAL'):
+        assert batch_size > 0, f"batch_size must be > 0. Got {batch_size}"
+        assert synchronous in ('OFF', 'NORMAL', 'FULL'), f"synchronous must be OFF, NORMAL or FULL. Got {synchronous}"
+        self.path = path or default_journal_path()
+        d = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(d): os.makedirs(d, exist_ok=True)
+        self.batch_size = batch_size
+        self.synchronous = synchronous
+        self._q = queue.SimpleQueue()
+        self._closed = False
+        self._stats = {'records': 0, 'batches': 0, 'errors': 0}
+
+        # Create the schema up front so errors surface in the caller
+        conn = self._connect()
+        conn.executescript(_SCHEMA)
+        conn.close()
+
+        self._read_conn = self._connect(check_same_thread=False)
+        self._read_lock = threading.Lock()
+
+        self._writer = threading.Thread(target=self._run, name='OrderJournal', daemon=True)
+        self._writer.start()
+
+
+    def _connect(self, check_same_thread:bool=True):
+        conn = sqlite3.connect(self.path, timeout=30.0, isolation_level=None, check_same_thread=check_same_thread)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA synchronous={self.synchronous}')
+        return conn
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    # result: order / authorize response to summarize. note: free text (eg. reason for FAILED)
+    def record(self, ordid:str, state:str, result=None, note:str=None, start_link:str=None, wait:bool=False, timeout:float=30.0):
+        assert isStr(ordid) and ordid, f"ordid must be a non blank str. Got {ordid!r}"
+        assert isStr(state) and state, f"state must be a non blank str. Got {state!r}"
+        if self._closed: raise Exception("OrderJournal is closed")
+        summary = order_summary(result) if result is not None else {}
+        if note: summary['note'] = note
+        self._q.put((ordid, state, time.time(), json.dumps(summary) if summary else None, start_link))
+        if wait: self.flush(timeout=timeout)
+
+
+    # Blocks until everything recorded so far is committed. Raises if a write failed
+    def flush(self, timeout:float=30.0):
+        marker = _Flush()
+        self._q.put(marker)
+        if not marker.event.wait(timeout):
+            raise Exception(f"OrderJournal flush timed out after {timeout}s")
+        if marker.error is not None:
+            raise Exception(f"OrderJournal write failed: {marker.error}")
+
+
+    def close(self):
+        if self._closed: return
+        self._closed = True
+        self._q.put(None)
+        self._writer.join()
+        with self._read_lock:
+            self._read_conn.close()
+
+
+    # Latest state of each order that is not in TERMINAL_STATES, oldest first
+    def pending_orders(self) -> list:
+        sql = (f"SELECT ordid, state, created, updated, start_link FROM orders"
+               f" WHERE state NOT IN ({','.join('?' * len(TERMINAL_STATES))}) ORDER BY created")
+        with self._read_lock:
+            rows = self._read_conn.execute(sql, TERMINAL_STATES).fetchall()
+        return [JournalOrder(*r) for r in rows]
+
+
+    def get_order(self, ordid:str) -> JournalOrder:
+        with self._read_lock:
+            r = self._read_conn.execute("SELECT ordid, state, created, updated, start_link FROM orders WHERE ordid = ?"
+                                       ,(ordid,)).fetchone()
+        return None if r is None else JournalOrder(*r)
+
+
+    # [(state, ts, summary_dict)] oldest first
+    def history(self, ordid:str) -> list:
+        with self._read_lock:
+            rows = self._read_conn.execute("SELECT state, ts, summary FROM transitions WHERE ordid = ? ORDER BY id"
+                                          ,(ordid,)).fetchall()
+        return [(state, ts, json.loads(summary) if summary else None) for (state, ts, summary) in rows]
+
+
+    def stats(self) -> dict:
+        return dict(self._stats)
+
+
+    # Writer thread. Everything already queued is committed as one transaction so
+    # batches grow with load while a lone record is written straight away
+    def _run(self):
+        conn = self._connect()
+        stop = False
+        while not stop:
+            batch = [self._q.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._q.get_nowait())
+                except queue.Empty:
+                    break
+
+            rows = []
+            markers = []
+            for item in batch:
+                if item is None: stop = True
+                elif isinstance(item, _Flush): markers.append(item)
+                else: rows.append(item)
+
+            error = None
+            if rows:
+                try:
+                    conn.execute('BEGIN')
+                    conn.executemany(_INSERT_TRANSITION, [(o, s, ts, summ) for (o, s, ts, summ, _) in rows])
+                    conn.executemany(_UPSERT_ORDER, [(o, s, ts, ts, link) for (o, s, ts, _, link) in rows])
+                    conn.execute('COMMIT')
+                    self._stats['records'] += len(rows)
+                    self._stats['batches'] += 1
+                except Exception as ex:
+                    error = ex
+                    self._stats['errors'] += 1
+                    try:
+                        conn.execute('ROLLBACK')
+                    except sqlite3.Error:
+                        pass
+                    pc(f"WARNING - OrderJournal failed to write {len(rows)} records: {ex}")
+
+            for m in markers:
+                m.error = error
+                m.event.set()
+
+        conn.close()
+
+
+
+class _Flush:
+    __slots__ = ('event', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.error = None
+
+
+
+# Small JSON safe summary of an order or authorize response for the journal
+def order_summary(result) -> dict:
+    d = {}
+    for k in ('id', 'status', 'intent', 'create_time', 'update_time'):
+        v = _get(result, k)
+        if v is not None: d[k] = v
+    pus = _get(result, 'purchase_units')
+    if pus:
+        auths = _get(_get(pus[0], 'payments'), 'authorizations')
+        if auths:
+            d['authorization_id'] = _get(auths[0], 'id')
+            d['authorization_status'] = _get(auths[0], 'status')
+    return d
+
+
+def _get(obj, k):
+    if obj is None: return None
+    try:
+        return obj[k]
+    except (KeyError, IndexError, TypeError):
+        return None
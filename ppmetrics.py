@@ -0,0 +1,177 @@
+# ppmetrics.py
+# In process latency histograms and counters with Prometheus text output
+# - Client operations, their HTTP calls and QWebServer routes record here
+# - QWebServer serves METRICS at /metrics
+# Author: https://github.com/JavaScriptDude
+# License: MIT
+
+import bisect
+import threading
+import time
+from functools import wraps
+
+
+# Upper bounds in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # Last is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, v:float):
+        self.counts[bisect.bisect_left(self.buckets, v)] += 1
+        self.sum += v
+        self.count += 1
+
+    # Cumulative counts per upper bound as Prometheus expects
+    def cumulative(self) -> list:
+        out = []
+        n = 0
+        for (le, c) in zip(list(self.buckets) + [float('inf')], self.counts):
+            n += c
+            out.append((le, n))
+        return out
+
+    # Estimated value at quantile q (0-1) by linear interpolation within the bucket
+    def quantile(self, q:float) -> float:
+        if self.count == 0: return None
+        rank = q * self.count
+        n = 0
+        lower = 0.0
+        for (i, c) in enumerate(self.counts):
+            if n + c >= rank and c > 0:
+                if i == len(self.buckets): return self.buckets[-1]
+                return lower + (self.buckets[i] - lower) * ((rank - n) / c)
+            n += c
+            if i < len(self.buckets): lower = self.buckets[i]
+        return self.buckets[-1]
+
+
+# Metric families:
+#   pp_operation_duration_seconds{component, op}           histogram
+#   pp_operation_errors_total{component, op}               counter
+#   pp_http_request_duration_seconds{component, op, status} histogram (status 'error' when no response)
+class MetricsRegistry:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._ops = {}
+        self._errors = {}
+        self._http = {}
+        self._lock = threading.Lock()
+
+
+    def observe(self, component:str, op:str, seconds:float, error:bool=False):
+        key = (component, op)
+        with self._lock:
+            h = self._ops.get(key)
+            if h is None: h = self._ops[key] = Histogram(self.buckets)
+            h.observe(seconds)
+            if error:
+                self._errors[key] = self._errors.get(key, 0) + 1
+            elif not key in self._errors:
+                self._errors[key] = 0
+
+
+    def observe_http(self, component:str, op:str, status, seconds:float):
+        key = (component, op, str(status))
+        with self._lock:
+            h = self._http.get(key)
+            if h is None: h = self._http[key] = Histogram(self.buckets)
+            h.observe(seconds)
+
+
+    def reset(self):
+        with self._lock:
+            self._ops.clear()
+            self._errors.clear()
+            self._http.clear()
+
+
+    # {'operations': {(component, op): {...}}, 'http': {(component, op, status): {...}}}
+    def snapshot(self) -> dict:
+        def _d(h):
+            return {'count': h.count, 'sum': h.sum
+                   ,'p50': h.quantile(0.50), 'p95': h.quantile(0.95), 'p99': h.quantile(0.99)}
+        with self._lock:
+            ops = {}
+            for (key, h) in self._ops.items():
+                ops[key] = _d(h)
+                ops[key]['errors'] = self._errors.get(key, 0)
+            return {'operations': ops, 'http': {k: _d(h) for (k, h) in self._http.items()}}
+
+
+    def render_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            ops = [(k, _copy_hist(h)) for (k, h) in self._ops.items()]
+            errors = dict(self._errors)
+            http = [(k, _copy_hist(h)) for (k, h) in self._http.items()]
+
+        _render_histogram(lines, 'pp_operation_duration_seconds', 'Latency of Client operations and web routes'
+                         ,('component', 'op'), ops)
+
+        lines.append('# HELP pp_operation_errors_total Operations that raised an exception or returned an error status')
+        lines.append('# TYPE pp_operation_errors_total counter')
+        for (key, n) in sorted(errors.items()):
+            lines.append(f"pp_operation_errors_total{_labels(('component', 'op'), key)} {n}")
+
+        _render_histogram(lines, 'pp_http_request_duration_seconds', 'Latency of HTTP calls by response status'
+                         ,('component', 'op', 'status'), http)
+        return '\n'.join(lines) + '\n'
+
+
+
+# Times a method of an object with a `metrics` attribute. Records an error when it raises
+def timed_method(component:str, op:str):
+    def deco(fn):
+        @wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            metrics = self.metrics
+            if metrics is None: return fn(self, *args, **kwargs)
+            started = time.perf_counter()
+            error = True
+            try:
+                ret = fn(self, *args, **kwargs)
+                error = False
+                return ret
+            finally:
+                metrics.observe(component, op, time.perf_counter() - started, error)
+        return wrapper
+    return deco
+
+
+def _copy_hist(h):
+    c = Histogram(h.buckets)
+    c.counts = list(h.counts)
+    c.sum = h.sum
+    c.count = h.count
+    return c
+
+
+def _render_histogram(lines, name, help, label_names, items):
+    lines.append(f"# HELP {name} {help}")
+    lines.append(f"# TYPE {name} histogram")
+    for (key, h) in sorted(items, key=lambda kv: kv[0]):
+        for (le, n) in h.cumulative():
+            sLe = '+Inf' if le == float('inf') else repr(float(le))
+            lines.append(f"{name}_bucket{_labels(label_names + ('le',), key + (sLe,))} {n}")
+        lines.append(f"{name}_sum{_labels(label_names, key)} {h.sum}")
+        lines.append(f"{name}_count{_labels(label_names, key)} {h.count}")
+
+
+def _labels(names, values) -> str:
+    return '{' + ','.join(f'{n}="{_escape(v)}"' for (n, v) in zip(names, values)) + '}'
+
+
+def _escape(v) -> str:
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Process wide default registry
+METRICS = MetricsRegistry()
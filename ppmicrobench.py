@@ -0,0 +1,220 @@
+# ppmicrobench.py
+# Microbenchmarks of the helpers.py / pptools.py hot paths run on every request
+# - Uses recorded PayPal responses in bench_payloads/ (ids and emails are sandbox / made up)
+# - Results are compared against a saved baseline and regressions over --threshold fail the run
+# - Baselines are machine specific. Save one per machine / python version before changing code
+# Author: https://github.com/JavaScriptDude
+# License: MIT
+
+# Usage:
+#   python3 ppmicrobench.py --save                 (record baseline to bench_baseline.json)
+#   python3 ppmicrobench.py                        (compare to baseline, exit 1 on regression)
+#   python3 ppmicrobench.py --filter 'aget|link' --threshold 0.10 --json
+
+import os
+import re
+import sys
+import json
+import timeit
+import logging
+import argparse
+import platform
+from datetime import datetime
+import helpers
+from pptools import *
+
+
+PAYLOAD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_payloads')
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+
+
+def load_payloads(path:str=PAYLOAD_DIR) -> dict:
+    payloads = {}
+    for name in sorted(os.listdir(path)):
+        if not name.endswith('.json'): continue
+        with open(os.path.join(path, name), 'r') as f:
+            payloads[name[:-5]] = f.read()
+    return payloads
+
+
+# Stands in for the requests.Response passed to HttpClient.parse_response
+class _RecordedResponse:
+    def __init__(self, text, status_code):
+        self.text = text
+        self.status_code = status_code
+        self.headers = {'Content-Type': 'application/json'}
+
+
+
+# [(name, fn)] - fn is called with no args
+def build_benchmarks(payloads:dict) -> list:
+    create_txt = payloads['create_order_201']
+    auth_txt = payloads['authorize_order_201']
+    created = json.loads(create_txt)
+    approved = json.loads(payloads['get_order_approved_200'])
+    authorized = json.loads(auth_txt)
+    pu = approved['purchase_units'][0]
+
+    client = Client(get_standin_env('http://127.0.0.1:9992'), metrics=None)
+    create_resp = client.parse_response(_RecordedResponse(create_txt, 201))
+    auth_resp = client.parse_response(_RecordedResponse(auth_txt, 201))
+    created_view = OrderView(created)
+
+    purchase_units = {'amount': {'currency_code': 'USD', 'value': '6000.00'}
+                     ,'payee': {'email_address': 'sb-merchant43@business.example.com'}}
+    application_context = {'shipping_preference': 'NO_SHIPPING', 'user_action': 'CONTINUE'
+                          ,'return_url': 'http://127.0.0.1:9991/pp_ord_accepted'
+                          ,'cancel_url': 'http://127.0.0.1:9991/pp_ord_cancelled'}
+
+    def _string_buffer():
+        sb = StringBuffer()
+        for k in ('id', 'intent', 'status', 'create_time', 'update_time'):
+            sb.a(f"  -  {k}: {authorized[k]}")
+        return sb.ts('\n')
+
+    return [
+         ('aget.str', lambda: aget('ord_info', approved, 'status', True, True))
+        ,('aget.missing_optional', lambda: aget('ord_info', approved, 'update_time', False))
+        ,('aget_dict', lambda: aget_dict('purchase_units', pu, 'amount'))
+        ,('aget_list', lambda: aget_list('ord_info', approved, 'links'))
+        ,('isInst.type', lambda: isInst(approved, dict))
+        ,('isInst.tuple', lambda: isInst(approved, (list, tuple, dict), subclass=True))
+        ,('valid_email', lambda: valid_email('sb-buyer47@personal.example.com'))
+        ,('valid_uri', lambda: valid_uri('https://www.sandbox.paypal.com/checkoutnow?token=5O190127TN364715T'))
+        ,('pc.dropped', lambda: pc('Order {0} is {1}', 'ORD', 'APPROVED'))
+        ,('pc.formatted', lambda: pc('Order {0} is {1}', 'ORD', 'APPROVED'))
+        ,('StringBuffer', _string_buffer)
+        ,('parse_response.create', lambda: client.parse_response(_RecordedResponse(create_txt, 201)))
+        ,('parse_response.authorize', lambda: client.parse_response(_RecordedResponse(auth_txt, 201)))
+        ,('get_order_result_dict.create', lambda: get_order_result_dict(create_resp))
+        ,('get_order_result_dict.authorize', lambda: get_order_result_dict(auth_resp))
+        ,('OrderView.json', lambda: OrderView(json.loads(create_txt)))
+        ,('get_link_by_rel.dict', lambda: get_link_by_rel(created, 'approve'))
+        ,('get_link_by_rel.view', lambda: get_link_by_rel(created_view, 'approve'))
+        ,('validate_order_request', lambda: ORDER_VALIDATOR.check(purchase_units, application_context))
+        ,('new_create_order_request', lambda: new_create_order_request(purchase_units, application_context))
+    ]
+
+
+
+# Runs fn enough times for each repeat to take about min_time secs. Returns best ns per call
+def time_call(fn, repeat:int=5, min_time:float=0.05) -> float:
+    timer = timeit.Timer(fn)
+    number = 1
+    while True:
+        t = timer.timeit(number)
+        if t >= min_time / 10 or number >= 10**7: break
+        number *= 10
+    number = max(1, int(number * min_time / max(t, 1e-9)))
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e9
+
+
+# {name: ns_per_call}
+# - The suite runs `rounds` times interleaved and the best per benchmark is kept, so a burst of
+#   machine noise during one benchmark does not read as a regression
+def run_benchmarks(pattern:str=None, repeat:int=5, min_time:float=0.05, rounds:int=3, payloads:dict=None) -> dict:
+    benches = build_benchmarks(payloads or load_payloads())
+    rx = re.compile(pattern) if pattern else None
+    results = {}
+    log = helpers.log
+    saved = (log.level, log.propagate, list(log.handlers))
+    try:
+        for h in list(log.handlers): log.removeHandler(h)
+        log.addHandler(logging.NullHandler())
+        log.propagate = False
+        for _ in range(rounds):
+            for (name, fn) in benches:
+                if rx is not None and not rx.search(name): continue
+                # pc.dropped exercises the fast path, pc.formatted formats and emits to a NullHandler
+                log.setLevel(logging.ERROR if name == 'pc.dropped' else logging.WARNING)
+                ns = time_call(fn, repeat=repeat, min_time=min_time)
+                if name not in results or ns < results[name]: results[name] = ns
+    finally:
+        for h in list(log.handlers): log.removeHandler(h)
+        for h in saved[2]: log.addHandler(h)
+        log.setLevel(saved[0])
+        log.propagate = saved[1]
+    return results
+
+
+def machine_info() -> dict:
+    return {'python': platform.python_version(), 'implementation': platform.python_implementation()
+           ,'platform': platform.platform(), 'machine': platform.machine()}
+
+
+def save_baseline(path:str, results:dict):
+    with open(path, 'w') as f:
+        json.dump({'meta': dict(machine_info(), saved=datetime.now().isoformat(timespec='seconds'))
+                  ,'results': results}, f, indent=1, sort_keys=True)
+        f.write('\n')
+
+
+def load_baseline(path:str) -> dict:
+    if not os.path.isfile(path): return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+# [(name, ns, base_ns, delta)] - delta is relative change (0.1 = 10% slower). base_ns / delta None if new
+def compare(results:dict, baseline:dict) -> list:
+    base = (baseline or {}).get('results', {})
+    rows = []
+    for (name, ns) in results.items():
+        b = base.get(name)
+        rows.append((name, ns, b, None if not b else (ns - b) / b))
+    return rows
+
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='ppmicrobench.py', description='Microbenchmarks of helpers / pptools hot paths')
+    parser.add_argument('--filter', default=None, help='Regex of benchmark names to run')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.05, help='Secs per repeat')
+    parser.add_argument('--rounds', type=int, default=3, help='Interleaved runs of the suite. Best is kept')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save', action='store_true', help='Save results as the baseline')
+    parser.add_argument('--threshold', type=float, default=0.15, help='Relative slowdown reported as a regression')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.filter, repeat=args.repeat, min_time=args.min_time, rounds=args.rounds)
+
+    if args.save:
+        baseline = load_baseline(args.baseline) if args.filter else None
+        if baseline is not None: # Partial run updates only the benchmarks that ran
+            baseline['results'].update(results)
+            results = baseline['results']
+        save_baseline(args.baseline, results)
+        print(f"Baseline saved to {args.baseline} ({len(results)} benchmarks)")
+        return
+
+    baseline = load_baseline(args.baseline)
+    rows = compare(results, baseline)
+    regressions = [r for r in rows if r[3] is not None and r[3] > args.threshold]
+
+    if args.json:
+        print(json.dumps({'meta': machine_info(), 'baseline_meta': (baseline or {}).get('meta')
+                         ,'threshold': args.threshold
+                         ,'results': {n: {'ns': ns, 'baseline_ns': b, 'delta': d} for (n, ns, b, d) in rows}
+                         ,'regressions': [r[0] for r in regressions]}, indent=1))
+    else:
+        if baseline is None:
+            print(f"No baseline at {args.baseline}. Run with --save to record one")
+        elif baseline.get('meta', {}).get('python') != platform.python_version():
+            print(f"WARNING - Baseline is from python {baseline['meta'].get('python')}. Comparisons are approximate")
+        print(f"{'benchmark':<34}{'ns/call':>12}{'baseline':>12}{'change':>10}")
+        for (name, ns, b, d) in rows:
+            sB = f"{b:>12.1f}" if b else f"{'-':>12}"
+            sD = f"{d * 100:>+9.1f}%" if d is not None else f"{'new':>10}"
+            flag = '  REGRESSION' if d is not None and d > args.threshold else ''
+            print(f"{name:<34}{ns:>12.1f}{sB}{sD}{flag}")
+        if regressions:
+            print(f"FAIL - {len(regressions)} benchmark(s) slower than baseline by more than {args.threshold * 100:.0f}%")
+
+    sys.exit(1 if regressions else 0)
+
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
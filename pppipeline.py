@@ -0,0 +1,216 @@
+# pppipeline.py
+# Staged thread pipeline with bounded buffers between stages
+# - Each stage has its own worker count and input buffer. A full buffer blocks the stage
+#   before it, so a slow stage slows intake rather than growing memory
+# - Per stage throughput, busy time and queue depth in stats()
+# Author: https://github.com/JavaScriptDude
+# License: MIT
+
+# Usage:
+#   pipe = authorize_pipeline(pp_client, check_workers=4, authorize_workers=4)
+#   web_server.add_order_listener(accepted_order_listener(pipe))   # redirect events in
+#   pipe.put(ordid)                                                # or queue input
+#   for r in pipe.results(): ...                                   # BatchResult per order
+#
+#   - or over an iterable, results streamed as they finish:
+#   for r in authorize_pipeline(pp_client).run(ordids): ...
+
+import time
+import queue
+import threading
+from helpers import *
+from pptools import BatchResult
+
+
+_STOP = object()
+
+
+class Stage:
+    def __init__(self, name:str, fn, workers:int=1, buffer:int=64):
+        assert callable(fn), f"fn is not callable. Got {getClassName(fn)}"
+        assert isInt(workers) and workers > 0, f"workers must be a positive int. Got {workers}"
+        assert isInt(buffer) and buffer > 0, f"buffer must be a positive int. Got {buffer}"
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.buffer = buffer
+        self.q = queue.Queue(maxsize=buffer)
+        self._lock = threading.Lock()
+        self._running = 0
+        self._stats = {'in': 0, 'out': 0, 'errors': 0, 'busy_s': 0.0, 'max_depth': 0}
+
+
+    def stats(self, elapsed:float) -> dict:
+        with self._lock:
+            d = dict(self._stats)
+        d['workers'] = self.workers
+        d['buffer'] = self.buffer
+        d['depth'] = self.q.qsize()
+        d['per_sec'] = (d['out'] / elapsed) if elapsed > 0 else 0.0
+        d['utilization'] = (d['busy_s'] / (elapsed * self.workers)) if elapsed > 0 else 0.0
+        return d
+
+
+
+# Items move through the stages as BatchResult(index, item, result, error, elapsed)
+# - `result` is the output of the last stage that ran. Each stage is called with it
+# - An item whose stage raised skips the remaining stages and is delivered with `error` set
+# - Delivered to `sink(r)` if given, else to results(). The results buffer is bounded too
+class Pipeline:
+    def __init__(self, stages, sink=None, results_buffer:int=256):
+        assert stages, "At least one stage is required"
+        self.stages = list(stages)
+        self.sink = sink
+        self._out = queue.Queue(maxsize=results_buffer)
+        self._index = 0
+        self._index_lock = threading.Lock()
+        self._closed = False
+        self._started = time.perf_counter()
+        self._threads = []
+        for (i, stage) in enumerate(self.stages):
+            stage._running = stage.workers
+            for n in range(stage.workers):
+                t = threading.Thread(target=self._work, args=(i,), name=f"pp-pipe-{stage.name}-{n}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+
+    # Blocks while the first stage's buffer is full. Raises queue.Full after timeout
+    def put(self, item, timeout:float=None):
+        if self._closed: raise Exception("Pipeline is closed")
+        with self._index_lock:
+            index = self._index
+            self._index += 1
+        stage = self.stages[0]
+        stage.q.put(BatchResult(index, item, result=item), timeout=timeout)
+        self._note_depth(stage)
+
+
+    # No more input. Stages finish what is buffered then results() ends
+    def close(self):
+        if self._closed: return
+        self._closed = True
+        for _ in range(self.stages[0].workers):
+            self.stages[0].q.put(_STOP)
+
+
+    def join(self, timeout:float=None):
+        for t in self._threads:
+            t.join(timeout)
+
+
+    # Yields results as they finish until the pipeline is closed and drained
+    def results(self):
+        assert self.sink is None, "results() is not available when a sink is set"
+        while True:
+            r = self._out.get()
+            if r is _STOP: return
+            yield r
+
+
+    # Feeds `items` from a background thread and yields results. Closes the pipeline
+    def run(self, items):
+        def _feed():
+            try:
+                for item in items:
+                    self.put(item)
+            finally:
+                self.close()
+        threading.Thread(target=_feed, name='pp-pipe-feed', daemon=True).start()
+        return self.results()
+
+
+    def stats(self) -> dict:
+        elapsed = time.perf_counter() - self._started
+        return {'elapsed_s': elapsed, 'stages': {s.name: s.stats(elapsed) for s in self.stages}
+               ,'results_depth': self._out.qsize()}
+
+
+    def _work(self, i):
+        stage = self.stages[i]
+        nxt = self.stages[i + 1] if i + 1 < len(self.stages) else None
+        while True:
+            r = stage.q.get()
+            if r is _STOP: break
+
+            if r.error is None:
+                started = time.perf_counter()
+                try:
+                    r.result = stage.fn(r.result)
+                except Exception as ex:
+                    r.error = ex
+                busy = time.perf_counter() - started
+                r.elapsed += busy
+                with stage._lock:
+                    stage._stats['in'] += 1
+                    stage._stats['busy_s'] += busy
+                    if r.error is None: stage._stats['out'] += 1
+                    else: stage._stats['errors'] += 1
+
+            if nxt is not None:
+                nxt.q.put(r)
+                self._note_depth(nxt)
+            else:
+                self._deliver(r)
+
+        # Last worker out passes the stop on
+        with stage._lock:
+            stage._running -= 1
+            last = stage._running == 0
+        if last:
+            if nxt is not None:
+                for _ in range(nxt.workers): nxt.q.put(_STOP)
+            elif self.sink is None:
+                self._out.put(_STOP)
+
+
+    def _deliver(self, r):
+        if self.sink is None:
+            self._out.put(r)
+            return
+        try:
+            self.sink(r)
+        except Exception as ex:
+            pc(f"WARNING - Pipeline sink failed for item {r.item}: {ex}")
+
+
+    def _note_depth(self, stage):
+        depth = stage.q.qsize()
+        if depth > stage._stats['max_depth']:
+            with stage._lock:
+                if depth > stage._stats['max_depth']: stage._stats['max_depth'] = depth
+
+
+
+# status check -> authorize pipeline over order ids
+# - Orders that are not APPROVED fail at the check stage and are not authorized
+# - journal: optional ppjournal.OrderJournal to record APPROVED / COMPLETED
+def authorize_pipeline(client, check_workers:int=4, authorize_workers:int=4, buffer:int=64
+                      ,journal=None, sink=None) -> Pipeline:
+    def _check(ordid):
+        (ord_exists, ord_status, ord_info) = client.get_order_info(ordid, bypass_cache=True)
+        if not ord_exists: raise Exception(f"Order does not exist: {ordid}")
+        if not ord_status == 'APPROVED':
+            raise Exception(f"Unexpected order status: {ord_status}. Expecting APPROVED.")
+        if journal is not None: journal.record(ordid, 'APPROVED', ord_info)
+        return ordid
+
+    def _authorize(ordid):
+        resu = client.authorize_order(ordid)
+        ord_status = aget('resu', resu, 'status', True, True)
+        if not ord_status == 'COMPLETED':
+            raise Exception(f"Unexpected order status: {ord_status}. Expecting COMPLETED.")
+        if journal is not None: journal.record(ordid, 'COMPLETED', resu)
+        return resu
+
+    return Pipeline([Stage('check', _check, check_workers, buffer)
+                    ,Stage('authorize', _authorize, authorize_workers, buffer)], sink=sink)
+
+
+# QWebServer.add_order_listener() callback that feeds accepted orders into a pipeline
+# - Runs on the redirect request thread so a full pipeline holds the redirect response
+def accepted_order_listener(pipeline:Pipeline, timeout:float=None):
+    def _on_event(event):
+        if event.outcome == 'accepted':
+            pipeline.put(event.token, timeout=timeout)
+    return _on_event
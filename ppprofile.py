@@ -0,0 +1,226 @@
+# ppprofile.py
+# Opt-in CPU (cProfile) and allocation (tracemalloc) profiling of a run
+# - Turned on by `python3 main.py --profile [cpu,mem,methods]` or PP_PROFILE=cpu,mem,methods
+# - Threads started during the run (web server, browser watcher, batch workers) are profiled too
+#   Python < 3.12: each thread gets its own cProfile. 3.12+: cProfile is built on sys.monitoring, which
+#   allows one profiler per process, and the main profile sees every thread's calls. Thread counts in
+#   the report are then 1 and per thread call stacks are interleaved in the stats
+# - Writes <out_dir>/<name>-<time>.txt (report) and .prof (pstats, eg. for snakeviz)
+# - Nothing here is imported or wrapped when profiling is off
+# Author: https://github.com/JavaScriptDude
+# License: MIT
+
+# Report sections:
+#   CPU top functions by cumulative and own time, all threads combined
+#   Watched hot paths (aget, pc, get_order_result_dict, execute ...)
+#   Client methods: calls / total / max wall time per method (`methods`)
+#   Peak traced memory and top allocation sites (`mem`)
+
+import io
+import os
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from datetime import datetime
+from functools import wraps
+from helpers import *
+
+
+PROFILE_KINDS = ('cpu', 'mem', 'methods')
+
+CLIENT_METHODS = ('get_access_token', 'create_order', 'get_order_info', 'authorize_order', 'cancel_order', 'execute')
+
+# pstats restriction regex for the watched section
+# Python < 3.12 cProfile only sees the thread that enabled it
+PER_THREAD_PROFILES = sys.version_info < (3, 12)
+
+WATCH = r'\b(aget\w*|pc|_pf|isInst|get_order_result_dict|get_link_by_rel|execute|_send_request|_send|deepcopy|serialize_request|deserialize_response|construct_object)\b'
+
+
+# 'cpu,mem' -> {'cpu', 'mem'}. '1' / 'all' / 'on' -> all kinds
+def parse_profile_spec(spec:str) -> set:
+    if spec is None: return set()
+    spec = spec.strip().lower()
+    if spec in ('', '0', 'off', 'false', 'no'): return set()
+    if spec in ('1', 'all', 'on', 'true', 'yes'): return set(PROFILE_KINDS)
+    kinds = {k.strip() for k in spec.split(',') if k.strip()}
+    bad = kinds - set(PROFILE_KINDS)
+    assert not bad, f"Unknown profile kind(s): {', '.join(sorted(bad))}. Expecting {', '.join(PROFILE_KINDS)}"
+    return kinds
+
+
+
+# Usage:
+#   with RunProfiler('checkout', 'cpu,mem', client=pp_client) as prof:
+#       ...
+#   prof.report_path
+class RunProfiler:
+    def __init__(self, name:str, spec:str='cpu,mem', client=None, out_dir:str=None, top:int=25, mem_frames:int=1):
+        self.name = name
+        self.kinds = parse_profile_spec(spec)
+        self.client = client
+        self.out_dir = out_dir or os.environ.get('PP_PROFILE_DIR') or 'pp_profiles'
+        self.top = top
+        self.mem_frames = mem_frames
+        self.report_path = None
+        self._profiles = []
+        self._profiles_lock = threading.Lock()
+        self._methods = {}
+        self._methods_lock = threading.Lock()
+        self._wrapped = []
+        self._started = 0.0
+        self._mem_started = False
+
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        if 'mem' in self.kinds and not tracemalloc.is_tracing():
+            tracemalloc.start(self.mem_frames)
+            self._mem_started = True
+        if 'methods' in self.kinds and self.client is not None:
+            self._wrap_client(self.client)
+        if 'cpu' in self.kinds:
+            # New threads enable their own profiler on their first profile event
+            if PER_THREAD_PROFILES: threading.setprofile(self._thread_profile_hook)
+            self._main_profile = self._new_profile()
+            self._main_profile.enable()
+        return self
+
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self._started
+        if 'cpu' in self.kinds:
+            self._main_profile.disable()
+            if PER_THREAD_PROFILES: threading.setprofile(None)
+
+        # Snapshot before building the CPU stats so their allocations are not in it
+        mem = None
+        if 'mem' in self.kinds and tracemalloc.is_tracing():
+            (current, peak) = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot().filter_traces((
+                 tracemalloc.Filter(False, tracemalloc.__file__)
+                ,tracemalloc.Filter(False, __file__)
+                ,tracemalloc.Filter(False, cProfile.__file__)
+                ,tracemalloc.Filter(False, '<frozen importlib._bootstrap>')
+            ))
+            mem = (current, peak, snapshot.statistics('lineno')[:self.top])
+            if self._mem_started: tracemalloc.stop()
+
+        stats = self._combined_stats() if 'cpu' in self.kinds else None
+
+        self._unwrap_client()
+        try:
+            self._write(elapsed, stats, mem)
+        except Exception as ex:
+            pc(f"WARNING - Could not write profile report: {ex}")
+        return False
+
+
+    def _new_profile(self):
+        p = cProfile.Profile()
+        with self._profiles_lock:
+            self._profiles.append(p)
+        return p
+
+
+    def _thread_profile_hook(self, frame, event, arg):
+        # Replaces this hook with the thread's own cProfile
+        # - Must not raise or the thread dies before its target runs. If another profiler is
+        #   active the thread runs unprofiled
+        p = cProfile.Profile()
+        try:
+            p.enable()
+        except ValueError:
+            sys.setprofile(None)
+            return
+        with self._profiles_lock:
+            self._profiles.append(p)
+
+
+    # All thread profiles merged. Worker profiles are read after the main one is disabled
+    # as Profile.disable() acts on the calling thread
+    def _combined_stats(self):
+        stats = None
+        with self._profiles_lock:
+            profiles = list(self._profiles)
+        for p in profiles:
+            try:
+                if stats is None: stats = pstats.Stats(p, stream=io.StringIO())
+                else: stats.add(p)
+            except TypeError:
+                pass # Thread started but recorded nothing
+        return stats
+
+
+    def _wrap_client(self, client):
+        for name in CLIENT_METHODS:
+            fn = getattr(client, name, None)
+            if fn is None: continue
+            setattr(client, name, self._timed(name, fn))
+            self._wrapped.append((client, name))
+
+
+    def _unwrap_client(self):
+        for (client, name) in self._wrapped:
+            try:
+                delattr(client, name)
+            except AttributeError:
+                pass
+        self._wrapped = []
+
+
+    def _timed(self, name, fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                with self._methods_lock:
+                    d = self._methods.get(name)
+                    if d is None: d = self._methods[name] = [0, 0.0, 0.0]
+                    d[0] += 1
+                    d[1] += elapsed
+                    d[2] = max(d[2], elapsed)
+        return wrapper
+
+
+    def _write(self, elapsed, stats, mem):
+        os.makedirs(self.out_dir, exist_ok=True)
+        base = os.path.join(self.out_dir, f"{self.name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}")
+        out = io.StringIO()
+        out.write(f"Profile of '{self.name}' ({', '.join(sorted(self.kinds))})\n")
+        out.write(f"Wall time: {elapsed:.3f}s\n")
+
+        if stats is not None:
+            stats.dump_stats(f"{base}.prof")
+            threads = len(self._profiles) if PER_THREAD_PROFILES else 'all (one profile)'
+            out.write(f"Threads profiled: {threads}  pstats: {base}.prof\n")
+            for (title, key) in (('cumulative time', 'cumulative'), ('own time', 'tottime')):
+                out.write(f"\n==== CPU top {self.top} by {title} ====\n")
+                stats.stream = out
+                stats.sort_stats(key).print_stats(self.top)
+            out.write("\n==== Watched hot paths ====\n")
+            stats.sort_stats('tottime').print_stats(WATCH)
+
+        if self._methods:
+            out.write("\n==== Client methods (wall time) ====\n")
+            out.write(f"{'method':<20}{'calls':>8}{'total ms':>12}{'avg ms':>10}{'max ms':>10}\n")
+            for (name, (n, total, mx)) in sorted(self._methods.items(), key=lambda kv: -kv[1][1]):
+                out.write(f"{name:<20}{n:>8}{total * 1000:>12.1f}{total / n * 1000:>10.1f}{mx * 1000:>10.1f}\n")
+
+        if mem is not None:
+            (current, peak, top_stats) = mem
+            out.write(f"\n==== Memory ====\nPeak traced: {peak / 1024:.1f} KiB  at exit: {current / 1024:.1f} KiB\n")
+            out.write(f"Top {self.top} allocation sites still held at exit:\n")
+            for st in top_stats:
+                out.write(f"  {st}\n")
+
+        self.report_path = f"{base}.txt"
+        with open(self.report_path, 'w') as f:
+            f.write(out.getvalue())
+        pc(f"Profile report written to {self.report_path}")
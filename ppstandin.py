@@ -0,0 +1,272 @@
+# ppstandin.py
+# Local stand-in for the PayPal REST endpoints used by pptools.Client
+# - For load testing and benchmarks. Not a full emulation of PayPal
+# Author: https://github.com/JavaScriptDude
+# License: MIT
+
+# Usage:
+#   python3 ppstandin.py --port 9992 --latency 0.05 --error-rate 0.01 --rate-429 0.01
+#   PP_ENV=standin python3 main.py
+#   - or in code: Client(get_standin_env('http://127.0.0.1:9992'))
+#
+# Endpoints:
+#   POST   /v1/oauth2/token
+#   POST   /v2/checkout/orders
+#   GET    /v2/checkout/orders/<id>
+#   POST   /v2/checkout/orders/<id>/authorize
+#   DELETE /v1/checkout/orders/<id>
+#   GET    /checkoutnow?token=<id>&action=approve|cancel   (simulated buyer, redirects to return_url / cancel_url)
+#
+# POSTs to create / authorize with a PayPal-Request-Id seen before return the order again
+# instead of creating / authorizing a second time
+
+import sys
+import random
+import string
+import threading
+import time
+import uuid
+import argparse
+from datetime import datetime, timezone
+from flask import request, jsonify, redirect
+from qwebserver import *
+
+
+class StandInServer(QWebServer):
+    def __init__(self, host:str='127.0.0.1', port:int=9992
+                ,latency:float=0.0, latency_jitter:float=0.0
+                ,error_rate:float=0.0, rate_429:float=0.0, retry_after:int=1
+                ,token_expires_in:int=32400):
+        super().__init__(host, port, metrics=None)
+        for (alias, v) in (('error_rate', error_rate), ('rate_429', rate_429)):
+            assert isinstance(v, (int, float)) and 0.0 <= v <= 1.0, f"{alias} must be between 0 and 1. Got {v}"
+        self.url = f"http://{host}:{self.srv.server_port}"
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.token_expires_in = token_expires_in
+        self.orders = {}
+        self.tokens = set()
+        self.request_ids = {} # (op, PayPal-Request-Id) -> ordid
+        self.counts = {}
+        self._lock = threading.Lock()
+        self._add_routes()
+
+
+    def _add_routes(self):
+        app = self.app
+
+        @app.before_request
+        def _inject_faults():
+            if not request.path.startswith(('/v1/', '/v2/')): return None
+            self._count(f"{request.method} {request.url_rule.rule if request.url_rule else request.path}")
+            if self.latency > 0 or self.latency_jitter > 0:
+                time.sleep(self.latency + random.random() * self.latency_jitter)
+            r = random.random()
+            if r < self.rate_429:
+                resp = _error(429, 'RATE_LIMIT_REACHED', 'Too many requests. Blocked due to rate limiting.')
+                resp.headers['Retry-After'] = str(self.retry_after)
+                return resp
+            if r < self.rate_429 + self.error_rate:
+                return _error(500, 'INTERNAL_SERVER_ERROR', 'An internal server error occurred.')
+            if request.path != '/v1/oauth2/token' and not self._authorized():
+                return _error(401, 'AUTHENTICATION_FAILURE', 'Authentication failed due to invalid authentication credentials or a missing Authorization header.')
+            return None
+
+
+        @app.route('/v1/oauth2/token', methods=['POST'])
+        def _token():
+            if request.authorization is None:
+                return _error(401, 'invalid_client', 'Client Authentication failed')
+            token = f"A21AA{uuid.uuid4().hex}"
+            with self._lock:
+                self.tokens.add(token)
+            return jsonify({
+                 'scope': 'https://uri.paypal.com/services/payments/payment'
+                ,'access_token': token
+                ,'token_type': 'Bearer'
+                ,'app_id': 'APP-STANDIN'
+                ,'expires_in': self.token_expires_in
+                ,'nonce': f"{_now()}{uuid.uuid4().hex[:8]}"
+            })
+
+
+        @app.route('/v2/checkout/orders', methods=['POST'])
+        def _create_order():
+            replay = self._replay('create')
+            if replay is not None: return replay
+            body = request.get_json(silent=True) or {}
+            ordid = _new_id()
+            now = _now()
+            app_ctx = body.get('application_context', {})
+            order = {
+                 'id': ordid
+                ,'intent': body.get('intent', 'CAPTURE')
+                ,'status': 'CREATED'
+                ,'purchase_units': body.get('purchase_units', [])
+                ,'create_time': now
+                ,'links': [
+                     {'href': f"{self.url}/v2/checkout/orders/{ordid}", 'rel': 'self', 'method': 'GET'}
+                    ,{'href': f"{self.url}/checkoutnow?token={ordid}", 'rel': 'approve', 'method': 'GET'}
+                    ,{'href': f"{self.url}/v2/checkout/orders/{ordid}", 'rel': 'update', 'method': 'PATCH'}
+                    ,{'href': f"{self.url}/v2/checkout/orders/{ordid}/authorize", 'rel': 'authorize', 'method': 'POST'}
+                ]
+                ,'_return_url': app_ctx.get('return_url')
+                ,'_cancel_url': app_ctx.get('cancel_url')
+            }
+            with self._lock:
+                self.orders[ordid] = order
+                self._remember('create', ordid)
+            return _order_response(order, 201)
+
+
+        @app.route('/v2/checkout/orders/<ordid>', methods=['GET'])
+        def _get_order(ordid):
+            with self._lock:
+                order = self.orders.get(ordid)
+                if order is None: return _not_found(ordid)
+                return _order_response(order, 200)
+
+
+        @app.route('/v2/checkout/orders/<ordid>/authorize', methods=['POST'])
+        def _authorize_order(ordid):
+            replay = self._replay('authorize')
+            if replay is not None: return replay
+            with self._lock:
+                order = self.orders.get(ordid)
+                if order is None: return _not_found(ordid)
+                if not order['status'] == 'APPROVED':
+                    return _error(422, 'UNPROCESSABLE_ENTITY', 'The requested action could not be performed, semantically incorrect, or failed business validation.'
+                                 ,issue='ORDER_NOT_APPROVED')
+                now = _now()
+                for pu in order['purchase_units']:
+                    pu['payments'] = {'authorizations': [{
+                         'id': _new_id()
+                        ,'status': 'CREATED'
+                        ,'amount': pu.get('amount')
+                        ,'create_time': now
+                        ,'update_time': now
+                    }]}
+                order['status'] = 'COMPLETED'
+                order['update_time'] = now
+                order['links'] = [{'href': f"{self.url}/v2/checkout/orders/{ordid}", 'rel': 'self', 'method': 'GET'}]
+                self._remember('authorize', ordid)
+                return _order_response(order, 201)
+
+
+        @app.route('/v1/checkout/orders/<ordid>', methods=['DELETE'])
+        def _delete_order(ordid):
+            with self._lock:
+                if self.orders.pop(ordid, None) is None: return _not_found(ordid)
+            return ('', 204)
+
+
+        # Simulated buyer. Not subject to fault injection
+        @app.route('/checkoutnow', methods=['GET'])
+        def _checkoutnow():
+            ordid = request.args.get('token', '')
+            action = request.args.get('action', 'approve')
+            with self._lock:
+                order = self.orders.get(ordid)
+                if order is None: return _not_found(ordid)
+                if action == 'approve':
+                    if order['status'] == 'CREATED':
+                        order['status'] = 'APPROVED'
+                        order['payer'] = {'payer_id': _new_id(13), 'email_address': 'buyer@example.com'}
+                    target = order['_return_url']
+                    qs = f"token={ordid}&PayerID={order['payer']['payer_id']}"
+                else:
+                    target = order['_cancel_url']
+                    qs = f"token={ordid}"
+            if not target: return ('', 204)
+            return redirect(f"{target}{'&' if '?' in target else '?'}{qs}", code=302)
+
+
+    def _authorized(self) -> bool:
+        auth = request.headers.get('Authorization', '')
+        if not auth.startswith('Bearer '): return False
+        with self._lock:
+            return auth[7:] in self.tokens
+
+
+    # Response for a repeated PayPal-Request-Id or None
+    def _replay(self, op):
+        rid = request.headers.get('PayPal-Request-Id')
+        if not rid: return None
+        with self._lock:
+            ordid = self.request_ids.get((op, rid))
+            if ordid is None: return None
+            self.counts[f"replay {op}"] = self.counts.get(f"replay {op}", 0) + 1
+            order = self.orders.get(ordid)
+            if order is None: return _not_found(ordid)
+            return _order_response(order, 201)
+
+
+    # Call with self._lock held
+    def _remember(self, op, ordid):
+        rid = request.headers.get('PayPal-Request-Id')
+        if rid: self.request_ids[(op, rid)] = ordid
+
+
+    def _count(self, key):
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+
+
+def _new_id(n:int=17) -> str:
+    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=n))
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _order_response(order, status_code):
+    resp = jsonify({k: v for (k, v) in order.items() if not k.startswith('_')})
+    resp.status_code = status_code
+    return resp
+
+
+def _error(status_code, name, message, issue=None):
+    d = {'name': name, 'message': message, 'debug_id': uuid.uuid4().hex[:13]}
+    if issue is not None:
+        d['details'] = [{'issue': issue, 'description': message}]
+    resp = jsonify(d)
+    resp.status_code = status_code
+    return resp
+
+
+def _not_found(ordid):
+    return _error(404, 'RESOURCE_NOT_FOUND', 'The specified resource does not exist.'
+                 ,issue='INVALID_RESOURCE_ID')
+
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='ppstandin.py', description='Local PayPal stand-in server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9992)
+    parser.add_argument('--latency', type=float, default=0.0, help='Added latency per API call (secs)')
+    parser.add_argument('--latency-jitter', type=float, default=0.0, help='Random extra latency up to this (secs)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of API calls answered with 500')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='Fraction of API calls answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After secs sent with 429')
+    args = parser.parse_args(argv)
+
+    server = StandInServer(args.host, args.port
+                ,latency=args.latency, latency_jitter=args.latency_jitter
+                ,error_rate=args.error_rate, rate_429=args.rate_429, retry_after=args.retry_after)
+    server.start()
+    pc(f"PayPal stand-in listening on {server.url}")
+    try:
+        server.join()
+    except KeyboardInterrupt:
+        server.begin_shutdown(drain_timeout=0)
+
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
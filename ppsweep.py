@@ -0,0 +1,221 @@
+# ppsweep.py
+# Parallel reconciliation of stale CREATED / APPROVED orders
+# - Order ids come from a file (one per line) or the order journal
+# - Status is read with Client.get_order_info then the order is cancelled / authorized per SweepPolicy
+# - Finished ids are appended to a checkpoint file so an interrupted sweep continues where it stopped
+# Author: https://github.com/JavaScriptDude
+# License: MIT
+
+# Usage:
+#   python3 main.py sweep --file stale_orders.txt --workers 16
+#   python3 main.py sweep --approved cancel --min-age 86400   (journal orders, cancel everything a day old)
+#   - or in code:
+#   report = Sweeper(pp_client, SweepPolicy(approved='cancel'), checkpoint='sweep.done').run(read_order_ids('stale_orders.txt'))
+
+import os
+import time
+import threading
+from datetime import datetime, timezone
+from helpers import *
+from pptools import run_batch
+
+
+# Outcome per order
+#   cancelled / authorized  action taken
+#   skipped                 policy says keep, order is younger than min_age or its age is unknown
+#   settled                 order is already past CREATED / APPROVED (eg. COMPLETED)
+#   not_found               deleted or expired at PayPal
+#   failed                  exception
+OUTCOMES = ('cancelled', 'authorized', 'skipped', 'settled', 'not_found', 'failed')
+
+# Outcomes written to the checkpoint. skipped / failed orders are looked at again next run
+FINAL_OUTCOMES = ('cancelled', 'authorized', 'settled', 'not_found')
+
+
+class SweepPolicy:
+    def __init__(self, created:str='cancel', approved:str='authorize', min_age:float=3600):
+        assert created in ('cancel', 'keep'), f"created must be cancel or keep. Got {created}"
+        assert approved in ('authorize', 'cancel', 'keep'), f"approved must be authorize, cancel or keep. Got {approved}"
+        assert min_age >= 0, f"min_age must be >= 0. Got {min_age}"
+        self.created = created
+        self.approved = approved
+        self.min_age = min_age
+
+
+    # Returns 'cancel', 'authorize' or 'keep'. age is seconds since create_time (None if unknown)
+    # - With min_age set, an order whose age can not be verified is kept
+    def action(self, ord_status:str, age:float) -> str:
+        if self.min_age > 0 and (age is None or age < self.min_age): return 'keep'
+        if ord_status == 'CREATED': return self.created
+        if ord_status == 'APPROVED': return self.approved
+        return 'keep'
+
+
+
+# Append only file of `<ordid>\t<outcome>` lines for orders already swept
+class SweepCheckpoint:
+    def __init__(self, path:str):
+        self.path = path
+        self.done = set()
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    ordid = line.split('\t', 1)[0].strip()
+                    if ordid: self.done.add(ordid)
+        self._f = open(path, 'a')
+        self._lock = threading.Lock()
+
+
+    def add(self, ordid:str, outcome:str):
+        with self._lock:
+            self._f.write(f"{ordid}\t{outcome}\n")
+            self._f.flush()
+            self.done.add(ordid)
+
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+
+
+class SweepReport:
+    def __init__(self):
+        self.totals = {k: 0 for k in OUTCOMES}
+        self.resumed = 0 # Skipped because already in checkpoint
+        self.errors = {}
+        self.elapsed = 0.0
+
+    @property
+    def swept(self) -> int:
+        return sum(self.totals.values())
+
+    def summary(self) -> dict:
+        return {
+             'swept': self.swept
+            ,'resumed': self.resumed
+            ,'elapsed_s': self.elapsed
+            ,'orders_per_sec': (self.swept / self.elapsed) if self.elapsed > 0 else 0.0
+            ,'totals': dict(self.totals)
+            ,'errors': dict(self.errors)
+        }
+
+    def report(self) -> str:
+        d = self.summary()
+        sb = StringBuffer()
+        sb.al(f"swept: {d['swept']}  resumed: {d['resumed']}  elapsed: {d['elapsed_s']:.2f}s  orders/sec: {d['orders_per_sec']:.1f}")
+        sb.al('  '.join(f"{k}: {n}" for (k, n) in d['totals'].items()))
+        for (k, n) in d['errors'].items():
+            sb.al(f"error {k}: {n}")
+        return sb.ts()
+
+
+
+# Usage: see top of file
+# - journal: optional ppjournal.OrderJournal. Transitions made by the sweep are recorded in it
+class Sweeper:
+    def __init__(self, client, policy:SweepPolicy=None, max_workers:int=8
+                ,checkpoint:str=None, journal=None, progress_every:float=5.0):
+        self.client = client
+        self.policy = policy or SweepPolicy()
+        self.max_workers = max_workers
+        self.checkpoint_path = checkpoint
+        self.journal = journal
+        self.progress_every = progress_every
+
+
+    def run(self, ordids) -> SweepReport:
+        res = SweepReport()
+        checkpoint = SweepCheckpoint(self.checkpoint_path) if self.checkpoint_path else None
+
+        def _todo():
+            for ordid in ordids:
+                if checkpoint is not None and ordid in checkpoint.done:
+                    res.resumed += 1
+                    continue
+                yield ordid
+
+        started = time.perf_counter()
+        last_progress = started
+        try:
+            for r in run_batch(self.sweep_order, _todo(), max_workers=self.max_workers, stream=True):
+                if r.ok:
+                    res.totals[r.result] += 1
+                    if checkpoint is not None and r.result in FINAL_OUTCOMES: checkpoint.add(r.item, r.result)
+                else:
+                    res.totals['failed'] += 1
+                    key = getClassName(r.error)
+                    res.errors[key] = res.errors.get(key, 0) + 1
+                    pc(f"WARNING - Sweep of order {r.item} failed: {r.error}")
+
+                now = time.perf_counter()
+                if self.progress_every and now - last_progress >= self.progress_every:
+                    last_progress = now
+                    pc(f"Sweep progress: {res.swept} swept ({res.swept / (now - started):.1f}/s) {res.totals}")
+        finally:
+            res.elapsed = time.perf_counter() - started
+            if checkpoint is not None: checkpoint.close()
+
+        return res
+
+
+    # Returns the outcome for one order. Raises on error
+    def sweep_order(self, ordid:str) -> str:
+        (ord_exists, ord_status, ord_info) = self.client.get_order_info(ordid, bypass_cache=True)
+        if not ord_exists:
+            self._journal(ordid, 'CANCELLED', note='Order not found at PayPal by sweep')
+            return 'not_found'
+
+        # Journal PayPal's status (eg. COMPLETED, VOIDED) so journal driven sweeps stop picking it up
+        if not ord_status in ('CREATED', 'APPROVED'):
+            self._journal(ordid, ord_status, ord_info)
+            return 'settled'
+
+        action = self.policy.action(ord_status, order_age(ord_info))
+        if action == 'keep':
+            return 'skipped'
+
+        if action == 'cancel':
+            self.client.cancel_order(ordid)
+            self._journal(ordid, 'CANCELLED', note=f"Cancelled by sweep. Was {ord_status}")
+            return 'cancelled'
+
+        resu = self.client.authorize_order(ordid)
+        ord_status = aget('resu', resu, 'status', True, True)
+        if not ord_status == 'COMPLETED':
+            raise Exception(f"Unexpected order status after authorize: {ord_status}. Expecting COMPLETED.")
+        self._journal(ordid, 'COMPLETED', resu)
+        return 'authorized'
+
+
+    def _journal(self, ordid, state, result=None, note=None):
+        if self.journal is not None:
+            self.journal.record(ordid, state, result, note=note)
+
+
+
+# Seconds since the order's create_time or None if missing / unparsable
+def order_age(ord_info, now:float=None) -> float:
+    try:
+        s = ord_info['create_time']
+    except (KeyError, TypeError):
+        return None
+    if not s: return None
+    try:
+        dt = datetime.fromisoformat(s.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if dt.tzinfo is None: dt = dt.replace(tzinfo=timezone.utc)
+    return (now if now is not None else time.time()) - dt.timestamp()
+
+
+# Yields order ids from a file. First field of each line (comma or whitespace separated)
+# - Blank lines and lines starting with # are ignored
+def read_order_ids(path:str):
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'): continue
+            ordid = line.replace(',', ' ').split()[0]
+            if ordid.lower() in ('id', 'ordid', 'order_id'): continue # Header
+            yield ordid
@@ -3,142 +3,1375 @@
 # Author: https://github.com/JavaScriptDude
 # License: MIT
 
+import os
+import copy
 import requests
 import logging
+import threading
+import time
+import random
+import re
+import json
+import uuid
+import hashlib
+from collections import OrderedDict, deque
+from collections.abc import Mapping, Sequence
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
 from paypalhttp import HttpError
-from paypalcheckoutsdk.core import PayPalHttpClient, SandboxEnvironment
+from paypalcheckoutsdk.core import PayPalHttpClient, PayPalEnvironment, SandboxEnvironment, LiveEnvironment, AccessTokenRequest, RefreshTokenRequest
 from paypalhttp.http_response import Result, HttpResponse
 from paypalcheckoutsdk.orders import OrdersCreateRequest, OrdersAuthorizeRequest, OrdersGetRequest
 from helpers import *
+from ppmetrics import METRICS, timed_method
 
 log = logging.getLogger('pptools')
 
-def get_sandbox_env():
-    return SandboxEnvironment(client_id=agetEnvVar('PP_CLIENT_ID'), client_secret=agetEnvVar('PP_CLIENT_SECRET'))
+# Credentials default to PP_CLIENT_ID / PP_CLIENT_SECRET
+def get_sandbox_env(client_id:str=None, client_secret:str=None):
+    return SandboxEnvironment(client_id=client_id or agetEnvVar('PP_CLIENT_ID'), client_secret=client_secret or agetEnvVar('PP_CLIENT_SECRET'))
+
+
+def get_live_env(client_id:str=None, client_secret:str=None):
+    return LiveEnvironment(client_id=client_id or agetEnvVar('PP_CLIENT_ID'), client_secret=client_secret or agetEnvVar('PP_CLIENT_SECRET'))
+
+
+# Environment for the local PayPal stand-in server (see ppstandin.py)
+def get_standin_env(url:str='http://127.0.0.1:9992', client_id:str='standin', client_secret:str='standin'):
+    assertValidUrl('url', url)
+    return PayPalEnvironment(client_id, client_secret, url.rstrip('/'), url.rstrip('/'))
+
+
+# Simulated buyer for the stand-in: approve (or cancel) an order without a browser
+# - Redirect to return_url / cancel_url is not followed
+def standin_buyer_action(client, start_link:str, action:str='approve'):
+    assert action in ('approve', 'cancel'), f"action must be approve or cancel. Got {action}"
+    r = client.session.get(f"{start_link}&action={action}", allow_redirects=False, timeout=client.timeout)
+    if r.status_code >= 400: raise Exception(f"Stand-in {action} failed: {r.status_code} {r.text}")
+
+
+ENV_NAMES = ('sandbox', 'live', 'standin')
+
+
+# Environment by name: 'sandbox', 'live' or 'standin'
+# - For standin `url` defaults to PP_STANDIN_URL then http://127.0.0.1:9992
+def get_named_env(name:str, client_id:str=None, client_secret:str=None, url:str=None):
+    name = (name or '').strip().lower()
+    if name == 'sandbox':
+        return get_sandbox_env(client_id, client_secret)
+    elif name == 'live':
+        return get_live_env(client_id, client_secret)
+    elif name == 'standin':
+        url = url or os.environ.get('PP_STANDIN_URL', 'http://127.0.0.1:9992')
+        return get_standin_env(url, client_id or 'standin', client_secret or 'standin')
+    raise AssertionError(f"Environment must be one of {', '.join(ENV_NAMES)}. Got '{name}'")
+
+
+# Environment picked by PP_ENV: 'sandbox' (default), 'live' or 'standin'
+# - For standin the server url is taken from PP_STANDIN_URL if set
+def get_env():
+    return get_named_env(os.environ.get('PP_ENV', 'sandbox'))
 
 class Client(PayPalHttpClient):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    def __init__(self, environment, refresh_token=None
+                ,token_expiry_margin:int=60, token_refresh_ahead:int=300
+                ,pool_size:int=10, pool_hosts:int=4, pool_block:bool=False, keep_alive:bool=True
+                ,connect_timeout:float=5.0, read_timeout:float=30.0
+                ,scheduler=None
+                ,order_cache_size:int=0, order_cache_ttl:float=30.0
+                ,result_views:bool=False
+                ,idempotency_cache_size:int=1024, idempotency_ttl:float=300.0
+                ,breakers=None
+                ,metrics=METRICS):
+        super().__init__(environment, refresh_token=refresh_token)
+        self._token_cache = AccessTokenCache(self._fetch_access_token
+                                    ,expiry_margin=token_expiry_margin
+                                    ,refresh_ahead=token_refresh_ahead)
 
+        # One keep-alive connection pool for every call (v1 via requests and v2 via execute())
+        assert isInt(pool_size) and pool_size > 0, f"pool_size must be a positive int. Got {pool_size}"
+        self.keep_alive = keep_alive
+        self.timeout = (connect_timeout, read_timeout)
+        self._adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size, pool_block=pool_block, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount('https://', self._adapter)
+        self.session.mount('http://', self._adapter)
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
 
-    def get_access_token(self):
-        res = requests.post(
-            'https://api-m.sandbox.paypal.com/v1/oauth2/token',
-            headers={
-                'Accept': 'application/json',
-                'Accept-Language': 'en_US',
-            },
-            auth=HTTPBasicAuth(self.environment.client_id, self.environment.client_secret),
-            data={'grant_type': 'client_credentials'},
-        ).json()
-        return res['access_token']
+        # Throttling and retries for every call. Pass one RequestScheduler to several Clients to share its rate limit
+        self.scheduler = RequestScheduler() if scheduler is None else scheduler
 
+        # Circuit breaker per endpoint family. Fails fast with CircuitOpenError while PayPal is failing
+        # - Pass a CircuitBreakers to tune or share them. breakers=False turns them off
+        self.breakers = CircuitBreakers() if breakers is None else (breakers or None)
 
-    def create_order(self, purchase_units, application_context):
-        
-        # OPTIONAL - Validations (Fail Fast)
-        assert isinstance(purchase_units, dict)\
-            ,f"purchase_units is not a dict. Got {getClassName(purchase_units)}"
+        # Optional order info cache. Off when order_cache_size is 0
+        # - create_order, authorize_order and cancel_order write through to it
+        self.order_cache = OrderCache(order_cache_size, order_cache_ttl) if order_cache_size > 0 else None
 
-        assert isinstance(application_context, dict)\
-            ,f"application_context is not a dict. Got {getClassName(application_context)}"        
+        # When True, order methods return read only OrderView objects instead of dicts
+        # - Skips building the paypalhttp Result tree and the dict conversion
+        self.result_views = result_views
 
-        amount = aget_dict('purchase_units', purchase_units, 'amount', True)
-        currency_code = aget('amount', amount, 'currency_code', True, True)
-        value = aget('amount', amount, 'value', True, True)
+        # create_order / authorize_order calls with the same PayPal-Request-Id share one request
+        # while in flight and return the cached result for `idempotency_ttl` secs after
+        # - idempotency_cache_size 0 keeps the in-flight merging only
+        self.idempotency = RequestDeduper(idempotency_cache_size, idempotency_ttl)
 
-        # . payee
-        payee = aget_dict('purchase_units', purchase_units, 'payee', False)
+        # Per operation / per HTTP status latency histograms (ppmetrics). None disables
+        self.metrics = metrics
 
-        # . brand_name
-        brand_name = aget('application_context', application_context, 'brand_name', False, True)
-        if payee is None:
-            if brand_name == '':
-                pc("WARNING - Merchant block at top of UI will show Test Store because payee and brand_name are not specified")
-        else:
-            payee_email = aget('payee', payee, 'email_address', True, True)
-            assert valid_email(payee_email), f"Email address for payee is invalid. Got '{payee_email}'"
 
-        # . application_context - other
-        aget('application_context', application_context, 'shipping_preference', True, True)
-        aget('application_context', application_context, 'user_action', True, True)
-        return_url = aget('application_context', application_context, 'return_url', True, True)
-        cancel_url = aget('application_context', application_context, 'cancel_url', True, True)
+    def get_timeout(self):
+        return self.timeout
 
-        assertValidUrl('return_url', return_url)
-        assertValidUrl('cancel_url', cancel_url)
 
-        # End Validations
-        
-        
-    
-        request = OrdersCreateRequest()
-        request.prefer('return=representation')
-
-        request.request_body (
-            {
-                 "intent": "AUTHORIZE"
-                ,"purchase_units": [purchase_units]
-                ,'application_context': application_context
+    def close(self):
+        self.session.close()
+
+
+    # Same as paypalhttp.HttpClient.execute but sent through the Client's pooled session
+    # - `op` names the operation for the scheduler's retry budget and stats
+    def execute(self, request, op:str=None):
+        return self.parse_response(self._send_request(request, op))
+
+
+    # (status_code, ord_info) = _execute_order(request, op)
+    # - ord_info is an OrderView when result_views is on, otherwise a dict
+    def _execute_order(self, request, op:str):
+        if not self.result_views:
+            resp = self.execute(request, op=op)
+            return (resp.status_code, get_order_result_dict(resp))
+
+        resp = self._send_request(request, op)
+        if not 200 <= resp.status_code <= 299:
+            raise HttpError(resp.text, resp.status_code, resp.headers)
+        return (resp.status_code, OrderView(resp.json()))
+
+
+    def _send_request(self, request, op:str):
+        reqCpy = copy.deepcopy(request)
+
+        try:
+            getattr(reqCpy, 'headers')
+        except AttributeError:
+            reqCpy.headers = {}
+
+        for injector in self._injectors:
+            injector(reqCpy)
+
+        data = None
+
+        formatted_headers = self.format_headers(reqCpy.headers)
+
+        if "user-agent" not in formatted_headers:
+            reqCpy.headers["user-agent"] = self.get_user_agent()
+
+        if hasattr(reqCpy, 'body') and reqCpy.body is not None:
+            raw_headers = reqCpy.headers
+            reqCpy.headers = formatted_headers
+            data = self.encoder.serialize_request(reqCpy)
+            reqCpy.headers = self.map_headers(raw_headers, formatted_headers)
+
+        return self._send(reqCpy.verb, self.environment.base_url + reqCpy.path, op=op, headers=reqCpy.headers, data=data)
+
+
+    def _send(self, method, url, op:str=None, idempotent:bool=None, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        if idempotent is None:
+            headers = kwargs.get('headers') or {}
+            idempotent = method in ('GET', 'HEAD', 'PUT', 'DELETE') or 'PayPal-Request-Id' in headers
+        op = op or method
+        breaker = self.breakers.for_url(url) if self.breakers is not None else None
+
+        def _attempt():
+            probe = breaker.before_call() if breaker is not None else False
+            started = time.perf_counter()
+            try:
+                resp = self.session.request(method, url, **kwargs)
+            except Exception:
+                elapsed = time.perf_counter() - started
+                if breaker is not None: breaker.after_call(probe, True, elapsed)
+                if self.metrics is not None: self.metrics.observe_http('client', op, 'error', elapsed)
+                raise
+            elapsed = time.perf_counter() - started
+            if breaker is not None: breaker.after_call(probe, resp.status_code >= 500, elapsed)
+            if self.metrics is not None: self.metrics.observe_http('client', op, resp.status_code, elapsed)
+            return resp
+
+        resp = self.scheduler.call(op, _attempt, idempotent=idempotent)
+
+        # Token revoked or expired at PayPal before it expired here. Drop it and retry once with a new one
+        # - A 401 is rejected before any processing so the retry can not duplicate the call
+        headers = kwargs.get('headers')
+        if resp.status_code == 401 and headers:
+            key = next((k for k in headers if k.lower() == 'authorization'), None)
+            if key is not None:
+                self._token_cache.invalidate(headers[key])
+                kwargs['headers'] = dict(headers)
+                kwargs['headers'][key] = self._token_cache.authorization_string()
+                resp = self.scheduler.call(op, _attempt, idempotent=idempotent)
+        return resp
+
+
+    # {family: 'closed' | 'open' | 'half_open'}. Callers can shed load while a family is not closed
+    def breaker_states(self) -> dict:
+        return {} if self.breakers is None else self.breakers.states()
+
+
+    # Connection reuse per host. hits = requests sent on an already open connection
+    def pool_stats(self) -> dict:
+        pools = self._adapter.poolmanager.pools
+        hosts = {}
+        for key in list(pools.keys()):
+            try:
+                pool = pools[key]
+            except KeyError:
+                continue # Evicted while iterating
+            hosts[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                 'requests': pool.num_requests
+                ,'hits': pool.num_requests - pool.num_connections
+                ,'misses': pool.num_connections
+                ,'idle': 0 if pool.pool is None else sum(1 for c in list(pool.pool.queue) if c is not None)
             }
+        return {
+             'requests': sum(h['requests'] for h in hosts.values())
+            ,'hits': sum(h['hits'] for h in hosts.values())
+            ,'misses': sum(h['misses'] for h in hosts.values())
+            ,'hosts': hosts
+        }
+
+
+    # SDK injector - Use the shared token cache for execute() instead of the SDK's own AccessToken
+    def __call__(self, request):
+        if "Authorization" not in request.headers\
+            and not isinstance(request, (AccessTokenRequest, RefreshTokenRequest)):
+            request.headers["Authorization"] = self._token_cache.authorization_string()
+        super().__call__(request)
+
+
+    @timed_method('client', 'get_access_token')
+    def get_access_token(self):
+        return self._token_cache.get()
+
+
+    # (access_token, token_type, expires_in) = _fetch_access_token()
+    def _fetch_access_token(self):
+        resp = self._send(
+            'POST',
+            f'{self.environment.base_url}/v1/oauth2/token',
+            op='get_access_token',
+            idempotent=True, # A new token per call, nothing to duplicate
+            headers={
+                'Accept': 'application/json',
+                'Accept-Language': 'en_US',
+            },
+            auth=HTTPBasicAuth(self.environment.client_id, self.environment.client_secret),
+            data={'grant_type': 'client_credentials'},
         )
+        if not resp.ok:
+            raise HttpError(resp.text, resp.status_code, resp.headers)
+        res = resp.json()
+        access_token = aget('res', res, 'access_token', True, True)
+        token_type = aget('res', res, 'token_type', False, True)
+        expires_in = aget_int('res', res, 'expires_in', False)
+        return (access_token, token_type or 'Bearer', expires_in)
 
-        ord_resp = self.execute(request)
 
-        return get_order_result_dict(ord_resp)
+    # Sent with a PayPal-Request-Id so retries can not create a second order
+    # - request_id: caller's stable id for this order. If not given, one is derived from the
+    #   request when purchase_units has an invoice_id or custom_id, else a random id is used
+    #   (safe retries within this call only)
+    # - Calls with the same stable id share one result (see RequestDeduper). Treat it as read only
+    @timed_method('client', 'create_order')
+    def create_order(self, purchase_units, application_context, request_id:str=None):
+        key = request_id or derive_create_request_id(purchase_units, application_context)
+        if key is None:
+            return self._create_order(purchase_units, application_context, f"create-{uuid.uuid4().hex}")
+        return self.idempotency.call(('create', key), lambda: self._create_order(purchase_units, application_context, key))
+
+
+    def _create_order(self, purchase_units, application_context, request_id):
+        request = new_create_order_request(purchase_units, application_context, request_id=request_id)
+
+        (_, ord_info) = self._execute_order(request, 'create_order')
+
+        if self.order_cache is not None:
+            self.order_cache.put(aget('ord_info', ord_info, 'id', True, True), ord_info)
+        return ord_info
 
 
 
     # (ord_exists, ord_status, ord_info) = get_order_info(<ordid>)
-    def get_order_info(self, ordid) -> Result:
-        global pp_client
+    # - Answered from order_cache when enabled. Pass bypass_cache=True for an authoritative read
+    # - ord_info may be shared with the cache. Treat it as read only
+    @timed_method('client', 'get_order_info')
+    def get_order_info(self, ordid, bypass_cache:bool=False) -> Result:
+        if self.order_cache is not None and not bypass_cache:
+            cached = self.order_cache.get(ordid)
+            if cached is not None: return cached
 
         req = OrdersGetRequest(ordid)
         try:
-            resp = self.execute(req)
+            (_, ord_info) = self._execute_order(req, 'get_order_info')
 
         except HttpError as he:
             msg = he.message
             if msg.find('RESOURCE_NOT_FOUND') > -1:
+                if self.order_cache is not None: self.order_cache.put_missing(ordid)
                 return (False, None, None)
 
-            raise Exception(f"HTTP Error occured. Message: '{msg}', error: {he}")
+            raise Exception(f"HTTP Error occured. Message: '{msg}', error: {he}") from he
     
-        ord_info = get_order_result_dict(resp)
         ord_status = aget('ord_info', ord_info, 'status', True, True)
+        if self.order_cache is not None: self.order_cache.put(ordid, ord_info)
         return (True, ord_status, ord_info)
 
 
-    def authorize_order(self, pp_ordid) -> dict:
-        req = OrdersAuthorizeRequest(pp_ordid)
-        req.prefer("return=representation")
-        req.request_body({})
+    # PayPal-Request-Id defaults to one derived from the order id as an order is only authorized once
+    # - Concurrent / repeated calls for the same order share one result (see RequestDeduper)
+    @timed_method('client', 'authorize_order')
+    def authorize_order(self, pp_ordid, request_id:str=None) -> dict:
+        key = request_id or f"authorize-{pp_ordid}"
+        return self.idempotency.call(('authorize', key), lambda: self._authorize_order(pp_ordid, key))
+
+
+    def _authorize_order(self, pp_ordid, request_id):
+        req = new_authorize_order_request(pp_ordid, request_id=request_id)
         
-        resp = self.execute(req)
+        (status_code, ord_info) = self._execute_order(req, 'authorize_order')
 
-        if not resp.status_code == 201:
-            raise Exception(f"Unexpected response from OrdersAuthorizeRequest: {resp.status_code}. Full response: {resp}")
+        if not status_code == 201:
+            raise Exception(f"Unexpected response from OrdersAuthorizeRequest: {status_code}. Full response: {ord_info}")
 
-        return get_order_result_dict(resp)
+        if self.order_cache is not None: self.order_cache.put(pp_ordid, ord_info)
+        return ord_info
 
     # Have to use v1 API as order deletion is not available in v2 API
+    @timed_method('client', 'cancel_order')
     def cancel_order(self, order_id) -> bool:
-        uri = f'https://api-m.sandbox.paypal.com/v1/checkout/orders/{order_id}'
-        res = requests.delete(
+        uri = f'{self.environment.base_url}/v1/checkout/orders/{order_id}'
+        res = self._send(
+            'DELETE',
             uri,
+            op='cancel_order',
             headers={
                 'Content-Type': 'application/json',
-                'Authorization': f'Bearer {self.get_access_token()}'
+                'Authorization': self._token_cache.authorization_string()
             }
         )
 
         if not res.ok:
+            if self.order_cache is not None: self.order_cache.invalidate(order_id)
             raise Exception(f"\n\nPayPal API Call failed for url {uri}: {res.reason} ({res.text}).\nFull Response:\n{res}\n\n")
 
+        if self.order_cache is not None: self.order_cache.put_missing(order_id)
         return
 
 
+    # Batch versions of create_order / authorize_order / cancel_order
+    # - Calls run on at most `max_workers` threads (keep <= pool_size to reuse connections)
+    # - Returns a list of BatchResult in input order, or with stream=True a generator
+    #   yielding each BatchResult as soon as it finishes
+    # - A failure is attached to its BatchResult.error and does not stop the batch
+    def create_orders(self, purchase_units_list, application_context, max_workers:int=8, stream:bool=False):
+        return run_batch(lambda pu: self.create_order(pu, application_context), purchase_units_list, max_workers, stream)
+
+    def authorize_orders(self, ordids, max_workers:int=8, stream:bool=False):
+        return run_batch(self.authorize_order, ordids, max_workers, stream)
+
+    def cancel_orders(self, ordids, max_workers:int=8, stream:bool=False):
+        return run_batch(self.cancel_order, ordids, max_workers, stream)
+
+
+# Warm Clients per merchant credentials and environment for multi-tenant use
+# - Each Client keeps its access token and connection pool between calls
+# - At most `max_clients` are kept. The least recently used is closed to make room and
+#   clients unused for `idle_ttl` secs are closed on the next get()
+# - A new secret for a known client_id replaces its Client (credential rotation)
+# - client_kwargs are passed to every Client (eg. pool_size, scheduler, breakers)
+#
+# Usage:
+#   registry = ClientRegistry(max_clients=64)
+#   pp_client = registry.get(merchant.client_id, merchant.client_secret, env='live')
+class ClientRegistry:
+    def __init__(self, max_clients:int=32, idle_ttl:float=900.0, client_kwargs:dict=None, client_class=None):
+        assert isInt(max_clients) and max_clients > 0, f"max_clients must be a positive int. Got {max_clients}"
+        assert idle_ttl > 0, f"idle_ttl must be > 0. Got {idle_ttl}"
+        self.max_clients = max_clients
+        self.idle_ttl = idle_ttl
+        self.client_kwargs = dict(client_kwargs or {})
+        self.client_class = client_class or Client
+        self._d = OrderedDict() # (env, base_url, client_id) -> [client, secret_hash, last_used]
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0, 'replaced': 0}
+
+
+    def get(self, client_id:str, client_secret:str, env:str='sandbox', url:str=None):
+        assert isStr(client_id) and client_id, "client_id must be a non blank str"
+        assert isStr(client_secret) and client_secret, "client_secret must be a non blank str"
+        environment = get_named_env(env, client_id, client_secret, url)
+        key = (env.strip().lower(), environment.base_url, client_id)
+        secret_hash = hashlib.sha256(client_secret.encode('utf-8')).hexdigest()
+        now = time.monotonic()
+        to_close = []
+        with self._lock:
+            self._expire(now, to_close)
+            e = self._d.get(key)
+            if e is not None and e[1] != secret_hash:
+                self._stats['replaced'] += 1
+                to_close.append(self._d.pop(key)[0])
+                e = None
+            if e is not None:
+                self._stats['hits'] += 1
+                e[2] = now
+                self._d.move_to_end(key)
+                client = e[0]
+            else:
+                self._stats['misses'] += 1
+                client = self.client_class(environment, **self.client_kwargs)
+                self._d[key] = [client, secret_hash, now]
+                while len(self._d) > self.max_clients:
+                    (_, old) = self._d.popitem(last=False)
+                    self._stats['evictions'] += 1
+                    to_close.append(old[0])
+
+        for c in to_close: c.close()
+        return client
+
+
+    # env: name as passed to get() (any case), an environment object (matched by base_url) or None for all
+    def evict(self, client_id:str, env=None):
+        match = lambda k: True
+        if isStr(env):
+            name = env.strip().lower()
+            assert name in ENV_NAMES, f"Environment must be one of {', '.join(ENV_NAMES)}. Got '{env}'"
+            match = lambda k: k[0] == name
+        elif env is not None:
+            base_url = getattr(env, 'base_url', None)
+            assert base_url, f"env must be an environment name or object with base_url. Got {getClassName(env)}"
+            match = lambda k: k[1] == base_url
+        to_close = []
+        with self._lock:
+            for key in [k for k in self._d if k[2] == client_id and match(k)]:
+                to_close.append(self._d.pop(key)[0])
+        for c in to_close: c.close()
+        return len(to_close)
+
+
+    def close(self):
+        with self._lock:
+            clients = [e[0] for e in self._d.values()]
+            self._d.clear()
+        for c in clients: c.close()
+
+
+    def __len__(self):
+        with self._lock:
+            return len(self._d)
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            d = dict(self._stats)
+            d['size'] = len(self._d)
+        return d
+
+
+    # Call with self._lock held. Oldest entries are at the front
+    def _expire(self, now, to_close):
+        while self._d:
+            (key, e) = next(iter(self._d.items()))
+            if now - e[2] < self.idle_ttl: break
+            del self._d[key]
+            self._stats['expired'] += 1
+            to_close.append(e[0])
+
+
+
+# Read only, lazily wrapped view of an order JSON response
+# - Nested objects / arrays are wrapped only when accessed
+# - Links are indexed by rel on first use: link('approve') -> (href, rel, method)
+# - Supports view['status'] and view.status. to_dict() gives a full (copied) dict
+# - Fields named like Mapping methods (items, keys, values, get) are only reachable by key, eg.
+#   purchase_unit['items']. purchase_unit.items is the Mapping method
+# - Not JSON serializable. Use json.dumps(view.to_dict())
+class OrderView(Mapping):
+    __slots__ = ('_raw', '_wrapped', '_links')
+
+    def __init__(self, raw:dict):
+        assert isinstance(raw, dict), f"raw is not a dict. Got {getClassName(raw)}"
+        self._raw = raw
+        self._wrapped = None
+        self._links = None
+
+    def __getitem__(self, key):
+        v = self._raw[key]
+        if isinstance(v, (dict, list)):
+            if self._wrapped is None: self._wrapped = {}
+            w = self._wrapped.get(key)
+            if w is None: w = self._wrapped[key] = _wrap_view(v)
+            return w
+        return v
+
+    def __getattr__(self, name):
+        if name.startswith('_'): raise AttributeError(name) # No lookups for dunders / unset slots
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def __len__(self):
+        return len(self._raw)
+
+    def __contains__(self, key):
+        return key in self._raw
+
+    def __repr__(self):
+        return f"OrderView(id={self._raw.get('id')}, status={self._raw.get('status')})"
+
+    # (href, rel, method) or None
+    def link(self, rel):
+        if self._links is None:
+            self._links = {}
+            for l in self._raw.get('links') or ():
+                self._links.setdefault(l.get('rel'), (l.get('href'), l.get('rel'), l.get('method')))
+        return self._links.get(rel)
+
+    def to_dict(self) -> dict:
+        return copy.deepcopy(self._raw)
+
+    # Same as dict() on a paypalhttp Result
+    def dict(self) -> dict:
+        return self.to_dict()
+
+
+class _ListView(Sequence):
+    __slots__ = ('_raw', '_wrapped')
+
+    def __init__(self, raw:list):
+        self._raw = raw
+        self._wrapped = None
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self._raw)))]
+        v = self._raw[i]
+        if isinstance(v, (dict, list)):
+            if self._wrapped is None: self._wrapped = {}
+            i = i % len(self._raw)
+            w = self._wrapped.get(i)
+            if w is None: w = self._wrapped[i] = _wrap_view(v)
+            return w
+        return v
+
+    def __len__(self):
+        return len(self._raw)
+
+    def __repr__(self):
+        return f"_ListView(len={len(self._raw)})"
+
+    def to_list(self) -> list:
+        return copy.deepcopy(self._raw)
+
+
+def _wrap_view(v):
+    return OrderView(v) if isinstance(v, dict) else _ListView(v)
+
+
+# Outcome of one item of a batch call
+class BatchResult:
+    __slots__ = ('index', 'item', 'result', 'error', 'elapsed')
+
+    def __init__(self, index:int, item, result=None, error:Exception=None, elapsed:float=0.0):
+        self.index = index
+        self.item = item
+        self.result = result
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __repr__(self):
+        s = f"error={self.error!r}" if self.error is not None else f"result={getClassName(self.result)}"
+        return f"BatchResult(index={self.index}, {s}, elapsed={self.elapsed:.3f})"
+
+
+# Runs fn(item) for each item on a bounded thread pool. See Client.create_orders
+# - Items are pulled from `items` lazily so iterators of any length can be passed
+def run_batch(fn, items, max_workers:int=8, stream:bool=False):
+    assert isInt(max_workers) and max_workers > 0, f"max_workers must be a positive int. Got {max_workers}"
+    gen = _iter_batch(fn, items, max_workers)
+    if stream: return gen
+    return sorted(gen, key=lambda r: r.index)
+
+
+def _iter_batch(fn, items, max_workers):
+    def _call(i, item):
+        started = time.perf_counter()
+        try:
+            return BatchResult(i, item, result=fn(item), elapsed=time.perf_counter() - started)
+        except Exception as ex:
+            return BatchResult(i, item, error=ex, elapsed=time.perf_counter() - started)
+
+    it = enumerate(items)
+    pending = set()
+    ex = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='pp-batch')
+
+    def _submit() -> bool:
+        for (i, item) in it:
+            pending.add(ex.submit(_call, i, item))
+            return True
+        return False
+
+    try:
+        # Keep a small backlog queued so workers never idle but inputs are not all buffered
+        for _ in range(max_workers * 2):
+            if not _submit(): break
+
+        while pending:
+            (done, _) = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                pending.discard(f)
+                _submit()
+                yield f.result()
+    finally:
+        ex.shutdown(wait=True, cancel_futures=True)
+
+
+# Merges identical in-flight calls and caches their results by idempotency key
+# - Concurrent call(key, fn) with the same key run fn once. Every caller gets its result or exception
+# - Successful results are kept for `ttl` secs (LRU, at most max_size). Failures are not kept
+# - Results are shared between callers. Treat them as read only
+class RequestDeduper:
+    def __init__(self, max_size:int=1024, ttl:float=300.0):
+        assert isInt(max_size) and max_size >= 0, f"max_size must be an int >= 0. Got {max_size}"
+        assert ttl > 0, f"ttl must be > 0. Got {ttl}"
+        self.max_size = max_size
+        self.ttl = ttl
+        self._inflight = {}
+        self._done = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'executed': 0, 'merged': 0, 'cached': 0}
+
+
+    def call(self, key, fn):
+        now = time.monotonic()
+        with self._lock:
+            e = self._done.get(key)
+            if e is not None:
+                if now < e[0]:
+                    self._done.move_to_end(key)
+                    self._stats['cached'] += 1
+                    return e[1]
+                del self._done[key]
+
+            f = self._inflight.get(key)
+            leader = f is None
+            if leader:
+                f = self._inflight[key] = Future()
+            else:
+                self._stats['merged'] += 1
+
+        if not leader: return f.result()
+
+        try:
+            result = fn()
+        except BaseException as ex:
+            with self._lock:
+                del self._inflight[key]
+                self._stats['executed'] += 1
+            f.set_exception(ex)
+            raise
+
+        with self._lock:
+            del self._inflight[key]
+            self._stats['executed'] += 1
+            if self.max_size > 0:
+                self._done[key] = (time.monotonic() + self.ttl, result)
+                self._done.move_to_end(key)
+                while len(self._done) > self.max_size:
+                    self._done.popitem(last=False)
+        f.set_result(result)
+        return result
+
+
+    def invalidate(self, key):
+        with self._lock:
+            self._done.pop(key, None)
+
+
+    def clear(self):
+        with self._lock:
+            self._done.clear()
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            d = dict(self._stats)
+            d['inflight'] = len(self._inflight)
+            d['size'] = len(self._done)
+        return d
+
+
+
+# Bounded LRU cache of order records with a per entry TTL
+# - Entries are (ord_exists, ord_status, ord_info) as returned by Client.get_order_info
+# - put_missing() records a deleted / unknown order
+class OrderCache:
+    def __init__(self, max_size:int=1024, ttl:float=30.0):
+        assert isInt(max_size) and max_size > 0, f"max_size must be a positive int. Got {max_size}"
+        assert ttl > 0, f"ttl must be > 0. Got {ttl}"
+        self.max_size = max_size
+        self.ttl = ttl
+        self._d = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0}
+
+
+    # Returns (ord_exists, ord_status, ord_info) or None if not cached / expired
+    def get(self, ordid):
+        now = time.monotonic()
+        with self._lock:
+            e = self._d.get(ordid)
+            if e is None:
+                self._stats['misses'] += 1
+                return None
+            (expires_at, rec) = e
+            if now >= expires_at:
+                del self._d[ordid]
+                self._stats['expired'] += 1
+                self._stats['misses'] += 1
+                return None
+            self._d.move_to_end(ordid)
+            self._stats['hits'] += 1
+            return rec
+
+
+    def put(self, ordid, ord_info:dict):
+        ord_status = aget('ord_info', ord_info, 'status', True, True)
+        self._put(ordid, (True, ord_status, ord_info))
+
+
+    def put_missing(self, ordid):
+        self._put(ordid, (False, None, None))
+
+
+    def invalidate(self, ordid):
+        with self._lock:
+            self._d.pop(ordid, None)
+
+
+    def clear(self):
+        with self._lock:
+            self._d.clear()
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            d = dict(self._stats)
+            d['size'] = len(self._d)
+            return d
+
+
+    def _put(self, ordid, rec):
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            self._d[ordid] = (expires_at, rec)
+            self._d.move_to_end(ordid)
+            while len(self._d) > self.max_size:
+                self._d.popitem(last=False)
+                self._stats['evictions'] += 1
+
+
+# Token bucket shared by the threads of one or more Clients
+# - rate: requests per second (None = unlimited). burst: bucket size (default = rate)
+# - pause() blocks every caller, e.g. after PayPal answers 429 with Retry-After
+class TokenBucket:
+    def __init__(self, rate:float=None, burst:float=None):
+        assert rate is None or rate > 0, f"rate must be > 0 or None. Got {rate}"
+        self.rate = rate
+        self.burst = (burst if burst is not None else max(1.0, rate)) if rate is not None else None
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    # Waits for a token. Returns seconds spent waiting
+    def acquire(self) -> float:
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                delay = self._paused_until - now
+                if delay <= 0:
+                    if self.rate is None: return waited
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1.0:
+                        self._tokens -= 1.0
+                        return waited
+                    delay = (1.0 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds:float):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+# Throttles and retries the HTTP calls of a Client
+# - Every attempt takes a token from `bucket`
+# - 429 is always retried and pauses the whole bucket for Retry-After (or the backoff delay)
+# - 5xx, connection errors and read timeouts are retried only for idempotent calls
+#   (GET / DELETE or requests carrying a PayPal-Request-Id)
+# - Delay is Retry-After when sent, otherwise full jitter exponential backoff
+# - Each operation gets `max_retries` retries within `max_retry_time` secs.
+#   Override per operation with op_budgets={'create_order': (1, 5.0)}
+class RequestScheduler:
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, rate:float=None, burst:float=None
+                ,max_retries:int=3, max_retry_time:float=30.0
+                ,backoff_base:float=0.25, backoff_max:float=8.0, max_retry_after:float=30.0
+                ,op_budgets:dict=None):
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.max_retry_time = max_retry_time
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_retry_after = max_retry_after
+        self.op_budgets = {} if op_budgets is None else dict(op_budgets)
+        self._lock = threading.Lock()
+        self._stats = {}
+
+
+    # Calls send() (one HTTP attempt returning a requests.Response) with throttling and retries
+    def call(self, op:str, send, idempotent:bool=True):
+        (max_retries, max_retry_time) = self.op_budgets.get(op, (self.max_retries, self.max_retry_time))
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            waited = self.bucket.acquire()
+            self._count(op, 'requests')
+            if waited > 0:
+                self._count(op, 'throttled')
+                self._count(op, 'throttle_wait_s', waited)
+
+            paused = False
+            try:
+                resp = send()
+            except requests.exceptions.RequestException as ex:
+                if not self._retryable_error(ex, idempotent): raise
+                if not self._has_budget(op, attempt, started, max_retries, max_retry_time, 0.0): raise
+                delay = self._backoff(attempt)
+                self._count(op, f"retry_{getClassName(ex)}")
+            else:
+                status = resp.status_code
+                if not (status in self.RETRY_STATUS and (status == 429 or idempotent)):
+                    return resp
+                retry_after = parse_retry_after(resp.headers.get('Retry-After'))
+                delay = self._backoff(attempt) if retry_after is None else min(retry_after, self.max_retry_after)
+                if not self._has_budget(op, attempt, started, max_retries, max_retry_time, delay):
+                    return resp
+                if status == 429:
+                    self.bucket.pause(delay)
+                    paused = True
+                self._count(op, f"retry_{status}")
+                resp.close()
+
+            self._count(op, 'retries')
+            if not paused: # Paused bucket makes the next acquire() wait
+                time.sleep(delay)
+            attempt += 1
+
+
+    # {op: {'requests': n, 'retries': n, 'retry_<status>': n, 'throttled': n, 'throttle_wait_s': secs, 'gave_up': n}}
+    def stats(self) -> dict:
+        with self._lock:
+            return {op: dict(d) for (op, d) in self._stats.items()}
+
+
+    def _has_budget(self, op, attempt, started, max_retries, max_retry_time, delay) -> bool:
+        if attempt < max_retries and (time.monotonic() - started + delay) <= max_retry_time:
+            return True
+        self._count(op, 'gave_up')
+        return False
+
+
+    def _retryable_error(self, ex, idempotent) -> bool:
+        # Connect failures never reached PayPal so are always safe to retry
+        if isinstance(ex, (requests.exceptions.ConnectTimeout, requests.exceptions.SSLError)):
+            return isinstance(ex, requests.exceptions.ConnectTimeout)
+        if isinstance(ex, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            return idempotent
+        return False
+
+
+    def _backoff(self, attempt) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+
+    def _count(self, op, key, n=1):
+        with self._lock:
+            d = self._stats.get(op)
+            if d is None: d = self._stats[op] = {}
+            d[key] = d.get(key, 0) + n
+
+
+# Raised without calling PayPal while the circuit breaker for an endpoint family is open
+class CircuitOpenError(Exception):
+    def __init__(self, family:str, retry_in:float):
+        super().__init__(f"Circuit breaker for '{family}' is open. Retry in {retry_in:.1f}s")
+        self.family = family
+        self.retry_in = retry_in
+
+
+# Circuit breaker for one endpoint family
+# - closed: calls pass. Outcomes in the last `window` secs are kept. Once there are at least
+#   `min_calls` and the failure rate reaches `failure_rate` (or slow call rate reaches `slow_rate`
+#   for calls over `slow_call` secs) the breaker opens
+# - open: calls raise CircuitOpenError for `open_for` secs
+# - half_open: up to `probes` calls are let through. All succeed -> closed, any fails -> open
+# Failures are connection errors, timeouts and 5xx responses. 4xx / 429 count as success
+class CircuitBreaker:
+    def __init__(self, name:str, failure_rate:float=0.5, min_calls:int=20, window:float=30.0
+                ,slow_call:float=None, slow_rate:float=0.8, open_for:float=15.0, probes:int=3):
+        assert 0 < failure_rate <= 1, f"failure_rate must be > 0 and <= 1. Got {failure_rate}"
+        assert 0 < slow_rate <= 1, f"slow_rate must be > 0 and <= 1. Got {slow_rate}"
+        assert isInt(min_calls) and min_calls > 0, f"min_calls must be a positive int. Got {min_calls}"
+        assert isInt(probes) and probes > 0, f"probes must be a positive int. Got {probes}"
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.open_for = open_for
+        self.probes = probes
+        self._lock = threading.Lock()
+        self._calls = deque() # (time, failed, slow)
+        self._failed = 0
+        self._slow = 0
+        self._state = 'closed'
+        self._opened_at = 0.0
+        self._probing = 0
+        self._probe_ok = 0
+        self._stats = {'calls': 0, 'failures': 0, 'rejected': 0, 'opened': 0}
+
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+
+    # Returns True if the call is a half-open probe. Raises CircuitOpenError when open
+    def before_call(self) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            state = self._current_state(now)
+            if state == 'closed': return False
+            if state == 'half_open' and self._probing + self._probe_ok < self.probes:
+                self._probing += 1
+                return True
+            self._stats['rejected'] += 1
+            retry_in = max(0.0, self._opened_at + self.open_for - now) if state == 'open' else 0.0
+        raise CircuitOpenError(self.name, retry_in)
+
+
+    def after_call(self, probe:bool, failed:bool, elapsed:float):
+        now = time.monotonic()
+        slow = self.slow_call is not None and elapsed >= self.slow_call
+        with self._lock:
+            self._stats['calls'] += 1
+            if failed: self._stats['failures'] += 1
+            if probe:
+                self._probing -= 1
+                if failed or slow:
+                    self._open(now)
+                else:
+                    self._probe_ok += 1
+                    if self._probe_ok >= self.probes:
+                        self._state = 'closed'
+                        self._reset_window()
+                return
+
+            if self._state != 'closed': return # Call started before the breaker opened
+            self._calls.append((now, failed, slow))
+            self._failed += failed
+            self._slow += slow
+            self._trim(now)
+            n = len(self._calls)
+            if n >= self.min_calls and (self._failed / n >= self.failure_rate or self._slow / n >= self.slow_rate):
+                self._open(now)
+
+
+    def reset(self):
+        with self._lock:
+            self._state = 'closed'
+            self._reset_window()
+
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            d = dict(self._stats)
+            d['state'] = self._current_state(now)
+            self._trim(now)
+            d['window_calls'] = len(self._calls)
+            d['window_failures'] = self._failed
+            d['window_slow'] = self._slow
+        return d
+
+
+    def _current_state(self, now) -> str:
+        if self._state == 'open' and now >= self._opened_at + self.open_for:
+            self._state = 'half_open'
+            self._probing = 0
+            self._probe_ok = 0
+        return self._state
+
+
+    def _open(self, now):
+        self._state = 'open'
+        self._opened_at = now
+        self._stats['opened'] += 1
+        self._reset_window()
+        pc(f"WARNING - Circuit breaker '{self.name}' opened for {self.open_for}s")
+
+
+    def _reset_window(self):
+        self._calls.clear()
+        self._failed = 0
+        self._slow = 0
+
+
+    def _trim(self, now):
+        cutoff = now - self.window
+        while self._calls and self._calls[0][0] < cutoff:
+            (_, failed, slow) = self._calls.popleft()
+            self._failed -= failed
+            self._slow -= slow
+
+
+
+# One CircuitBreaker per endpoint family. Pass one instance to several Clients to share state
+# - Families: oauth (/v1/oauth2), v2_orders (/v2/checkout/orders), v1_orders (/v1/checkout/orders), other
+# - `overrides`: {family: {CircuitBreaker kwargs}} on top of the shared kwargs
+class CircuitBreakers:
+    FAMILIES = (('/v1/oauth2/', 'oauth'), ('/v2/checkout/orders', 'v2_orders'), ('/v1/checkout/orders', 'v1_orders'))
+
+    def __init__(self, overrides:dict=None, **kwargs):
+        overrides = overrides or {}
+        self.breakers = {}
+        for family in [f for (_, f) in self.FAMILIES] + ['other']:
+            self.breakers[family] = CircuitBreaker(family, **{**kwargs, **overrides.get(family, {})})
+
+
+    def for_url(self, url:str) -> CircuitBreaker:
+        path = urlparse(url).path
+        for (prefix, family) in self.FAMILIES:
+            if path.startswith(prefix): return self.breakers[family]
+        return self.breakers['other']
+
+
+    # {family: 'closed' | 'open' | 'half_open'}
+    def states(self) -> dict:
+        return {family: b.state for (family, b) in self.breakers.items()}
+
+
+    def stats(self) -> dict:
+        return {family: b.stats() for (family, b) in self.breakers.items()}
+
+
+    def reset(self):
+        for b in self.breakers.values(): b.reset()
+
+
+
+# Retry-After is either delay-seconds or an HTTP date. Returns seconds or None
+def parse_retry_after(v) -> float:
+    if v is None: return None
+    v = v.strip()
+    if v.isdigit(): return float(v)
+    try:
+        return max(0.0, parsedate_to_datetime(v).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# Thread safe cache of the OAuth access token for a Client
+# - Token is held until `expiry_margin` seconds before `expires_in`
+# - Once inside `refresh_ahead` seconds of expiry, one background refresh is started
+#   while callers keep getting the current token
+# - When no valid token is held, only one caller fetches and the others wait on it
+class AccessTokenCache:
+    def __init__(self, fetch, expiry_margin:int=60, refresh_ahead:int=300):
+        assert callable(fetch), f"fetch is not callable. Got {getClassName(fetch)}"
+        assert expiry_margin >= 0, f"expiry_margin must be >= 0. Got {expiry_margin}"
+        assert refresh_ahead >= expiry_margin, f"refresh_ahead must be >= expiry_margin. Got {refresh_ahead}"
+        self._fetch = fetch
+        self.expiry_margin = expiry_margin
+        self.refresh_ahead = refresh_ahead
+        self._cond = threading.Condition(threading.Lock())
+        self._token = None
+        self._token_type = None
+        self._expires_at = 0.0
+        self._refreshing = False
+        self._error = None
+        self._generation = 0
+        self.fetch_count = 0
+
+
+    def get(self) -> str:
+        return self._get()[0]
+
+
+    def authorization_string(self) -> str:
+        (token, token_type) = self._get()
+        return f"{token_type} {token}"
+
+
+    # (token, token_type) = _get()
+    def _get(self):
+        with self._cond:
+            gen = None
+            while True:
+                now = time.monotonic()
+                if self._is_valid(now):
+                    if not self._refreshing and now >= self._expires_at - self.refresh_ahead:
+                        self._refreshing = True
+                        threading.Thread(target=self._refresh, name='pp-token-refresh', daemon=True).start()
+                    return (self._token, self._token_type)
+
+                if not self._refreshing: break
+
+                # Another thread is fetching - wait for it rather than piling on
+                if gen is None: gen = self._generation
+                self._cond.wait()
+                if self._generation != gen and self._error is not None and not self._is_valid(time.monotonic()):
+                    raise self._error
+
+            self._refreshing = True
+
+        self._refresh(raise_error=True)
+        with self._cond:
+            return (self._token, self._token_type)
+
+
+    # authorization: drop the token only if it is still the one that failed, so concurrent
+    # 401s on the same token cause one fetch
+    def invalidate(self, authorization:str=None):
+        with self._cond:
+            if authorization is not None and authorization != f"{self._token_type} {self._token}": return
+            self._token = None
+            self._expires_at = 0.0
+
+
+    @property
+    def expires_in(self) -> float:
+        with self._cond:
+            if self._token is None: return 0.0
+            return max(0.0, self._expires_at - time.monotonic())
+
+
+    def _is_valid(self, now) -> bool:
+        return self._token is not None and now < self._expires_at - self.expiry_margin
+
+
+    def _refresh(self, raise_error:bool=False):
+        started = time.monotonic()
+        try:
+            (token, token_type, expires_in) = self._fetch()
+        except Exception as ex:
+            with self._cond:
+                self._refreshing = False
+                self._error = ex
+                self._generation += 1
+                self._cond.notify_all()
+            if raise_error: raise
+            pc(f"WARNING - Background access token refresh failed: {ex}")
+            return
+
+        with self._cond:
+            self._token = token
+            self._token_type = token_type
+            self._expires_at = started + (expires_in if expires_in and expires_in > 0 else 0)
+            self._refreshing = False
+            self._error = None
+            self._generation += 1
+            self.fetch_count += 1
+            self._cond.notify_all()
+
+
+# Validator for create_order requests, built once and reused (see ORDER_VALIDATOR)
+# - Checks purchase_units and application_context in one pass and collects every error
+# - Messages match the ones raised by aget()
+class OrderRequestValidator:
+    def __init__(self, url_cache_size:int=1024):
+        self._re_email = re.compile(RE_VALID_EMAIL)
+        # (alias, key, required, dtype)
+        self._pu_rules = (
+             ('purchase_units', 'amount', True, dict)
+            ,('purchase_units', 'payee', False, dict)
+        )
+        self._amount_rules = (
+             ('amount', 'currency_code', True, str)
+            ,('amount', 'value', True, str)
+        )
+        self._ctx_rules = (
+             ('application_context', 'brand_name', False, str)
+            ,('application_context', 'shipping_preference', True, str)
+            ,('application_context', 'user_action', True, str)
+            ,('application_context', 'return_url', True, str)
+            ,('application_context', 'cancel_url', True, str)
+        )
+        self._url_cache_size = url_cache_size
+        self._url_cache = {}
+
+
+    # Raises AssertionError listing all errors
+    def validate(self, purchase_units, application_context):
+        (errors, warnings) = self.check(purchase_units, application_context)
+        for w in warnings: pc(f"WARNING - {w}")
+        if errors: raise AssertionError('; '.join(errors))
+
+
+    # Returns a list of (index, errors) for each invalid (purchase_units, application_context) item
+    def validate_batch(self, items) -> list:
+        failed = []
+        for (i, (purchase_units, application_context)) in enumerate(items):
+            (errors, _) = self.check(purchase_units, application_context)
+            if errors: failed.append((i, errors))
+        return failed
+
+
+    # (errors, warnings) = check(purchase_units, application_context)
+    def check(self, purchase_units, application_context):
+        errors = []
+        warnings = []
+        if not isinstance(purchase_units, dict):
+            errors.append(f"purchase_units is not a dict. Got {getClassName(purchase_units)}")
+            purchase_units = None
+        if not isinstance(application_context, dict):
+            errors.append(f"application_context is not a dict. Got {getClassName(application_context)}")
+            application_context = None
+
+        pu = {} if purchase_units is None else self._check_fields(purchase_units, self._pu_rules, errors)
+        ctx = {} if application_context is None else self._check_fields(application_context, self._ctx_rules, errors)
+
+        amount = pu.get('amount')
+        if amount is not None:
+            self._check_fields(amount, self._amount_rules, errors)
+
+        payee = pu.get('payee')
+        if payee is None:
+            if purchase_units is not None and application_context is not None and not ctx.get('brand_name'):
+                warnings.append("Merchant block at top of UI will show Test Store because payee and brand_name are not specified")
+        else:
+            payee_email = self._check_fields(payee, (('payee', 'email_address', True, str),), errors).get('email_address')
+            if payee_email is not None and not self._re_email.fullmatch(payee_email):
+                errors.append(f"Email address for payee is invalid. Got '{payee_email}'")
+
+        for k in ('return_url', 'cancel_url'):
+            url = ctx.get(k)
+            if url is not None and not self._valid_url(url):
+                errors.append(f"{k} is invalid. Please pass valid URL. Got '{url}'")
+
+        return (errors, warnings)
+
+
+    # Returns {key: value} of fields that passed
+    def _check_fields(self, obj, rules, errors) -> dict:
+        found = {}
+        for (alias, key, req, dtype) in rules:
+            v = obj.get(key)
+            if v is None:
+                if req: errors.append(f'Missing key {key} from {alias}')
+                continue
+            if not isinstance(v, dtype):
+                errors.append(f'value for key {key} in {alias} is not a {dtype.__name__}. Got: {getClassName(v)}')
+                continue
+            found[key] = v.strip() if dtype is str else v
+        return found
+
+
+    # return / cancel urls repeat across orders so remember the urlparse result
+    def _valid_url(self, url) -> bool:
+        ok = self._url_cache.get(url)
+        if ok is None:
+            ok = valid_uri(url)
+            if len(self._url_cache) >= self._url_cache_size: self._url_cache.clear()
+            self._url_cache[url] = ok
+        return ok
+
+
+ORDER_VALIDATOR = OrderRequestValidator()
+
+
+# Validations for create_order (Fail Fast)
+def validate_order_request(purchase_units, application_context):
+    ORDER_VALIDATOR.validate(purchase_units, application_context)
+
+
+# Returns a list of (index, errors) for the invalid items of [(purchase_units, application_context), ...]
+def validate_order_requests(items) -> list:
+    return ORDER_VALIDATOR.validate_batch(items)
+
+
+def new_create_order_request(purchase_units, application_context, request_id:str=None) -> OrdersCreateRequest:
+    # OPTIONAL - Validations (Fail Fast)
+    validate_order_request(purchase_units, application_context)
+
+    request = OrdersCreateRequest()
+    request.prefer('return=representation')
+    if request_id: request.headers["PayPal-Request-Id"] = str(request_id)
+
+    request.request_body (
+        {
+             "intent": "AUTHORIZE"
+            ,"purchase_units": [purchase_units]
+            ,'application_context': application_context
+        }
+    )
+    return request
+
+
+def new_authorize_order_request(pp_ordid, request_id:str=None) -> OrdersAuthorizeRequest:
+    req = OrdersAuthorizeRequest(pp_ordid)
+    req.prefer("return=representation")
+    if request_id: req.pay_pal_request_id(request_id)
+    req.request_body({})
+    return req
+
+
+# Stable PayPal-Request-Id for a create_order request or None
+# - Only derived when purchase_units identifies the order (invoice_id or custom_id). Two orders
+#   with the same amount and no identifier are different orders
+def derive_create_request_id(purchase_units, application_context) -> str:
+    if not isinstance(purchase_units, dict): return None
+    if not (purchase_units.get('invoice_id') or purchase_units.get('custom_id')): return None
+    blob = json.dumps([purchase_units, application_context], sort_keys=True, separators=(',', ':'), default=str)
+    return f"create-{hashlib.sha256(blob.encode('utf-8')).hexdigest()[:40]}"
+
+
+def get_authorize_result_dict(resp) -> dict:
+    if not resp.status_code == 201:
+        raise Exception(f"Unexpected response from OrdersAuthorizeRequest: {resp.status_code}. Full response: {resp}")
+
+    return get_order_result_dict(resp)
+
+
 def get_order_result_dict(ord_resp) -> dict:
     assert isinstance(ord_resp, HttpResponse), f"ord_resp is not a HttpResponse. Got: {getClassName(ord_resp)}"
     result = aget('ord_resp', ord_resp, 'result', True, True, dtype=Result)
@@ -149,6 +1382,10 @@ def get_order_result_dict(ord_resp) -> dict:
 
 # (_href, _rel, _method) = get_link_by_rel(result, rel)
 def get_link_by_rel(result, rel):
+    if isinstance(result, OrderView):
+        link = result.link(rel)
+        if link is None: raise Exception(f"Link not found for rel '{rel}'")
+        return link
     assert isinstance(result, (Result, dict)), f"result is not a paypalhttp.http_response.Result. Got: {getClassName(result)}"
     links = aget('result', result, 'links', True, True, dtype=list)
     for link in links:
@@ -0,0 +1,379 @@
+# pptrace.py
+# Per order timeline tracing. One trace per order id, spans from every thread that touches the order
+# - Client calls (create / get / authorize / cancel) are spans waiting on PayPal
+# - The PayPal dialog (browser launch to redirect callback or browser closed) is a span waiting on the user
+# - QWebServer redirect callbacks are server spans. Browser closed is an event seen on the watcher thread
+# - Threads find the trace by order id (PayPal's `token` on redirects), so nothing needs passing between them
+# - Exported as OTLP/JSON (collector /v1/traces body) and summarized per order
+# Author: https://github.com/JavaScriptDude
+# License: MIT
+
+# Usage:
+#   python3 main.py --trace traces.json          (or PP_TRACE=traces.json)
+#   - or in code:
+#   with Tracer('traces.json') as tracer:
+#       tracer.instrument_client(pp_client)
+#       web_server = WebServer(host, port, tracer=tracer)
+#       with tracer.span(ordid, 'journal.record'): ...
+#   tracer.summary()
+
+import os
+import json
+import time
+import threading
+import contextvars
+from collections import OrderedDict
+from collections.abc import Mapping
+from contextlib import contextmanager
+from helpers import *
+
+
+# Span `pp.wait` attribute. What the order was waiting on during the span
+WAITS = ('paypal', 'user', 'local')
+
+# OTLP SpanKind
+KINDS = {'INTERNAL': 1, 'SERVER': 2, 'CLIENT': 3}
+
+TRACED_METHODS = ('create_order', 'get_order_info', 'authorize_order', 'cancel_order')
+
+# Span open on the current thread. Spans started on the same thread and order nest under it
+_current = contextvars.ContextVar('pptrace_current', default=None)
+
+
+class Span:
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'kind', 'start_ns', 'end_ns', 'attrs', 'events', 'error')
+
+    def __init__(self, trace, name:str, parent_id:str=None, kind:str='INTERNAL', start_ns:int=None, attrs:dict=None):
+        assert kind in KINDS, f"kind must be one of {', '.join(KINDS)}. Got {kind}"
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns() if start_ns is None else start_ns
+        self.end_ns = None
+        self.attrs = {} if attrs is None else attrs
+        self.events = []
+        self.error = None
+
+    @property
+    def ended(self) -> bool:
+        return self.end_ns is not None
+
+    # Secs. Up to now if still open
+    @property
+    def duration(self) -> float:
+        return ((self.end_ns if self.end_ns is not None else time.time_ns()) - self.start_ns) / 1e9
+
+    def set(self, key:str, value):
+        self.attrs[key] = value
+
+    def add_event(self, name:str, **attrs):
+        attrs.setdefault('thread.name', threading.current_thread().name)
+        self.events.append((time.time_ns(), name, attrs))
+
+    # First end wins so a span closed from another thread is not ended twice
+    def end(self, error=None, end_ns:int=None) -> bool:
+        with self.trace.lock:
+            if self.end_ns is not None: return False
+            self.end_ns = time.time_ns() if end_ns is None else end_ns
+            if error is not None: self.error = f"{getClassName(error)}: {error}" if isinstance(error, BaseException) else str(error)
+        return True
+
+    def to_otlp(self, end_ns:int) -> dict:
+        d = {
+             'traceId': self.trace.trace_id
+            ,'spanId': self.span_id
+            ,'name': self.name
+            ,'kind': KINDS[self.kind]
+            ,'startTimeUnixNano': str(self.start_ns)
+            ,'endTimeUnixNano': str(self.end_ns if self.end_ns is not None else end_ns)
+            ,'attributes': _otlp_attrs(self.attrs)
+            ,'status': {'code': 2, 'message': self.error} if self.error else {'code': 1}
+        }
+        if self.parent_id: d['parentSpanId'] = self.parent_id
+        if self.events:
+            d['events'] = [{'timeUnixNano': str(t), 'name': n, 'attributes': _otlp_attrs(a)} for (t, n, a) in self.events]
+        return d
+
+
+
+# All spans of one order. The root `order` span runs from the first span to the last
+class OrderTrace:
+    def __init__(self, ordid:str, start_ns:int=None):
+        self.ordid = ordid
+        self.trace_id = os.urandom(16).hex()
+        self.lock = threading.Lock()
+        self.root = Span(self, 'order', start_ns=start_ns, attrs={'pp.order_id': ordid})
+        self.spans = []
+
+    def add(self, span:Span):
+        with self.lock:
+            self.spans.append(span)
+            if span.start_ns < self.root.start_ns: self.root.start_ns = span.start_ns
+
+    # Most recently started span still open, eg. user.approval while a redirect is handled
+    def open_span(self, name:str=None) -> Span:
+        with self.lock:
+            for span in reversed(self.spans):
+                if span.end_ns is None and (name is None or span.name == name): return span
+        return None
+
+    def end_ns(self) -> int:
+        if self.root.end_ns is not None: return self.root.end_ns
+        with self.lock:
+            ends = [s.end_ns for s in self.spans if s.end_ns is not None]
+        return max(ends) if ends else time.time_ns()
+
+    # Where the order's wall time went
+    # - paypal_s / user_s are summed over spans with that pp.wait. local_s is the rest of the order
+    # - slowest is the longest paypal or user span
+    def summary(self) -> dict:
+        with self.lock:
+            spans = list(self.spans)
+        total = (self.end_ns() - self.root.start_ns) / 1e9
+        waits = {w: 0.0 for w in WAITS}
+        slowest = None
+        for span in spans:
+            if not span.ended: continue
+            w = span.attrs.get('pp.wait')
+            if w in ('paypal', 'user'):
+                waits[w] += span.duration
+                if slowest is None or span.duration > slowest.duration: slowest = span
+        waits['local'] = max(0.0, total - waits['paypal'] - waits['user'])
+        return {
+             'ordid': self.ordid
+            ,'trace_id': self.trace_id
+            ,'total_s': total
+            ,'paypal_s': waits['paypal']
+            ,'user_s': waits['user']
+            ,'local_s': waits['local']
+            ,'spans': len(spans)
+            ,'errors': sum(1 for s in spans if s.error)
+            ,'slowest': None if slowest is None else {'name': slowest.name, 'duration_s': slowest.duration}
+        }
+
+
+
+class Tracer:
+    # summary_lines: per order summaries printed on exit (latest orders). Totals are printed for 2+ orders
+    def __init__(self, out_path:str=None, service:str='paypal-auth-intent', max_orders:int=10000, summary_lines:int=10):
+        assert isInt(max_orders) and max_orders > 0, f"max_orders must be a positive int. Got {max_orders}"
+        self.out_path = out_path
+        self.service = service
+        self.max_orders = max_orders
+        self.summary_lines = summary_lines
+        self.dropped = 0 # Oldest traces dropped over max_orders
+        self._traces = OrderedDict()
+        self._lock = threading.Lock()
+        self._wrapped = []
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.uninstrument_client()
+        if self.out_path:
+            try:
+                self.export(self.out_path)
+                pc(f"Traces for {len(self._traces)} order(s) written to {self.out_path}")
+            except Exception as ex:
+                pc(f"WARNING - Could not write traces: {ex}")
+        summaries = self.summary()
+        for d in summaries[-self.summary_lines:] if self.summary_lines else []:
+            pc(format_trace_summary(d))
+        if len(summaries) > 1:
+            pc(format_trace_totals(summaries))
+        return False
+
+
+    # Trace of an order. Created on first use
+    def trace(self, ordid:str, start_ns:int=None) -> OrderTrace:
+        with self._lock:
+            trace = self._traces.get(ordid)
+            if trace is None:
+                trace = self._traces[ordid] = OrderTrace(ordid, start_ns)
+                while len(self._traces) > self.max_orders:
+                    self._traces.popitem(last=False)
+                    self.dropped += 1
+            return trace
+
+
+    def get_trace(self, ordid:str) -> OrderTrace:
+        with self._lock:
+            return self._traces.get(ordid)
+
+
+    # Parent is the span open on this thread for the order, else the order's latest open span
+    # (the step another thread is waiting on), else the root
+    def start_span(self, ordid:str, name:str, wait:str='local', kind:str='INTERNAL', start_ns:int=None, **attrs) -> Span:
+        assert wait in WAITS, f"wait must be one of {', '.join(WAITS)}. Got {wait}"
+        trace = self.trace(ordid, start_ns)
+        cur = _current.get()
+        parent = cur if cur is not None and cur.trace is trace and not cur.ended else trace.open_span()
+        attrs['pp.order_id'] = ordid
+        attrs['pp.wait'] = wait
+        attrs['thread.name'] = threading.current_thread().name
+        span = Span(trace, name, (parent or trace.root).span_id, kind, start_ns, attrs)
+        trace.add(span)
+        return span
+
+
+    # Usage:
+    #   with tracer.span(ordid, 'paypal.get_order_info', wait='paypal') as span: ...
+    @contextmanager
+    def span(self, ordid:str, name:str, wait:str='local', kind:str='INTERNAL', **attrs):
+        span = self.start_span(ordid, name, wait, kind, **attrs)
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as ex:
+            span.end(error=ex)
+            raise
+        finally:
+            _current.reset(token)
+            span.end()
+
+
+    # Span for a step whose order id is only known once it finished (eg. create_order)
+    def add_span(self, ordid:str, name:str, start_ns:int, end_ns:int, wait:str='local', kind:str='INTERNAL', error=None, **attrs) -> Span:
+        span = self.start_span(ordid, name, wait, kind, start_ns=start_ns, **attrs)
+        span.end(error=error, end_ns=end_ns)
+        return span
+
+
+    # Open span of an order by name, eg. to end it from another thread. None if there is none
+    def open_span(self, ordid:str, name:str) -> Span:
+        trace = self.get_trace(ordid)
+        return None if trace is None else trace.open_span(name)
+
+
+    # QWebServer.add_order_listener() callback
+    # - Ends the order's user.approval span on the thread that resolved it (redirect or browser watcher)
+    def order_listener(self):
+        def _on_event(event):
+            span = self.open_span(event.token, 'user.approval')
+            if span is None: return
+            span.add_event(f"order.{event.outcome}", **({'pp.payer_id': event.payer_id} if event.payer_id else {}))
+            span.set('pp.outcome', event.outcome)
+            span.end()
+        return _on_event
+
+
+    # Client calls become `paypal.<method>` CLIENT spans on the calling thread
+    # - create_order is recorded once the order id is known. Failed creates have no order so are not traced
+    def instrument_client(self, client):
+        for name in TRACED_METHODS:
+            fn = getattr(client, name, None)
+            if fn is None: continue
+            self._wrapped.append((client, name, client.__dict__.get(name)))
+            setattr(client, name, self._traced_create(fn) if name == 'create_order' else self._traced(name, fn))
+
+
+    # Restores what was on the client before, eg. RunProfiler's wrappers
+    def uninstrument_client(self):
+        for (client, name, prev) in reversed(self._wrapped):
+            if prev is not None:
+                setattr(client, name, prev)
+            else:
+                try:
+                    delattr(client, name)
+                except AttributeError:
+                    pass
+        self._wrapped = []
+
+
+    def _traced(self, name, fn):
+        def wrapper(ordid, *args, **kwargs):
+            with self.span(ordid, f"paypal.{name}", wait='paypal', kind='CLIENT') as span:
+                resu = fn(ordid, *args, **kwargs)
+                if name == 'get_order_info':
+                    span.set('pp.status', resu[1] if resu[0] else 'NOT_FOUND')
+                elif isinstance(resu, Mapping) and 'status' in resu:
+                    span.set('pp.status', resu['status'])
+                return resu
+        return wrapper
+
+
+    def _traced_create(self, fn):
+        def wrapper(*args, **kwargs):
+            started = time.time_ns()
+            resu = fn(*args, **kwargs)
+            ordid = resu.get('id') if isinstance(resu, Mapping) else None
+            if ordid:
+                self.add_span(ordid, 'paypal.create_order', started, time.time_ns(), wait='paypal', kind='CLIENT'
+                             ,**{'pp.status': resu.get('status')})
+            return resu
+        return wrapper
+
+
+    # {ordid: summary} or a list of summaries in order of first span
+    def summary(self, ordid:str=None):
+        if ordid is not None:
+            trace = self.get_trace(ordid)
+            return None if trace is None else trace.summary()
+        with self._lock:
+            traces = list(self._traces.values())
+        return [t.summary() for t in traces]
+
+
+    # OTLP/JSON ExportTraceServiceRequest. Open spans are closed at the order's last span end
+    def to_otlp(self) -> dict:
+        with self._lock:
+            traces = list(self._traces.values())
+        spans = []
+        for trace in traces:
+            end_ns = trace.end_ns()
+            root = trace.root.to_otlp(end_ns)
+            root['attributes'] += _otlp_attrs({k: v for (k, v) in trace.summary().items() if k.endswith('_s')}, prefix='pp.')
+            spans.append(root)
+            with trace.lock:
+                children = list(trace.spans)
+            spans.extend(s.to_otlp(end_ns) for s in children)
+        return {'resourceSpans': [{
+             'resource': {'attributes': _otlp_attrs({'service.name': self.service, 'process.pid': os.getpid()})}
+            ,'scopeSpans': [{'scope': {'name': 'pptrace'}, 'spans': spans}]
+        }]}
+
+
+    def export(self, path:str):
+        with open(path, 'w') as f:
+            json.dump(self.to_otlp(), f)
+
+
+
+def _otlp_attrs(d:dict, prefix:str='') -> list:
+    out = []
+    for (k, v) in d.items():
+        if v is None: continue
+        if isinstance(v, bool): val = {'boolValue': v}
+        elif isinstance(v, int): val = {'intValue': str(v)}
+        elif isinstance(v, float): val = {'doubleValue': v}
+        else: val = {'stringValue': str(v)}
+        out.append({'key': f"{prefix}{k}", 'value': val})
+    return out
+
+
+def format_trace_summary(d:dict) -> str:
+    s = (f"Order {d['ordid']} trace {d['trace_id']}: total {d['total_s']:.3f}s"
+        +f"  paypal {d['paypal_s']:.3f}s  user {d['user_s']:.3f}s  local {d['local_s']:.3f}s")
+    if d['slowest']: s += f"  slowest {d['slowest']['name']} {d['slowest']['duration_s']:.3f}s"
+    if d['errors']: s += f"  errors {d['errors']}"
+    return s
+
+
+# Orders traced, mean total / paypal / user / local secs and the step that was slowest most often
+def format_trace_totals(summaries:list) -> str:
+    n = len(summaries)
+    means = {k: sum(d[k] for d in summaries) / n for k in ('total_s', 'paypal_s', 'user_s', 'local_s')}
+    slowest = {}
+    for d in summaries:
+        if d['slowest']: slowest[d['slowest']['name']] = slowest.get(d['slowest']['name'], 0) + 1
+    s = (f"Traced {n} orders. Mean total {means['total_s']:.3f}s  paypal {means['paypal_s']:.3f}s"
+        +f"  user {means['user_s']:.3f}s  local {means['local_s']:.3f}s")
+    if slowest:
+        (name, count) = max(slowest.items(), key=lambda kv: kv[1])
+        s += f"  slowest step: {name} ({count} orders)"
+    return s
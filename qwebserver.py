@@ -0,0 +1,248 @@
+# qwebserver.py
+# Flask / flask_restx server for PayPal UI redirects
+# - Separate from helpers.py so flask is only imported when a redirect listener is needed
+# Author: https://github.com/JavaScriptDude
+# License: MIT
+
+import logging
+import threading
+import time
+from flask import Flask, request, make_response
+from flask_restx import Api as FlaskRestxApi, Resource
+from werkzeug.serving import make_server
+from ppmetrics import METRICS
+from helpers import *
+
+
+# Disable Access Logging by werkzeug
+# Access logging will be handled by WSGI layer or above
+log_werkzeug = logging.getLogger('werkzeug')
+log_werkzeug.setLevel(logging.ERROR)
+
+
+class QResource(Resource):
+    def __init__(self, *class_args, **kwargs):
+        self.shutdown_server = kwargs['shutdown_server']
+        self.web_server = kwargs['web_server']
+        self.pc = kwargs['pc']
+        self.metrics = kwargs.get('metrics')
+        self.tracer = kwargs.get('tracer')
+        
+        super().__init__(*class_args, **kwargs)
+
+    # Routes called for an order (PayPal's `token` query param) are spans in its trace (see pptrace)
+    def dispatch_request(self, *args, **kwargs):
+        token = request.args.get('token') if self.tracer is not None else None
+        if not token: return self._timed_dispatch(*args, **kwargs)
+        with self.tracer.span(token, f"web {request.path}", kind='SERVER', **{'http.target': request.path}):
+            return self._timed_dispatch(*args, **kwargs)
+
+    # Time every route the same way Client operations are timed (see ppmetrics)
+    def _timed_dispatch(self, *args, **kwargs):
+        if self.metrics is None: return super().dispatch_request(*args, **kwargs)
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            resp = super().dispatch_request(*args, **kwargs)
+            if isinstance(resp, tuple):
+                status = resp[1] if len(resp) > 1 and isinstance(resp[1], int) else 200
+            else:
+                status = getattr(resp, 'status_code', 200)
+            return resp
+        finally:
+            elapsed = time.perf_counter() - started
+            route = request.url_rule.rule if request.url_rule else request.path
+            self.metrics.observe('web', route, elapsed, error=(status == 'error' or status >= 500))
+            self.metrics.observe_http('web', route, status, elapsed)
+
+    #abstract method
+    def run(self): pass
+
+    def get(self): return self.run()
+    def post(self): return self.run()
+    
+    def html_response(self, html, status_code=200):
+        response = make_response()
+        response.set_data(html)
+        response.status_code = status_code
+        response.headers['Content-Type'] = 'text/html'
+        return response
+
+    def shutdown_server(self):
+        pass
+
+
+# Published when an order's redirect callback arrives or its browser is closed
+# - outcome is one of 'accepted', 'cancelled' or 'closed' (browser closed by user)
+class OrderEvent:
+    __slots__ = ('token', 'payer_id', 'outcome', 'args', 'time')
+
+    def __init__(self, token, outcome, args=None):
+        self.token = token
+        self.outcome = outcome
+        self.args = {} if args is None else args
+        self.payer_id = self.args.get('PayerID')
+        self.time = time.time()
+
+    def __repr__(self):
+        return f"OrderEvent(token={self.token}, outcome={self.outcome}, payer_id={self.payer_id})"
+
+
+# An order waiting on its PayPal UI redirect callback
+class PendingOrder:
+    def __init__(self, token, on_event=None):
+        self.token = token
+        self.browser_pid = None
+        self.event = None
+        self.done = threading.Event()
+        self._on_event = on_event
+        self._lock = threading.Lock()
+
+    @property
+    def outcome(self):
+        return None if self.event is None else self.event.outcome
+
+    @property
+    def args(self):
+        return None if self.event is None else self.event.args
+
+    # First resolution wins. Returns False if already resolved
+    def resolve(self, outcome, args=None) -> bool:
+        with self._lock:
+            if self.done.is_set(): return False
+            self.event = OrderEvent(self.token, outcome, args)
+            self.done.set()
+        if self._on_event is not None:
+            self._on_event(self.event)
+        return True
+
+    # Block until the order is resolved. Returns the OrderEvent or None on timeout
+    def wait(self, timeout:float=None) -> OrderEvent:
+        if not self.done.wait(timeout): return None
+        return self.event
+
+
+# Long lived, multi-threaded server for PayPal UI redirects
+# - Many orders can be pending at once. Callbacks are routed by the `token` query param
+# - Runs until begin_shutdown() is called, which drains pending orders first
+class QWebServer(threading.Thread):
+    # Default secs begin_shutdown() waits on pending orders. The server thread is not a daemon, so an
+    # unbounded wait on a callback that never comes would keep the process alive
+    DRAIN_TIMEOUT = 300.0
+
+    # tracer: optional pptrace.Tracer. Redirect callbacks and order events are traced per order
+    def __init__(self, host, port, threaded:bool=True, metrics=METRICS, tracer=None):
+        threading.Thread.__init__(self)
+        assert isinstance(host, str) and not host.strip() == '', 'host param is required'
+        assert isinstance(port, int), 'port param must be an integer'
+        
+        self.app = app = Flask(__name__)
+        self.host = host
+        self.port = port
+        self.api = FlaskRestxApi(self.app)
+        self.metrics = metrics
+        if metrics is not None:
+            self.app.add_url_rule('/metrics', 'metrics', self._metrics_route)
+        self.srv = make_server(self.host, self.port, self.app, threaded=threaded)
+        self.is_running = True
+        self._orders = {}
+        self._orders_lock = threading.Lock()
+        self._listeners = []
+        self.tracer = tracer
+        if tracer is not None:
+            self.add_order_listener(tracer.order_listener())
+
+    def _build_kwargs(self, pc):
+        return {'shutdown_server': self.begin_shutdown, 'web_server': self, 'pc': pc, 'metrics': self.metrics
+               ,'tracer': self.tracer}
+
+
+    # Prometheus scrape endpoint
+    def _metrics_route(self):
+        response = make_response(self.metrics.render_prometheus())
+        response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        return response
+
+    def start(self):
+        # Finish flask_restx setup
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+        # Start thread
+        super().start()
+
+
+    def run(self):
+        self.srv.serve_forever()
+
+    def _do_shutdown(self):
+        self.srv.shutdown()
+
+
+    def register_order(self, token) -> PendingOrder:
+        assert isinstance(token, str) and not token.strip() == '', 'token param is required'
+        assert self.is_running, "Server is shutting down. Cannot register order"
+        pending = PendingOrder(token, on_event=self._publish)
+        with self._orders_lock:
+            assert not token in self._orders, f"Order already pending: {token}"
+            self._orders[token] = pending
+        return pending
+
+
+    def unregister_order(self, token):
+        with self._orders_lock:
+            self._orders.pop(token, None)
+
+
+    def get_order(self, token) -> PendingOrder:
+        with self._orders_lock:
+            return self._orders.get(token)
+
+
+    def pending_count(self) -> int:
+        with self._orders_lock:
+            return len(self._orders)
+
+
+    # fn(OrderEvent) is called on the resolving thread for every order event
+    def add_order_listener(self, fn):
+        assert callable(fn), f"fn is not callable. Got {getClassName(fn)}"
+        self._listeners.append(fn)
+
+
+    def _publish(self, event):
+        for fn in list(self._listeners):
+            try:
+                fn(event)
+            except Exception as ex:
+                pc(f"WARNING - Order listener failed for {event}: {ex}")
+
+
+    # Called from redirect route. Returns the PendingOrder or None if token is unknown
+    def resolve_order(self, token, outcome, args=None) -> PendingOrder:
+        pending = self.get_order(token) if token else None
+        if pending is None: return None
+        pending.resolve(outcome, args)
+        return pending
+
+
+    # Stop accepting orders, wait up to `drain_timeout` secs for pending ones then stop server
+    # - drain_timeout=0 closes immediately. None waits for every pending order however long it takes
+    # - Browsers of orders still pending at the deadline are closed
+    def begin_shutdown(self, drain_timeout:float=DRAIN_TIMEOUT):
+        if not self.is_running: return
+        self.is_running = False
+        pc("Server being shut down")
+        t = threading.Thread(target=self._drain_and_shutdown, args=(drain_timeout,))
+        t.start()
+
+    def _drain_and_shutdown(self, drain_timeout):
+        deadline = None if drain_timeout is None else time.monotonic() + drain_timeout
+        with self._orders_lock:
+            orders = list(self._orders.values())
+        for pending in orders:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not pending.done.wait(remaining):
+                if pending.browser_pid is not None:
+                    close_proc_if_running('browser', pending.browser_pid)
+        self._do_shutdown()